@@ -31,10 +31,54 @@ def create_app():
     from app.doc import doc_blueprint
     app.register_blueprint(doc_blueprint, url_prefix='/doc')
 
+    from app.lab.flowaccount import invoice_cli
+    app.cli.add_command(invoice_cli)
+
+    from app.lab.analyzers import analyzer_cli
+    app.cli.add_command(analyzer_cli)
+
+    from app.lab.ranges import range_cli
+    app.cli.add_command(range_cli)
+
+    from app.lab.stats import stats_cli
+    app.cli.add_command(stats_cli)
+
+    from app.lab.tat import tat_cli
+    app.cli.add_command(tat_cli)
+
+    from app.lab.apikeys import apikey_cli
+    app.cli.add_command(apikey_cli)
+
+    from app.lab.revisions import revision_cli
+    app.cli.add_command(revision_cli)
+
+    from app.bench import bench_cli
+    app.cli.add_command(bench_cli)
+
+    # Heroku style postgres:// URLs are not accepted by SQLAlchemy
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')\
-        .replace('://', 'ql://', 1)
+        .replace('postgres://', 'postgresql://', 1)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+    # numbers reserved per worker at a time, codes are unique but may have gaps, more so with larger blocks
+    app.config['ORDER_CODE_BLOCK_SIZE'] = int(os.environ.get('ORDER_CODE_BLOCK_SIZE', 1))
+    app.config['HN_BLOCK_SIZE'] = int(os.environ.get('HN_BLOCK_SIZE', 1))
+    app.config['INVOICE_MAX_ATTEMPTS'] = int(os.environ.get('INVOICE_MAX_ATTEMPTS', 8))
+    app.config['INVOICE_RETRY_BACKOFF'] = int(os.environ.get('INVOICE_RETRY_BACKOFF', 30))
+    # how long a worker holds a job while calling FlowAccount before another may retry it
+    app.config['INVOICE_CLAIM_SECONDS'] = int(os.environ.get('INVOICE_CLAIM_SECONDS', 300))
+    app.config['PDF_CACHE_DIR'] = os.environ.get('PDF_CACHE_DIR')
+    app.config['PDF_CACHE_MAX_BYTES'] = int(os.environ.get('PDF_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    app.config['PROFILER_ENABLED'] = os.environ.get('PROFILER_ENABLED', '').lower() in ('1', 'true', 'yes')
+    app.config['PROFILER_SLOW_QUERY_MS'] = int(os.environ.get('PROFILER_SLOW_QUERY_MS', 200))
+    app.config['REPORT_PROCESSES'] = int(os.environ['REPORT_PROCESSES']) if os.environ.get('REPORT_PROCESSES') else None
+    # smaller report exports are rendered in the request instead of the process pool
+    app.config['REPORT_POOL_THRESHOLD'] = int(os.environ.get('REPORT_POOL_THRESHOLD', 20))
+    app.config['ACTIVITY_BATCH_SIZE'] = int(os.environ.get('ACTIVITY_BATCH_SIZE', 100))
+    app.config['ACTIVITY_FLUSH_MS'] = int(os.environ.get('ACTIVITY_FLUSH_MS', 1000))
+    app.config['REVISION_RETENTION_DAYS'] = int(os.environ.get('REVISION_RETENTION_DAYS', 365))
+    # how long a worker serves a lab catalogue before checking the version table
+    app.config['CATALOGUE_CHECK_SECONDS'] = float(os.environ.get('CATALOGUE_CHECK_SECONDS', 5))
 
     db.init_app(app)
     migrate.init_app(app, db)
@@ -43,4 +87,10 @@ def create_app():
     principal.init_app(app)
     csrf_protect.init_app(app)
 
+    from app.profiler import profiler
+    profiler.init_app(app)
+
+    from app.lab.activities import activity_log
+    activity_log.init_app(app)
+
     return app
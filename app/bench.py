@@ -0,0 +1,379 @@
+import json
+import random
+import time
+from datetime import timedelta
+
+import arrow
+import click
+from faker import Faker
+from flask import current_app, url_for
+from flask.cli import AppGroup
+from sqlalchemy import func, text
+
+from app import db
+from app.auth.models import User
+from app.main.models import Laboratory, UserLabAffil
+from app.lab.models import (LabTest, LabTestProfile, LabServicePackage, LabCustomer, LabTestOrder, LabTestRecord,
+                            LabOrderRejectRecord, LabOrderPaymentRecord, LabActivity, test_profile_assoc,
+                            lab_test_package_assoc, lab_test_profile_package_assoc)
+from app.lab.rejections import REJECTION_GROUPS
+from app.lab.revisions import RecordVersion
+from app.lab.utils import encode_cursor
+from app.profiler import QueryRecorder
+
+bench_cli = AppGroup('bench', help='Synthetic data and endpoint benchmarks.')
+
+BENCH_EMAIL = 'bench@one-lims.local'
+
+REJECT_REASONS = ['สิ่งส่งตรวจไม่เหมาะสมกับการทดสอบ',
+                  'สิ่งส่งตรวจไม่เพียงพอ',
+                  'คุณภาพของสิ่งส่งตรวจไม่ดี',
+                  'ภาชนะรั่วหรือแตก',
+                  'ข้อมูลคนไข้ไม่ตรงกัน']
+
+
+def next_id(model):
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def reset_sequences(*models):
+    """Move the PostgreSQL id sequences past the explicitly inserted ids."""
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+    for model in models:
+        table = model.__tablename__
+        db.session.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                                f"COALESCE((SELECT MAX(id) FROM {table}), 1))"))
+
+
+def bulk_insert(model, mappings):
+    # bulk inserts skip the unit of work, so no Continuum versions are written for the synthetic data
+    if mappings:
+        db.session.bulk_insert_mappings(model, mappings)
+
+
+def get_bench_user():
+    user = User.query.filter_by(email=BENCH_EMAIL).first()
+    if not user:
+        user = User('Bench', 'User', BENCH_EMAIL, 'bench', 'BENCH')
+        db.session.add(user)
+        db.session.commit()
+    return user
+
+
+def seed_catalogue(lab, user, rng, num_tests):
+    now = arrow.now('Asia/Bangkok').datetime
+    tests = []
+    for i in range(num_tests):
+        low = rng.randint(1, 50)
+        tests.append(LabTest(name=f'Test {i + 1:03}', code=f'T{i + 1:03}', lab=lab, data_type='Numeric',
+                             min_value=0, max_value=low * 20, min_ref_value=low, max_ref_value=low * 4,
+                             price=rng.choice([80, 100, 150, 200, 350]), unit='mg/dL', added_at=now))
+    db.session.add_all(tests)
+    db.session.flush()
+    profiles = []
+    for i in range(max(1, num_tests // 10)):
+        profiles.append(LabTestProfile(name=f'Profile {i + 1:02}', code=f'P{i + 1:02}', lab=lab))
+    db.session.add_all(profiles)
+    packages = [LabServicePackage(name=f'Package {i + 1}', code=f'PK{i + 1}', lab=lab, creator_id=user.id,
+                                  price=rng.choice([500, 900, 1500]), created_at=now) for i in range(3)]
+    db.session.add_all(packages)
+    db.session.flush()
+    db.session.execute(test_profile_assoc.insert(),
+                       [{'test_id': t.id, 'profile_id': p.id}
+                        for p in profiles for t in rng.sample(tests, min(len(tests), rng.randint(3, 6)))])
+    db.session.execute(lab_test_package_assoc.insert(),
+                       [{'test_id': t.id, 'package_id': p.id} for p in packages for t in rng.sample(tests, 2)])
+    db.session.execute(lab_test_profile_package_assoc.insert(),
+                       [{'profile_id': rng.choice(profiles).id, 'package_id': p.id} for p in packages])
+    db.session.commit()
+    return tests
+
+
+def seed_customers(lab, rng, fake, count, batch_size):
+    # combining pools of names is much faster than asking Faker for every row
+    firstnames = [fake.first_name() for _ in range(500)]
+    lastnames = [fake.last_name() for _ in range(1000)]
+    start_id = next_id(LabCustomer)
+    today = arrow.now('Asia/Bangkok').date()
+    for offset in range(0, count, batch_size):
+        mappings = []
+        for n in range(offset, min(count, offset + batch_size)):
+            gender = rng.choice(['ชาย', 'หญิง'])
+            mappings.append({
+                'id': start_id + n,
+                'lab_id': lab.id,
+                'hn': f'B{lab.id:02}{n + 1:07}',
+                'title': 'นาย' if gender == 'ชาย' else rng.choice(['นาง', 'นางสาว']),
+                'firstname': rng.choice(firstnames),
+                'lastname': rng.choice(lastnames),
+                'gender': gender,
+                'dob': today - timedelta(days=rng.randint(365, 365 * 90)),
+                'tel': f'08{rng.randint(0, 99999999):08}',
+                'pid': f'{rng.randint(10 ** 12, 10 ** 13 - 1)}',
+            })
+        bulk_insert(LabCustomer, mappings)
+        db.session.commit()
+    return range(start_id, start_id + count)
+
+
+def seed_orders(lab, user, tests, customer_ids, rng, count, batch_size, days):
+    order_id = next_id(LabTestOrder)
+    record_id = next_id(LabTestRecord)
+    reject_id = next_id(LabOrderRejectRecord)
+    payment_id = next_id(LabOrderPaymentRecord)
+    activity_id = next_id(LabActivity)
+    now = arrow.now('Asia/Bangkok')
+    num_records = 0
+    for offset in range(0, count, batch_size):
+        orders, records, rejects, payments, activities = [], [], [], [], []
+        for n in range(offset, min(count, offset + batch_size)):
+            ordered_at = now.shift(minutes=-rng.randint(0, days * 24 * 60))
+            status = rng.random()
+            approved = status < 0.7
+            cancelled = 0.7 <= status < 0.75
+            orders.append({
+                'id': order_id,
+                'code': f'B{lab.id:02}{n + 1:08}',
+                'lab_id': lab.id,
+                'customer_id': rng.choice(customer_ids),
+                'ordered_at': ordered_at.datetime,
+                'ordered_by_id': user.id,
+                'approved_at': ordered_at.shift(hours=+3).datetime if approved else None,
+                'approver_id': user.id if approved else None,
+                'cancelled_at': ordered_at.shift(minutes=+30).datetime if cancelled else None,
+            })
+            for test in rng.sample(tests, rng.randint(1, min(8, len(tests)))):
+                record = {'id': record_id, 'order_id': order_id, 'test_id': test.id, 'cancelled': False}
+                if rng.random() < 0.03:
+                    rejects.append({'id': reject_id, 'created_at': ordered_at.shift(minutes=+15).datetime,
+                                    'creator_id': user.id, 'reason': rng.choice(REJECT_REASONS)})
+                    record['reject_record_id'] = reject_id
+                    reject_id += 1
+                elif approved or rng.random() < 0.5:
+                    record['received_at'] = ordered_at.shift(minutes=+rng.randint(5, 30)).datetime
+                    record['receiver_id'] = user.id
+                    if approved or rng.random() < 0.5:
+                        record['updated_at'] = ordered_at.shift(minutes=+rng.randint(40, 150)).datetime
+                        record['updater_id'] = user.id
+                        record['num_result'] = rng.randint(int(test.min_value or 0), int(test.max_value or 100))
+                records.append(record)
+                record_id += 1
+            if approved:
+                # the activity log is written by session events, which bulk inserts skip
+                activities.append({'id': activity_id, 'lab_id': lab.id, 'actor_id': user.id,
+                                   'message': 'Approved an order.', 'detail': str(order_id),
+                                   'added_at': ordered_at.shift(hours=+3).datetime})
+                activity_id += 1
+                payments.append({'id': payment_id, 'order_id': order_id, 'created_at': ordered_at.datetime,
+                                 'creator_id': user.id, 'payment_datetime': ordered_at.datetime,
+                                 'payment_amount': 500, 'payment_method': 'Cash'})
+                payment_id += 1
+            order_id += 1
+        bulk_insert(LabTestOrder, orders)
+        bulk_insert(LabOrderRejectRecord, rejects)
+        bulk_insert(LabTestRecord, records)
+        bulk_insert(LabOrderPaymentRecord, payments)
+        bulk_insert(LabActivity, activities)
+        db.session.commit()
+        num_records += len(records)
+        click.echo(f'  {offset + len(orders)}/{count} orders, {num_records} records')
+    return num_records
+
+
+@bench_cli.command('seed')
+@click.option('--labs', default=1, help='Number of labs.')
+@click.option('--tests', 'num_tests', default=50, help='Tests per lab.')
+@click.option('--customers', default=10000, help='Customers per lab.')
+@click.option('--orders', default=20000, help='Orders per lab, each has one to eight test records.')
+@click.option('--days', default=365, help='Spread the orders over this many days.')
+@click.option('--batch-size', default=5000)
+@click.option('--revisions', default=200, help='Orders per lab whose results are edited through the ORM.')
+@click.option('--seed', 'random_seed', default=0, help='Seed of the random generators.')
+def seed_command(labs, num_tests, customers, orders, days, batch_size, revisions, random_seed):
+    """Generate labs, tests, customers, orders and results with bulk inserts."""
+    rng = random.Random(random_seed)
+    fake = Faker(['th-TH'])
+    fake.seed_instance(random_seed)
+    user = get_bench_user()
+    for _ in range(labs):
+        lab = Laboratory(name=f'Bench Lab {fake.company()}', creator=user, address=fake.address(),
+                         tel=fake.phone_number(), created_at=arrow.now('Asia/Bangkok').datetime)
+        db.session.add(lab)
+        db.session.add(UserLabAffil(user=user, lab=lab, approved=True))
+        db.session.commit()
+        click.echo(f'Lab {lab.id}: {lab.name}')
+        tests = seed_catalogue(lab, user, rng, num_tests)
+        customer_ids = seed_customers(lab, rng, fake, customers, batch_size)
+        num_records = seed_orders(lab, user, tests, customer_ids, rng, orders, batch_size, days)
+        reset_sequences(LabCustomer, LabTestOrder, LabTestRecord, LabOrderRejectRecord, LabOrderPaymentRecord,
+                        LabActivity)
+        db.session.commit()
+        seed_revisions(lab, user, rng, revisions)
+        click.echo(f'Lab {lab.id}: {customers} customers, {orders} orders, {num_records} records')
+
+
+def seed_revisions(lab, user, rng, count, edits=3):
+    """Edit the results of some orders through the ORM, so Continuum writes their revisions."""
+    order_ids = [id_ for id_, in db.session.query(LabTestOrder.id).filter(LabTestOrder.lab_id == lab.id)
+                 .order_by(LabTestOrder.id)]
+    for n, order_id in enumerate(rng.sample(order_ids, min(count, len(order_ids))), start=1):
+        records = LabTestRecord.query.filter(LabTestRecord.order_id == order_id).all()
+        for _ in range(edits):
+            for rec in records:
+                rec.num_result = rng.randint(0, 100)
+                rec.updated_at = arrow.now('Asia/Bangkok').datetime
+                rec.updater_id = user.id
+            db.session.commit()
+        if n % 100 == 0:
+            click.echo(f'  {n}/{count} orders edited')
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+RECEIPT_BATCH_SIZE = 20
+
+
+def benchmark_requests(lab, repeat):
+    """Yield (name, method, url, cleanup, documents) for the endpoints under test.
+
+    documents is the number of PDFs a request renders, None for the others.
+    """
+    order_ids = [id_ for id_, in db.session.query(LabTestOrder.id).filter(LabTestOrder.lab_id == lab.id)
+                 .order_by(func.random()).limit(repeat)]
+    pending_ids = [id_ for id_, in db.session.query(LabTestOrder.id)
+                   .filter(LabTestOrder.lab_id == lab.id,
+                           LabTestOrder.approved_at == None,
+                           LabTestOrder.cancelled_at == None)
+                   .order_by(func.random()).limit(repeat)]
+    names = [name for name, in db.session.query(LabCustomer.firstname).filter(LabCustomer.lab_id == lab.id)
+             .order_by(func.random()).limit(repeat)]
+    # a different batch each time, so the receipts are rendered rather than read from the cache
+    paid_ids = [id_ for id_, in db.session.query(LabOrderPaymentRecord.order_id).join(LabTestOrder)
+                .filter(LabTestOrder.lab_id == lab.id, LabOrderPaymentRecord.expired_at == None)
+                .order_by(func.random()).limit(repeat * RECEIPT_BATCH_SIZE)]
+    last_week = arrow.now('Asia/Bangkok').shift(days=-7).format('YYYY-MM-DD')
+    last_month = arrow.now('Asia/Bangkok').shift(days=-30).format('YYYY-MM-DD')
+    groups = list(REJECTION_GROUPS)
+    revised_ids = [id_ for id_, in db.session.query(RecordVersion.order_id.distinct())
+                   .join(LabTestOrder, RecordVersion.order_id == LabTestOrder.id)
+                   .filter(LabTestOrder.lab_id == lab.id).limit(repeat)]
+    # pages of the activity log deep into its history
+    activity_cursors = [encode_cursor(added_at, id_) for added_at, id_ in
+                        db.session.query(LabActivity.added_at, LabActivity.id)
+                        .filter(LabActivity.lab_id == lab.id, LabActivity.added_at.isnot(None))
+                        .order_by(func.random()).limit(repeat)]
+    for i in range(repeat):
+        yield 'order_list', 'GET', url_for('lab.get_test_orders', lab_id=lab.id), None, None
+        yield 'pending_list', 'GET', url_for('lab.get_pending_records', lab_id=lab.id), None, None
+        yield 'customer_directory', 'GET', url_for('lab.get_customers', lab_id=lab.id, sort='pending'), None, None
+        if order_ids:
+            yield 'order_detail', 'GET', url_for('lab.show_customer_test_records',
+                                                 order_id=order_ids[i % len(order_ids)]), None, None
+        if names:
+            yield 'customer_search', 'GET', url_for('lab.search_customers', lab_id=lab.id,
+                                                    query=names[i % len(names)][:3]), None, None
+        yield 'results_export', 'GET', url_for('lab.export_data', lab_id=lab.id, table='results',
+                                               format='csv', start=last_week), None, None
+        if pending_ids:
+            # approve a pending order, then toggle the approval back with PATCH
+            url = url_for('lab.approve_test_order', order_id=pending_ids[i % len(pending_ids)])
+            yield 'approve', 'GET', url, ('PATCH', url), None
+        # the reports approved on one of the last days, rendered in the report pool when there are enough
+        day = arrow.now('Asia/Bangkok').shift(days=-(i + 1)).floor('day')
+        approved = LabTestOrder.query.filter(LabTestOrder.lab_id == lab.id,
+                                             LabTestOrder.approved_at >= day.datetime,
+                                             LabTestOrder.approved_at < day.shift(days=+1).datetime,
+                                             LabTestOrder.cancelled_at == None).count()
+        if approved:
+            day_arg = day.format('YYYY-MM-DD')
+            yield 'reports_batch', 'GET', url_for('lab.export_reports_pdf', lab_id=lab.id,
+                                                  start=day_arg, end=day_arg), None, approved
+        yield 'rejections', 'GET', url_for('lab.get_rejections', lab_id=lab.id, start=last_month,
+                                           group=groups[i % len(groups)]), None, None
+        yield 'activities', 'GET', url_for('lab.get_activities', lab_id=lab.id), None, None
+        if activity_cursors:
+            yield 'activities_page', 'GET', url_for('lab.get_activities', lab_id=lab.id,
+                                                    cursor=activity_cursors[i % len(activity_cursors)]), None, None
+        if revised_ids:
+            yield 'order_revisions', 'GET', url_for('lab.get_order_revisions',
+                                                    order_id=revised_ids[i % len(revised_ids)]), None, None
+        batch = paid_ids[i * RECEIPT_BATCH_SIZE:(i + 1) * RECEIPT_BATCH_SIZE]
+        if batch:
+            yield 'receipts_batch', 'GET', url_for('lab.export_receipts_pdf', lab_id=lab.id,
+                                                   order_ids=batch), None, len(batch)
+
+
+@bench_cli.command('run')
+@click.option('--lab-id', type=int, help='Lab to benchmark, defaults to the last seeded lab.')
+@click.option('--repeat', default=20, help='Requests per endpoint.')
+@click.option('--output', default='bench.json', help='JSON file for the results.')
+@click.option('--compare', type=click.Path(exists=True), help='Earlier results to compare with.')
+def run_command(lab_id, repeat, output, compare):
+    """Time the main views through the test client and report p50/p95 latency and query counts."""
+    user = get_bench_user()
+    lab = Laboratory.query.get(lab_id) if lab_id else \
+        Laboratory.query.join(UserLabAffil).filter(UserLabAffil.user_id == user.id) \
+        .order_by(Laboratory.id.desc()).first()
+    if not lab:
+        raise click.ClickException('No lab to benchmark, run "flask bench seed" first.')
+    current_app.config['WTF_CSRF_ENABLED'] = False
+    client = current_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+        session['lab_id'] = lab.id
+    timings = {}
+    with current_app.test_request_context():
+        requests = list(benchmark_requests(lab, repeat))
+    db.session.remove()
+    for name, method, url, cleanup, documents in requests:
+        with QueryRecorder() as recorder:
+            started_at = time.perf_counter()
+            response = client.open(url, method=method)
+            response.get_data()
+            elapsed = (time.perf_counter() - started_at) * 1000
+        if response.status_code >= 400:
+            raise click.ClickException(f'{method} {url} returned {response.status_code}')
+        if cleanup:
+            client.open(cleanup[1], method=cleanup[0])
+        timings.setdefault(name, []).append((elapsed, recorder.count, documents))
+    results = {}
+    for name, items in timings.items():
+        latencies = [ms for ms, _, _ in items]
+        queries = [count for _, count, _ in items]
+        results[name] = {
+            'requests': len(items),
+            'p50_ms': round(percentile(latencies, 0.5), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'mean_queries': round(sum(queries) / len(queries), 2),
+            'max_queries': max(queries),
+        }
+        documents = sum(count or 0 for _, _, count in items)
+        if documents:
+            results[name]['documents_per_second'] = round(documents / (sum(latencies) / 1000), 2)
+    report = {
+        'created_at': arrow.now('Asia/Bangkok').isoformat(),
+        'lab_id': lab.id,
+        'dialect': db.session.get_bind().dialect.name,
+        'customers': LabCustomer.query.filter_by(lab_id=lab.id).count(),
+        'orders': LabTestOrder.query.filter_by(lab_id=lab.id).count(),
+        'endpoints': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    previous = {}
+    if compare:
+        with open(compare) as f:
+            previous = json.load(f).get('endpoints', {})
+    click.echo(f'{"endpoint":<20}{"p50 ms":>10}{"p95 ms":>10}{"queries":>10}{"p95 change":>12}{"docs/s":>10}')
+    for name, item in results.items():
+        change = ''
+        if name in previous and previous[name]['p95_ms']:
+            change = f'{(item["p95_ms"] / previous[name]["p95_ms"] - 1) * 100:+.0f}%'
+        click.echo(f'{name:<20}{item["p50_ms"]:>10}{item["p95_ms"]:>10}{item["max_queries"]:>10}{change:>12}'
+                   f'{item.get("documents_per_second", ""):>10}')
+    click.echo(f'Results were written to {output}')
@@ -0,0 +1,195 @@
+import atexit
+import os
+import threading
+from collections import namedtuple
+
+import arrow
+import sqlalchemy as sa
+from flask import has_request_context
+from flask_login import current_user
+from sqlalchemy import event, tuple_
+from sqlalchemy.orm import Session, joinedload
+
+from app import db
+from .models import LabActivity, LabTestRecord, LabTestOrder, LabOrderPaymentRecord
+
+Activity = namedtuple('Activity', 'model attribute message when lab')
+
+
+def became_set(obj, old, new):
+    return old is None and new is not None
+
+
+def changed(obj, old, new):
+    return old is not None and new is not None
+
+
+def became_unset(obj, old, new):
+    return old is not None and new is None
+
+
+def record_cancelled(obj, old, new):
+    # rejections and cancelled orders are logged by their own rules
+    return new is True and old is not True and obj.reject_record is None \
+        and not (obj.order and obj.order.cancelled_at)
+
+
+def record_lab(session, obj):
+    order = obj.order or (session.get(LabTestOrder, obj.order_id) if obj.order_id else None)
+    return order.lab_id if order else None
+
+
+def order_lab(session, obj):
+    return obj.lab_id
+
+
+# What is logged when an attribute changes, the detail is the id of the object
+# or the order of a payment.
+ACTIVITIES = [
+    Activity(LabTestRecord, 'received_at', 'Received the test.', became_set, record_lab),
+    Activity(LabTestRecord, 'reject_record', 'Rejected and cancelled the test order.', became_set, record_lab),
+    Activity(LabTestRecord, 'cancelled', 'Cancelled the test order.', record_cancelled, record_lab),
+    Activity(LabTestRecord, 'updated_at', 'Added the result for a test record.', became_set, record_lab),
+    Activity(LabTestRecord, 'updated_at', 'Updated the result for a test record.', changed, record_lab),
+    Activity(LabTestOrder, 'approved_at', 'Approved an order.', became_set, order_lab),
+    Activity(LabTestOrder, 'approved_at', 'Cancelled the approval for an order.', became_unset, order_lab),
+    Activity(LabTestOrder, 'cancelled_at', 'Cancelled an order.', became_set, order_lab),
+    Activity(LabOrderPaymentRecord, 'payment_datetime', 'Added a payment.', became_set, record_lab),
+    Activity(LabOrderPaymentRecord, 'payment_datetime', 'Updated a payment.', changed, record_lab),
+]
+
+
+def detail_of(obj):
+    return obj.order_id if isinstance(obj, LabOrderPaymentRecord) else obj.id
+
+
+class ActivityLog:
+    """Buffers the activities in memory and inserts them in batches from a background thread.
+
+    A batch is written when ACTIVITY_BATCH_SIZE activities are waiting or
+    ACTIVITY_FLUSH_MS after the last write, and what is left is written when
+    the process exits. With ACTIVITY_FLUSH_MS of 0 the activities are written
+    as they are added.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.rows = []
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ACTIVITY_BATCH_SIZE', 100)
+        app.config.setdefault('ACTIVITY_FLUSH_MS', 1000)
+        self.app = app
+        atexit.register(self.flush)
+
+    @property
+    def batch_size(self):
+        return self.app.config['ACTIVITY_BATCH_SIZE']
+
+    @property
+    def interval(self):
+        return self.app.config['ACTIVITY_FLUSH_MS'] / 1000
+
+    def add(self, rows):
+        if not self.app or not rows:
+            return
+        if not self.interval:
+            self.write(rows)
+            return
+        with self.condition:
+            self.rows.extend(rows)
+            self.start()
+            if len(self.rows) >= self.batch_size:
+                self.condition.notify()
+
+    def start(self):
+        # a worker forked from the master does not inherit its thread
+        if self.thread is None or self.pid != os.getpid() or not self.thread.is_alive():
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name='activity-log', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.rows) >= self.batch_size, timeout=self.interval)
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.condition:
+                rows, self.rows = self.rows, []
+            if rows:
+                self.write(rows)
+
+    def write(self, rows):
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as connection:
+                    connection.execute(LabActivity.__table__.insert(), rows)
+        except Exception:
+            self.app.logger.exception('Could not write %d activities', len(rows))
+            with self.condition:
+                # keep them for the next batch unless the database stays down
+                if len(self.rows) < self.batch_size * 10:
+                    self.rows[:0] = rows
+
+
+activity_log = ActivityLog()
+
+
+@event.listens_for(Session, 'before_flush')
+def collect_activities(session, flush_context, instances):
+    actor_id = current_user.id if has_request_context() and current_user.is_authenticated else None
+    now = arrow.now('Asia/Bangkok').datetime
+    pending = session.info.setdefault('pending_activities', [])
+    for obj in list(session.new) + list(session.dirty):
+        new = obj in session.new
+        for activity in ACTIVITIES:
+            if not isinstance(obj, activity.model):
+                continue
+            history = sa.inspect(obj).attrs[activity.attribute].history
+            if not new and not history.has_changes():
+                continue
+            old = None if new or not history.deleted else history.deleted[0]
+            if activity.when(obj, old, getattr(obj, activity.attribute)):
+                pending.append((activity, obj, actor_id, now))
+
+
+@event.listens_for(Session, 'after_flush')
+def resolve_activities(session, flush_context):
+    pending = session.info.pop('pending_activities', None)
+    if not pending:
+        return
+    rows = session.info.setdefault('activities', [])
+    for activity, obj, actor_id, added_at in pending:
+        lab_id = activity.lab(session, obj)
+        if lab_id:
+            rows.append({'lab_id': lab_id, 'actor_id': actor_id, 'message': activity.message,
+                         'detail': str(detail_of(obj)), 'added_at': added_at})
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_activities(session):
+    activity_log.add(session.info.pop('activities', None))
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_activities(session):
+    session.info.pop('pending_activities', None)
+    session.info.pop('activities', None)
+
+
+def query_activities(lab_id, cursor=None, limit=50):
+    """Return the activities of a lab before the (added_at, id) cursor, the latest first."""
+    query = LabActivity.query.filter(LabActivity.lab_id == lab_id, LabActivity.added_at.isnot(None)) \
+        .options(joinedload(LabActivity.actor))
+    if cursor:
+        query = query.filter(tuple_(LabActivity.added_at, LabActivity.id) < cursor)
+    return query.order_by(LabActivity.added_at.desc(), LabActivity.id.desc()).limit(limit).all()
@@ -0,0 +1,292 @@
+import codecs
+import os
+import re
+import shutil
+import time
+from collections import namedtuple
+from itertools import chain
+
+import arrow
+import click
+from flask.cli import AppGroup
+
+from app import db
+from app.auth.models import User
+from .labels import parse_specimen_code
+from .results import apply_results
+
+AnalyzerResult = namedtuple('AnalyzerResult', ['specimen', 'test_code', 'value', 'unit', 'flags', 'observed_at'])
+
+BATCH_SIZE = 500
+
+# keep at most this many error rows in a summary
+MAX_REPORTED_ERRORS = 1000
+
+# ASTM frames are <STX><frame number>text<ETB or ETX><checksum>
+ASTM_FRAME = re.compile(r'^\x02[0-7]?(.*?)(?:([\x17\x03])[0-9A-Fa-f]{2})?$')
+
+# result status of records that carry no usable value
+SKIPPED_STATUSES = {'X', 'D', 'W', 'I'}
+
+
+def iter_lines(stream, chunk_size=64 * 1024):
+    """Yield the CR or LF separated lines of a binary stream, one chunk in memory at a time."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        pending += decoder.decode(chunk)
+        lines = re.split(r'[\r\n]+', pending)
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    pending += decoder.decode(b'', final=True)
+    if pending.strip():
+        yield pending
+
+
+def parse_timestamp(value):
+    """Analyzer timestamps are local YYYYMMDD[HHMM[SS]] strings."""
+    digits = re.sub(r'\D', '', value or '')[:14]
+    formats = {14: 'YYYYMMDDHHmmss', 12: 'YYYYMMDDHHmm', 8: 'YYYYMMDD'}
+    if len(digits) not in formats:
+        return None
+    try:
+        return arrow.get(digits, formats[len(digits)], tzinfo='Asia/Bangkok').datetime
+    except (arrow.parser.ParserError, ValueError):
+        return None
+
+
+def parse_astm(lines):
+    """Yield the results of ASTM E1394 records.
+
+    The delimiters are read from the header record. Records split over several
+    frames are joined again.
+    """
+    field, repeat, component = '|', '\\', '^'
+    specimen = None
+    header_time = None
+    buffer = ''
+    for line in lines:
+        match = ASTM_FRAME.match(line)
+        if line.startswith('\x02') and match:
+            buffer += match.group(1)
+            if match.group(2) == '\x17':
+                # intermediate frame, the record continues in the next one
+                continue
+            line, buffer = buffer, ''
+        line = line.lstrip('\x05\x04\x06')
+        if not line:
+            continue
+        record_type = line[0]
+        if record_type == 'H' and len(line) > 4:
+            field, repeat, component = line[1], line[2], line[3]
+            fields = line.split(field)
+            header_time = parse_timestamp(fields[13]) if len(fields) > 13 else None
+            specimen = None
+            continue
+        fields = line.split(field)
+        if record_type == 'O':
+            specimen_field = fields[2] if len(fields) > 2 and fields[2] else (fields[3] if len(fields) > 3 else '')
+            specimen = specimen_field.split(repeat)[0].split(component)[0].strip()
+        elif record_type == 'R' and specimen and len(fields) > 3:
+            codes = [c for c in fields[2].split(component) if c]
+            status = fields[8] if len(fields) > 8 else ''
+            if not codes or status in SKIPPED_STATUSES:
+                continue
+            test_code = fields[2].split(component)[3] if len(fields[2].split(component)) > 3 else codes[-1]
+            yield AnalyzerResult(specimen=specimen,
+                                 test_code=test_code.strip(),
+                                 value=fields[3].split(component)[0].strip(),
+                                 unit=fields[4] if len(fields) > 4 else '',
+                                 flags=fields[6] if len(fields) > 6 else '',
+                                 observed_at=(parse_timestamp(fields[12]) if len(fields) > 12 else None) or header_time)
+        elif record_type == 'L':
+            specimen = None
+
+
+def parse_hl7(lines):
+    """Yield the results of HL7 v2 ORU messages.
+
+    The OBX segments of an observation request are held until the next OBR or
+    MSH, because the specimen of a v2.5 message comes in an SPM segment after
+    them.
+    """
+    field, component = '|', '^'
+    group = []
+    specimen = None
+    request_time = None
+
+    def flush():
+        for obx in group:
+            if specimen:
+                yield obx._replace(specimen=specimen)
+
+    for line in lines:
+        segment = line[:3]
+        if segment == 'MSH':
+            yield from flush()
+            group, specimen = [], None
+            field, component = line[3], line[4]
+            fields = line.split(field)
+            # MSH-1 is the separator itself, so MSH-7 is at index 6
+            request_time = parse_timestamp(fields[6]) if len(fields) > 6 else None
+            continue
+        fields = line.split(field)
+        if segment == 'OBR':
+            yield from flush()
+            group = []
+            filler = fields[3] if len(fields) > 3 else ''
+            placer = fields[2] if len(fields) > 2 else ''
+            specimen = (filler or placer).split(component)[0].strip() or None
+            if len(fields) > 7 and fields[7]:
+                request_time = parse_timestamp(fields[7]) or request_time
+        elif segment == 'SPM' and len(fields) > 2 and fields[2]:
+            specimen = fields[2].split(component)[0].strip() or specimen
+        elif segment == 'OBX' and len(fields) > 5:
+            status = fields[11] if len(fields) > 11 else ''
+            if status in SKIPPED_STATUSES or not fields[3]:
+                continue
+            group.append(AnalyzerResult(specimen=None,
+                                        test_code=fields[3].split(component)[0].strip(),
+                                        value=fields[5].split(component)[0].strip(),
+                                        unit=fields[6].split(component)[0] if len(fields) > 6 else '',
+                                        flags=fields[8] if len(fields) > 8 else '',
+                                        observed_at=(parse_timestamp(fields[14]) if len(fields) > 14 else None)
+                                        or request_time))
+    yield from flush()
+
+
+def parse_stream(stream):
+    """Detect the format from the first line and yield the results of the stream."""
+    lines = iter_lines(stream)
+    first = next(lines, None)
+    if first is None:
+        return
+    lines = chain([first], lines)
+    if first.startswith('MSH'):
+        yield from parse_hl7(lines)
+    else:
+        yield from parse_astm(lines)
+
+
+def to_row(result):
+    """Map an analyzer result to a result row, the specimen barcode gives the order code."""
+    code = parse_specimen_code(result.specimen)
+    return {
+        'order_code': code.order_code if code else result.specimen,
+        'test_code': result.test_code,
+        'result': result.value,
+        'observed_at': result.observed_at.isoformat() if result.observed_at else None,
+    }
+
+
+def apply_batch(lab_id, batch, user, summary):
+    # only the latest observation of a test of an order in the batch is applied
+    latest = {}
+    for index, row in batch:
+        key = (row['order_code'], row['test_code'])
+        if key not in latest or (row['observed_at'] or '') >= (latest[key][1]['observed_at'] or ''):
+            if key in latest:
+                summary['skipped'] += 1
+            latest[key] = (index, row)
+        else:
+            summary['skipped'] += 1
+    items = list(latest.values())
+    result = apply_results(lab_id, [row for _, row in items], user)
+    summary['updated'] += result['updated']
+    summary['skipped'] += result['skipped']
+    for error in result['errors']:
+        summary['error_count'] += 1
+        if len(summary['errors']) < MAX_REPORTED_ERRORS:
+            summary['errors'].append({'result': items[error['row']][0], 'error': error['error']})
+
+
+def import_stream(lab_id, stream, user=None, batch_size=BATCH_SIZE):
+    """Parse an analyzer file and apply its results in batches.
+
+    Results are numbered from 0 in the order they appear, errors refer to them.
+    Repeated or late results are skipped, see apply_results().
+    """
+    summary = {'results': 0, 'updated': 0, 'skipped': 0, 'error_count': 0, 'errors': []}
+    batch = []
+    for result in parse_stream(stream):
+        batch.append((summary['results'], to_row(result)))
+        summary['results'] += 1
+        if len(batch) >= batch_size:
+            apply_batch(lab_id, batch, user, summary)
+            batch = []
+    if batch:
+        apply_batch(lab_id, batch, user, summary)
+    return summary
+
+
+analyzer_cli = AppGroup('analyzers', help='Analyzer result files.')
+
+
+def get_user(email):
+    if not email:
+        return None
+    user = User.query.filter_by(email=email).first()
+    if not user:
+        raise click.ClickException(f'No user with the email {email}.')
+    return user
+
+
+def import_file(lab_id, path, user, batch_size):
+    with open(path, 'rb') as f:
+        summary = import_stream(lab_id, f, user=user, batch_size=batch_size)
+    click.echo(f'{os.path.basename(path)}: {summary["results"]} results, {summary["updated"]} updated, '
+               f'{summary["skipped"]} skipped, {summary["error_count"]} errors')
+    for error in summary['errors'][:20]:
+        click.echo(f'  result {error["result"]}: {error["error"]}')
+    return summary
+
+
+@analyzer_cli.command('import')
+@click.argument('paths', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--lab-id', type=int, required=True)
+@click.option('--email', help='The user the results are reported by.')
+@click.option('--batch-size', default=BATCH_SIZE)
+def import_command(paths, lab_id, email, batch_size):
+    """Import ASTM or HL7 result files."""
+    user = get_user(email)
+    for path in paths:
+        import_file(lab_id, path, user, batch_size)
+
+
+@analyzer_cli.command('watch')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--lab-id', type=int, required=True)
+@click.option('--email', help='The user the results are reported by.')
+@click.option('--interval', default=5.0, help='Seconds between scans of the directory.')
+@click.option('--batch-size', default=BATCH_SIZE)
+@click.option('--once', is_flag=True, help='Exit after one scan.')
+def watch_command(directory, lab_id, email, interval, batch_size, once):
+    """Import the files dropped into a directory and move them to processed/ or failed/."""
+    user = get_user(email)
+    processed = os.path.join(directory, 'processed')
+    failed = os.path.join(directory, 'failed')
+    os.makedirs(processed, exist_ok=True)
+    os.makedirs(failed, exist_ok=True)
+    while True:
+        entries = sorted((e for e in os.scandir(directory) if e.is_file() and not e.name.startswith('.')),
+                         key=lambda e: e.stat().st_mtime)
+        for entry in entries:
+            # leave files that may still be written
+            if time.time() - entry.stat().st_mtime < 2:
+                continue
+            try:
+                import_file(lab_id, entry.path, user, batch_size)
+            except Exception as e:
+                db.session.rollback()
+                click.echo(f'{entry.name}: {e}', err=True)
+                shutil.move(entry.path, os.path.join(failed, entry.name))
+            else:
+                shutil.move(entry.path, os.path.join(processed, entry.name))
+        if once:
+            break
+        time.sleep(interval)
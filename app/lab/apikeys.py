@@ -0,0 +1,90 @@
+import hashlib
+import secrets
+from functools import wraps
+
+import arrow
+import click
+from flask import request, jsonify
+from flask.cli import AppGroup
+from flask_login import current_user
+
+from app import db, csrf_protect
+from app.auth.models import User
+from .models import LabApiKey
+
+
+def hash_key(key):
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def bearer_key():
+    scheme, _, key = request.headers.get('Authorization', '').partition(' ')
+    return key.strip() if scheme.lower() == 'bearer' and key.strip() else None
+
+
+def api_auth_required(view):
+    """Authenticate an API view of a lab by an API key or by the session.
+
+    Scripts and LIS clients send ``Authorization: Bearer <key>`` with a key of
+    the lab made by ``flask apikeys create``, no CSRF token is needed. Requests
+    with the session cookie of a logged-in user must send the CSRF token in
+    the X-CSRFToken header or a csrf_token field, like the forms do. The view
+    gets the user the request acts as in ``user``.
+    """
+    @wraps(view)
+    def wrapper(lab_id, *args, **kwargs):
+        key = bearer_key()
+        if key:
+            api_key = LabApiKey.query.filter_by(key_hash=hash_key(key), revoked_at=None).first()
+            if not api_key or api_key.lab_id != lab_id or not api_key.user.is_active:
+                return jsonify({"success": False, "error": "Invalid API key."}), 401
+            # saved on its own, the view may not commit, e.g. when it rejects the payload
+            with db.engine.begin() as conn:
+                conn.execute(LabApiKey.__table__.update()
+                             .where(LabApiKey.__table__.c.id == api_key.id)
+                             .values(last_used_at=arrow.now('Asia/Bangkok').datetime))
+            return view(lab_id, *args, user=api_key.user, **kwargs)
+        if not current_user.is_authenticated:
+            return jsonify({"success": False, "error": "Log in or send an API key."}), 401
+        csrf_protect.protect()
+        return view(lab_id, *args, user=current_user._get_current_object(), **kwargs)
+
+    # the token is checked above for session requests only
+    return csrf_protect.exempt(wrapper)
+
+
+apikey_cli = AppGroup('apikeys', help='API keys of the result APIs.')
+
+
+@apikey_cli.command('create')
+@click.option('--lab-id', type=int, required=True)
+@click.option('--email', required=True, help='The user the key acts as.')
+@click.option('--name', required=True, help='What uses the key, e.g. the analyzer bridge.')
+def create_command(lab_id, email, name):
+    """Create a key and print it, it cannot be shown again."""
+    user = User.query.filter_by(email=email).first()
+    if not user:
+        raise click.ClickException(f'No user with the email {email}.')
+    key = secrets.token_urlsafe(32)
+    db.session.add(LabApiKey(lab_id=lab_id, user=user, name=name, key_hash=hash_key(key),
+                             created_at=arrow.now('Asia/Bangkok').datetime))
+    db.session.commit()
+    click.echo(key)
+
+
+@apikey_cli.command('list')
+@click.option('--lab-id', type=int, required=True)
+def list_command(lab_id):
+    for api_key in LabApiKey.query.filter_by(lab_id=lab_id).order_by(LabApiKey.id):
+        status = f'revoked {api_key.revoked_at:%Y-%m-%d}' if api_key.revoked_at else 'active'
+        click.echo(f'{api_key.id}\t{api_key.name}\t{api_key.user.email}\t{status}')
+
+
+@apikey_cli.command('revoke')
+@click.argument('key_id', type=int)
+def revoke_command(key_id):
+    api_key = db.session.get(LabApiKey, key_id)
+    if not api_key:
+        raise click.ClickException(f'No API key {key_id}.')
+    api_key.revoked_at = arrow.now('Asia/Bangkok').datetime
+    db.session.commit()
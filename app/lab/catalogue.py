@@ -0,0 +1,230 @@
+import threading
+import time
+from collections import namedtuple, defaultdict
+from types import MappingProxyType
+
+from flask import current_app
+from sqlalchemy import event, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from app import db
+from .models import LabTest, LabTestProfile, LabServicePackage, LabResultChoiceSet, LabResultChoiceItem, \
+    LabCatalogueVersion, test_profile_assoc, lab_test_package_assoc, lab_test_profile_package_assoc
+
+
+# The snapshots are tuples, so they can be shared by the threads of a worker
+# without copying and cannot be changed by a view by mistake.
+
+class CatalogueTest(namedtuple('CatalogueTest', ['id', 'lab_id', 'code', 'name', 'detail', 'data_type', 'unit',
+                                                 'price', 'min_value', 'max_value', 'min_ref_value',
+                                                 'max_ref_value', 'choice_set_id', 'choice_set', 'tat_minutes',
+                                                 'active', 'added_at'])):
+    __slots__ = ()
+
+    def __str__(self):
+        return f'{self.name} ({self.code})'
+
+    reference_values = LabTest.reference_values
+
+
+class CatalogueProfile(namedtuple('CatalogueProfile', ['id', 'lab_id', 'code', 'name', 'test_order', 'price',
+                                                       'test_ids', 'tests_list'])):
+    __slots__ = ()
+
+    def __str__(self):
+        return self.name
+
+
+class CataloguePackage(namedtuple('CataloguePackage', ['id', 'lab_id', 'code', 'name', 'price', 'test_ids',
+                                                       'profile_ids'])):
+    __slots__ = ()
+
+    def __str__(self):
+        return self.name
+
+
+class CatalogueChoiceItem(namedtuple('CatalogueChoiceItem', ['id', 'choice_set_id', 'result', 'interpretation',
+                                                             'ref'])):
+    __slots__ = ()
+
+    def __str__(self):
+        return self.result
+
+
+class Catalogue(namedtuple('Catalogue', ['lab_id', 'version', 'tests', 'profiles', 'packages', 'choice_items'])):
+    """The tests, profiles, packages and choice items of a lab by id, in the order they were added."""
+    __slots__ = ()
+
+    def profile_tests(self, profile):
+        """The tests in the test order of the profile by code."""
+        codes = {code.strip() for code in (profile.test_order or '').split(',') if code.strip()}
+        return {test.code: test for test in self.tests.values() if test.code in codes}
+
+    def choices(self, choice_set_id):
+        return self.choice_items.get(choice_set_id, ())
+
+    def missing(self, tests=(), profiles=(), packages=()):
+        """The ids that are not in the catalogue, by kind, empty when all are."""
+        missing = {'tests': [i for i in tests if i not in self.tests],
+                   'profiles': [i for i in profiles if i not in self.profiles],
+                   'packages': [i for i in packages if i not in self.packages]}
+        return {kind: ids for kind, ids in missing.items() if ids}
+
+
+def load_catalogue(lab_id, version):
+    """Load the catalogue of a lab in a fixed number of queries."""
+    choice_sets = dict(db.session.query(LabResultChoiceSet.id, LabResultChoiceSet.name)
+                       .filter(LabResultChoiceSet.lab_id == lab_id))
+    tests = {}
+    for t in LabTest.query.filter(LabTest.lab_id == lab_id).order_by(LabTest.id):
+        tests[t.id] = CatalogueTest(t.id, t.lab_id, t.code, t.name, t.detail, t.data_type, t.unit, t.price,
+                                    t.min_value, t.max_value, t.min_ref_value, t.max_ref_value, t.choice_set_id,
+                                    choice_sets.get(t.choice_set_id), t.tat_minutes, t.active, t.added_at)
+
+    profile_tests = defaultdict(list)
+    for profile_id, test_id in db.session.execute(
+            select(test_profile_assoc.c.profile_id, test_profile_assoc.c.test_id)
+            .join(LabTestProfile, test_profile_assoc.c.profile_id == LabTestProfile.id)
+            .where(LabTestProfile.lab_id == lab_id)
+            .order_by(test_profile_assoc.c.test_id)):
+        if test_id in tests:
+            profile_tests[profile_id].append(test_id)
+    profiles = {}
+    for p in LabTestProfile.query.filter(LabTestProfile.lab_id == lab_id).order_by(LabTestProfile.id):
+        test_ids = tuple(profile_tests[p.id])
+        # the price is the sum of its tests unless the profile has its own
+        price = p.profile_price or sum(tests[i].price or 0 for i in test_ids)
+        profiles[p.id] = CatalogueProfile(p.id, p.lab_id, p.code, p.name, p.test_order, price, test_ids,
+                                          ','.join(tests[i].code or '' for i in test_ids))
+
+    package_tests = defaultdict(list)
+    for package_id, test_id in db.session.execute(
+            select(lab_test_package_assoc.c.package_id, lab_test_package_assoc.c.test_id)
+            .join(LabServicePackage, lab_test_package_assoc.c.package_id == LabServicePackage.id)
+            .where(LabServicePackage.lab_id == lab_id)
+            .order_by(lab_test_package_assoc.c.test_id)):
+        if test_id in tests:
+            package_tests[package_id].append(test_id)
+    package_profiles = defaultdict(list)
+    for package_id, profile_id in db.session.execute(
+            select(lab_test_profile_package_assoc.c.package_id, lab_test_profile_package_assoc.c.profile_id)
+            .join(LabServicePackage, lab_test_profile_package_assoc.c.package_id == LabServicePackage.id)
+            .where(LabServicePackage.lab_id == lab_id)
+            .order_by(lab_test_profile_package_assoc.c.profile_id)):
+        if profile_id in profiles:
+            package_profiles[package_id].append(profile_id)
+    packages = {}
+    for p in LabServicePackage.query.filter(LabServicePackage.lab_id == lab_id).order_by(LabServicePackage.id):
+        packages[p.id] = CataloguePackage(p.id, p.lab_id, p.code, p.name, p.price,
+                                          tuple(package_tests[p.id]), tuple(package_profiles[p.id]))
+
+    choice_items = defaultdict(list)
+    if choice_sets:
+        for item in LabResultChoiceItem.query.filter(LabResultChoiceItem.choice_set_id.in_(choice_sets)) \
+                .order_by(LabResultChoiceItem.id):
+            choice_items[item.choice_set_id].append(
+                CatalogueChoiceItem(item.id, item.choice_set_id, item.result, item.interpretation, item.ref))
+
+    return Catalogue(lab_id, version, MappingProxyType(tests), MappingProxyType(profiles),
+                     MappingProxyType(packages), MappingProxyType({k: tuple(v) for k, v in choice_items.items()}))
+
+
+# The catalogues are shared by the requests of a worker. A change bumps the
+# version of the lab in lab_catalogue_versions in the same transaction, and
+# drops the catalogue of this worker on commit. Other workers compare their
+# version with the table at most every CATALOGUE_CHECK_SECONDS.
+_catalogues = {}
+_checked_at = {}
+_catalogues_lock = threading.Lock()
+
+
+def current_version(lab_id):
+    return db.session.query(LabCatalogueVersion.version).filter_by(lab_id=lab_id).scalar() or 0
+
+
+def catalogue(lab_id, check=False):
+    """Return the catalogue of a lab, without a query while it is fresh.
+
+    With check the version is compared with the table whenever it was last checked.
+    """
+    cached = _catalogues.get(lab_id)
+    now = time.monotonic()
+    if cached is not None and not check \
+            and now - _checked_at.get(lab_id, 0) < current_app.config['CATALOGUE_CHECK_SECONDS']:
+        return cached
+    version = current_version(lab_id)
+    if cached is None or cached.version != version:
+        cached = load_catalogue(lab_id, version)
+        with _catalogues_lock:
+            _catalogues[lab_id] = cached
+    _checked_at[lab_id] = now
+    return cached
+
+
+def catalogue_with(lab_id, tests=(), profiles=(), packages=()):
+    """Return the catalogue of a lab, checked against the version table when it misses one of the ids.
+
+    Another worker may have added them since this one last checked, the
+    caller still has to handle the ids that are missing after the check.
+    """
+    lab_catalogue = catalogue(lab_id)
+    if lab_catalogue.missing(tests, profiles, packages):
+        lab_catalogue = catalogue(lab_id, check=True)
+    return lab_catalogue
+
+
+def invalidate_catalogues(lab_ids=None):
+    with _catalogues_lock:
+        for lab_id in (list(_catalogues) if lab_ids is None else lab_ids):
+            _catalogues.pop(lab_id, None)
+            _checked_at.pop(lab_id, None)
+
+
+CATALOGUE_MODELS = (LabTest, LabTestProfile, LabServicePackage, LabResultChoiceSet, LabResultChoiceItem)
+
+
+def lab_of(session, obj):
+    if isinstance(obj, LabResultChoiceItem):
+        choice_set = obj.choice_set or (session.get(LabResultChoiceSet, obj.choice_set_id)
+                                        if obj.choice_set_id else None)
+        return lab_of(session, choice_set) if choice_set else None
+    if obj.lab_id is not None:
+        return obj.lab_id
+    return obj.lab.id if obj.lab else None
+
+
+@event.listens_for(Session, 'before_flush')
+def collect_changed_labs(session, flush_context, instances):
+    changed = [obj for obj in list(session.new) + list(session.deleted) if isinstance(obj, CATALOGUE_MODELS)]
+    changed += [obj for obj in session.dirty if isinstance(obj, CATALOGUE_MODELS) and session.is_modified(obj)]
+    lab_ids = {lab_of(session, obj) for obj in changed} - {None}
+    if lab_ids:
+        session.info.setdefault('catalogue_labs', set()).update(lab_ids)
+
+
+@event.listens_for(Session, 'after_flush')
+def bump_versions(session, flush_context):
+    lab_ids = session.info.pop('catalogue_labs', None)
+    if not lab_ids:
+        return
+    connection = session.connection()
+    table = LabCatalogueVersion.__table__
+    insert = postgresql.insert if connection.dialect.name == 'postgresql' else sqlite.insert
+    stmt = insert(table).values([{'lab_id': lab_id, 'version': 1} for lab_id in lab_ids])
+    connection.execute(stmt.on_conflict_do_update(index_elements=[table.c.lab_id],
+                                                  set_={'version': table.c.version + 1}))
+    session.info.setdefault('bumped_catalogues', set()).update(lab_ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def drop_bumped_catalogues(session):
+    lab_ids = session.info.pop('bumped_catalogues', None)
+    if lab_ids:
+        invalidate_catalogues(lab_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_bumped_catalogues(session):
+    session.info.pop('catalogue_labs', None)
+    session.info.pop('bumped_catalogues', None)
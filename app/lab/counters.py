@@ -0,0 +1,89 @@
+import threading
+from collections import defaultdict
+
+import sqlalchemy as sa
+from flask import current_app
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+
+
+def allocate(model, year, month, size=1, retries=3):
+    """Atomically reserve ``size`` consecutive numbers from a monthly counter table.
+
+    The allocation runs on its own connection and commits immediately, so the row
+    lock is held for a single statement instead of the whole request. On PostgreSQL
+    this is one ``INSERT ... ON CONFLICT DO UPDATE ... RETURNING`` round-trip, other
+    databases fall back to ``SELECT ... FOR UPDATE``. There the first allocations
+    of a month can both insert the row, the one that loses on the unique
+    constraint is retried and then updates it.
+
+    Returns a range of the reserved numbers.
+    """
+    for attempt in range(retries):
+        try:
+            with db.engine.begin() as conn:
+                last = increment(conn, model.__table__, year, month, size)
+        except IntegrityError:
+            if attempt == retries - 1:
+                raise
+        else:
+            return range(last - size + 1, last + 1)
+
+
+def increment(conn, table, year, month, size):
+    count = table.c['count']
+    if conn.dialect.name == 'postgresql':
+        stmt = pg_insert(table).values(year=year, month=month, count=size)
+        stmt = stmt.on_conflict_do_update(index_elements=[table.c.year, table.c.month],
+                                          set_={'count': sa.func.coalesce(count, 0) + size}).returning(count)
+        return conn.execute(stmt).scalar_one()
+    row = conn.execute(sa.select(table.c.id, count)
+                       .where(table.c.year == year, table.c.month == month)
+                       .with_for_update()).first()
+    if row:
+        last = (row[1] or 0) + size
+        conn.execute(table.update().where(table.c.id == row[0]).values(count=last))
+    else:
+        last = size
+        conn.execute(table.insert().values(year=year, month=month, count=last))
+    return last
+
+
+class CounterBlocks:
+    """Per-process pool of counter numbers reserved in blocks.
+
+    With a block size of 1 every number is taken straight from the database.
+    Codes are unique but may have gaps either way: a number is committed on its
+    own, so it is lost when the request that took it fails. Larger blocks save
+    round-trips under load, and the numbers left in a block when the worker
+    exits are never used.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = defaultdict(list)
+
+    def next(self, model, year, month, block_size=1):
+        key = (model.__tablename__, year, month)
+        with self._lock:
+            block = self._blocks[key]
+            if not block:
+                # drop exhausted blocks of the previous months
+                for k in [k for k in self._blocks if k[0] == key[0] and k != key]:
+                    del self._blocks[k]
+                block.extend(reversed(allocate(model, year, month, size=block_size)))
+            return block.pop()
+
+    def reset(self):
+        with self._lock:
+            self._blocks.clear()
+
+
+counter_blocks = CounterBlocks()
+
+
+def next_number(model, year, month, config_key):
+    block_size = current_app.config.get(config_key, 1)
+    return counter_blocks.next(model, year, month, block_size=block_size)
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+
+import arrow
+from sqlalchemy import func, and_
+
+from app import db
+from .models import LabCustomer, LabTestOrder
+from .utils import escape_like
+
+# (youngest, oldest) age in years, None means no bound
+AGE_BANDS = OrderedDict([
+    ('0-14', (0, 14)),
+    ('15-24', (15, 24)),
+    ('25-44', (25, 44)),
+    ('45-59', (45, 59)),
+    ('60+', (60, None)),
+])
+
+CUSTOMER_SORTS = OrderedDict([
+    ('hn', (LabCustomer.hn,)),
+    ('name', (LabCustomer.firstname, LabCustomer.lastname)),
+    ('dob', (LabCustomer.dob,)),
+    ('gender', (LabCustomer.gender,)),
+    ('pending', None),
+    ('total', None),
+])
+
+
+def order_counts(lab_id, customer_ids=None):
+    """A subquery of the pending and total number of orders per customer."""
+    pending = and_(LabTestOrder.approved_at == None, LabTestOrder.cancelled_at == None)
+    query = db.session.query(LabTestOrder.customer_id.label('customer_id'),
+                             func.count(LabTestOrder.id).filter(pending).label('pending'),
+                             func.count(LabTestOrder.id).label('total')) \
+        .filter(LabTestOrder.lab_id == lab_id)
+    if customer_ids is not None:
+        query = query.filter(LabTestOrder.customer_id.in_(customer_ids))
+    return query.group_by(LabTestOrder.customer_id).subquery()
+
+
+def dob_range(band, today=None):
+    """Return the (earliest, latest) date of birth of the age band, both inclusive."""
+    youngest, oldest = AGE_BANDS[band]
+    today = arrow.get(today) if today else arrow.now('Asia/Bangkok')
+    latest = today.shift(years=-youngest).date()
+    earliest = today.shift(years=-(oldest + 1), days=+1).date() if oldest is not None else None
+    return earliest, latest
+
+
+def filter_customers(lab_id, hn=None, name=None, gender=None, age_band=None):
+    query = LabCustomer.query.filter(LabCustomer.lab_id == lab_id)
+    if hn:
+        query = query.filter(LabCustomer.hn.like(f'{escape_like(hn)}%', escape='\\'))
+    if name:
+        words = name.split()
+        if len(words) > 1:
+            query = query.filter(LabCustomer.firstname.ilike(f'{escape_like(words[0])}%', escape='\\'),
+                                 LabCustomer.lastname.ilike(f'{escape_like(words[1])}%', escape='\\'))
+        else:
+            pattern = f'{escape_like(name)}%'
+            query = query.filter(LabCustomer.firstname.ilike(pattern, escape='\\')
+                                 | LabCustomer.lastname.ilike(pattern, escape='\\'))
+    if gender:
+        query = query.filter(LabCustomer.gender == gender)
+    if age_band in AGE_BANDS:
+        earliest, latest = dob_range(age_band)
+        query = query.filter(LabCustomer.dob <= latest)
+        if earliest:
+            query = query.filter(LabCustomer.dob >= earliest)
+    return query
+
+
+def paginate_customers(lab_id, page=1, per_page=50, sort='hn', descending=False, **filters):
+    """Return a page of customers and a dict of (pending, total) order counts by customer id.
+
+    When sorted by a customer column only the customers of the page are counted.
+    Sorting by the counts joins the grouped subquery of the whole lab instead.
+    """
+    query = filter_customers(lab_id, **filters)
+    if sort not in CUSTOMER_SORTS:
+        sort = 'hn'
+    if CUSTOMER_SORTS[sort] is None:
+        counts = order_counts(lab_id)
+        column = func.coalesce(getattr(counts.c, sort), 0)
+        query = query.outerjoin(counts, counts.c.customer_id == LabCustomer.id) \
+            .order_by(column.desc() if descending else column, LabCustomer.id)
+        pagination = query.add_columns(counts.c.pending, counts.c.total) \
+            .paginate(page=page, per_page=per_page, error_out=False)
+        customers = [customer for customer, _, _ in pagination.items]
+        counts = {customer.id: (pending or 0, total or 0) for customer, pending, total in pagination.items}
+        pagination.items = customers
+        return pagination, counts
+    columns = CUSTOMER_SORTS[sort]
+    query = query.order_by(*[c.desc() if descending else c for c in columns], LabCustomer.id)
+    pagination = query.paginate(page=page, per_page=per_page, error_out=False)
+    counts = {}
+    if pagination.items:
+        subquery = order_counts(lab_id, [c.id for c in pagination.items])
+        counts = {row.customer_id: (row.pending, row.total) for row in db.session.query(subquery)}
+    return pagination, counts
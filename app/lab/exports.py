@@ -0,0 +1,114 @@
+import csv
+import io
+import tempfile
+import zlib
+from collections import OrderedDict
+from decimal import Decimal
+
+import xlsxwriter
+from sqlalchemy import select
+
+from app import db
+from .models import LabTestRecord, LabTestOrder, LabTest, LabCustomer
+
+# the first ten columns are the keys of LabTestRecord.to_dict()
+RESULT_COLUMNS = OrderedDict([
+    ('id', LabTestRecord.id),
+    ('num_result', LabTestRecord.num_result),
+    ('text_result', LabTestRecord.text_result),
+    ('reported_datetime', LabTestRecord.updated_at),
+    ('reporter_id', LabTestRecord.updater_id),
+    ('test_id', LabTestRecord.test_id),
+    ('reject_record_id', LabTestRecord.reject_record_id),
+    ('receive_datetime', LabTestRecord.received_at),
+    ('received_by', LabTestRecord.receiver_id),
+    ('order_id', LabTestRecord.order_id),
+    ('order_code', LabTestOrder.code),
+    ('order_datetime', LabTestOrder.ordered_at),
+    ('test_code', LabTest.code),
+    ('test_name', LabTest.name),
+    ('unit', LabTest.unit),
+    ('hn', LabCustomer.hn),
+    ('cancelled', LabTestRecord.cancelled),
+    ('flag', LabTestRecord.flag),
+])
+
+DEFAULT_RESULT_COLUMNS = list(RESULT_COLUMNS)[:10]
+
+CHUNK_SIZE = 1000
+
+MAX_XLSX_ROWS = 1048576
+
+
+def iter_result_rows(lab_id, columns=None, start=None, end=None, chunk_size=CHUNK_SIZE):
+    """Yield lists of result rows for a lab using a server-side cursor.
+
+    Only ``chunk_size`` rows are held in memory at a time. ``start`` and ``end``
+    filter on the order datetime.
+    """
+    columns = [c for c in (columns or DEFAULT_RESULT_COLUMNS) if c in RESULT_COLUMNS]
+    stmt = select(*[RESULT_COLUMNS[c] for c in columns]) \
+        .select_from(LabTestRecord) \
+        .join(LabTestOrder, LabTestRecord.order_id == LabTestOrder.id) \
+        .outerjoin(LabTest, LabTestRecord.test_id == LabTest.id) \
+        .outerjoin(LabCustomer, LabTestOrder.customer_id == LabCustomer.id) \
+        .where(LabTestOrder.lab_id == lab_id) \
+        .order_by(LabTestRecord.order_id, LabTestRecord.id)
+    if start:
+        stmt = stmt.where(LabTestOrder.ordered_at >= start)
+    if end:
+        stmt = stmt.where(LabTestOrder.ordered_at < end)
+    result = db.session.execute(stmt.execution_options(stream_results=True, max_row_buffer=chunk_size))
+    for rows in result.partitions(chunk_size):
+        yield [[format_value(v) for v in row] for row in rows]
+
+
+def format_value(value):
+    if hasattr(value, 'strftime'):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def generate_csv(columns, chunks, compress=False):
+    """Stream CSV text encoded in UTF-8 with a BOM so Excel shows Thai correctly."""
+    compressor = zlib.compressobj(wbits=31) if compress else None
+
+    def encode(text, first=False):
+        data = text.encode('utf-8-sig' if first else 'utf-8')
+        return compressor.compress(data) if compressor else data
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield encode(buffer.getvalue(), first=True)
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield encode(buffer.getvalue())
+    if compressor:
+        yield compressor.flush()
+
+
+def write_xlsx(columns, chunks):
+    """Write the rows to a temporary xlsx file in constant memory and return the open file."""
+    output = tempfile.TemporaryFile()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    worksheet = None
+    row_num = MAX_XLSX_ROWS
+    for rows in chunks:
+        for row in rows:
+            # continue on a new sheet when one is full
+            if row_num == MAX_XLSX_ROWS:
+                worksheet = workbook.add_worksheet()
+                worksheet.write_row(0, 0, columns)
+                row_num = 1
+            worksheet.write_row(row_num, 0, row)
+            row_num += 1
+    if worksheet is None:
+        workbook.add_worksheet().write_row(0, 0, columns)
+    workbook.close()
+    output.seek(0)
+    return output
@@ -0,0 +1,261 @@
+import os
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+import arrow
+import click
+import requests
+from flask import Flask, current_app, request, jsonify
+from flask.cli import AppGroup
+from requests.adapters import HTTPAdapter
+
+from app import db
+from .models import LabInvoiceJob
+
+
+class FlowAccountError(Exception):
+    pass
+
+
+class AccessTokenCache:
+    """Process-wide cache of the FlowAccount access token.
+
+    The token is reused by all threads until shortly before it expires.
+    """
+
+    # renew the token this many seconds before it expires
+    leeway = 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+
+    def get(self, session):
+        with self._lock:
+            if not self._token or time.monotonic() >= self._expires_at - self.leeway:
+                token_data = request_access_token(session)
+                self._token = token_data['access_token']
+                self._expires_at = time.monotonic() + int(token_data.get('expires_in', 3600))
+            return self._token
+
+    def invalidate(self):
+        with self._lock:
+            self._token = None
+
+
+def request_access_token(session):
+    url = f"{get_host()}/token"
+    payload = {
+        'client_id': os.getenv('FA_CLIENT_ID'),
+        'client_secret': os.getenv('FA_CLIENT_SECRET'),
+        'grant_type': os.getenv('FA_GRANT_TYPE'),
+        'scope': os.getenv('FA_SCOPE'),
+    }
+    response = session.post(url, data=payload, timeout=10)
+    if response.status_code != 200:
+        raise FlowAccountError(f"Failed to get access token: {response.text}")
+    return response.json()
+
+
+def get_host():
+    return os.getenv('FA_URL')
+
+
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+http = create_session()
+token_cache = AccessTokenCache()
+
+
+def get_access_token():
+    return token_cache.get(http)
+
+
+def post(path, data):
+    """POST JSON to the FlowAccount API, renewing the token once if it was rejected."""
+    for attempt in range(2):
+        headers = {
+            'Authorization': f'Bearer {get_access_token()}',
+            'Content-Type': 'application/json'
+        }
+        response = http.post(f'{get_host()}{path}', headers=headers, json=data, timeout=30)
+        if response.status_code == 401 and attempt == 0:
+            token_cache.invalidate()
+            continue
+        if response.status_code != 200:
+            raise FlowAccountError(f'{response.status_code}: {response.text}')
+        return response.json()['data']
+
+
+def get(path, params=None):
+    """GET from the FlowAccount API, renewing the token once if it was rejected."""
+    for attempt in range(2):
+        headers = {'Authorization': f'Bearer {get_access_token()}'}
+        response = http.get(f'{get_host()}{path}', headers=headers, params=params, timeout=30)
+        if response.status_code == 401 and attempt == 0:
+            token_cache.invalidate()
+            continue
+        if response.status_code != 200:
+            raise FlowAccountError(f'{response.status_code}: {response.text}')
+        return response.json()['data']
+
+
+def create_cash_invoice(invoice):
+    data = post('/cash-invoices/with-payment', invoice)
+    return data['documentId'], data.get('documentSerial')
+
+
+def find_cash_invoice(reference):
+    """Return the id of the cash invoice created with the reference, None if there is none."""
+    data = get('/cash-invoices', {'currentPage': 1, 'pageSize': 20, 'searchKeyword': reference})
+    for document in data.get('list', []):
+        # the search also matches other fields, only the exact reference counts
+        if document.get('reference') == reference:
+            return document['recordId']
+    return None
+
+
+def share_document(document_id):
+    return post('/cash-invoices/sharedocument', {'documentId': document_id})['link']
+
+
+def enqueue_invoice(payment_record, invoice):
+    """Add a job for the worker, committed together with the payment record."""
+    job = LabInvoiceJob(payload=invoice,
+                        payment_record=payment_record,
+                        created_at=arrow.now('Asia/Bangkok').datetime,
+                        next_attempt_at=arrow.now('Asia/Bangkok').datetime)
+    db.session.add(job)
+    db.session.flush()
+    # sent with the document, so a retry can find the one an earlier attempt created
+    job.reference = f'LIMS-{job.id}'
+    return job
+
+
+def get_backoff(attempts):
+    base = current_app.config.get('INVOICE_RETRY_BACKOFF', 30)
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), 3600))
+
+
+def send_job(job):
+    """Create the document of a job unless an earlier attempt already did."""
+    document_id = find_cash_invoice(job.reference) if job.attempts > 1 else None
+    if document_id is None:
+        document_id, _ = create_cash_invoice(dict(job.payload, reference=job.reference))
+    return document_id
+
+
+def process_next_job():
+    """Run the next due job, returns False when there is nothing to do.
+
+    The job row is locked with SKIP LOCKED so several workers can share the
+    queue. The job is claimed for INVOICE_CLAIM_SECONDS and the lock released
+    before calling FlowAccount, a job left behind by a worker that died is
+    picked up again after that.
+    """
+    now = arrow.now('Asia/Bangkok').datetime
+    job = LabInvoiceJob.query.filter(LabInvoiceJob.status == 'pending',
+                                     LabInvoiceJob.next_attempt_at <= now) \
+        .order_by(LabInvoiceJob.next_attempt_at) \
+        .with_for_update(skip_locked=True).first()
+    if not job:
+        db.session.rollback()
+        return False
+    job.attempts += 1
+    job.next_attempt_at = now + timedelta(seconds=current_app.config.get('INVOICE_CLAIM_SECONDS', 300))
+    db.session.commit()
+
+    now = arrow.now('Asia/Bangkok').datetime
+    try:
+        document_id = send_job(job)
+    except (FlowAccountError, requests.RequestException, KeyError) as e:
+        job.last_error = str(e)
+        if job.attempts >= current_app.config.get('INVOICE_MAX_ATTEMPTS', 8):
+            job.status = 'failed'
+            job.finished_at = now
+        else:
+            job.next_attempt_at = now + get_backoff(job.attempts)
+    else:
+        job.status = 'done'
+        job.document_id = str(document_id)
+        job.finished_at = now
+        job.payment_record.receipt_id = str(document_id)
+    db.session.commit()
+    return True
+
+
+def run_worker(interval=2.0, once=False):
+    while True:
+        while process_next_job():
+            pass
+        if once:
+            break
+        time.sleep(interval)
+
+
+invoice_cli = AppGroup('invoices', help='FlowAccount invoice queue.')
+
+
+@invoice_cli.command('work')
+@click.option('--interval', default=2.0, help='Seconds to wait when the queue is empty.')
+@click.option('--once', is_flag=True, help='Exit when the queue is empty.')
+def work_command(interval, once):
+    """Process pending invoice jobs."""
+    run_worker(interval=interval, once=once)
+
+
+@invoice_cli.command('fake-server')
+@click.option('--port', default=5050)
+def fake_server_command(port):
+    """Run a local stand-in for the FlowAccount API, point FA_URL to it."""
+    create_fake_server().run(port=port)
+
+
+def create_fake_server():
+    """A minimal stand-in for the FlowAccount endpoints used by the lab."""
+    server = Flask('fake_flowaccount')
+    documents = {}
+
+    @server.route('/cash-invoices', methods=['GET'])
+    def cash_invoices():
+        if not authorized():
+            return jsonify(status=False, message='Unauthorized'), 401
+        keyword = request.args.get('searchKeyword', '')
+        found = [{'recordId': document_id, 'documentSerial': f'CA{document_id:08}',
+                  'reference': document.get('reference')}
+                 for document_id, document in documents.items() if keyword in (document.get('reference') or '')]
+        return jsonify(status=True, data={'list': found, 'total': len(found)})
+
+    def authorized():
+        return request.headers.get('Authorization', '').startswith('Bearer fake-')
+
+    @server.route('/token', methods=['POST'])
+    def token():
+        return jsonify(access_token=f'fake-{uuid.uuid4().hex}', token_type='Bearer', expires_in=3600)
+
+    @server.route('/cash-invoices/with-payment', methods=['POST'])
+    def cash_invoice():
+        if not authorized():
+            return jsonify(status=False, message='Unauthorized'), 401
+        document_id = len(documents) + 1
+        documents[document_id] = request.get_json()
+        return jsonify(status=True, data={'documentId': document_id,
+                                          'documentSerial': f'CA{document_id:08}'})
+
+    @server.route('/cash-invoices/sharedocument', methods=['POST'])
+    def share():
+        if not authorized():
+            return jsonify(status=False, message='Unauthorized'), 401
+        document_id = request.get_json().get('documentId')
+        return jsonify(status=True, data={'link': f'{request.host_url}documents/{document_id}'})
+
+    return server
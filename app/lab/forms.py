@@ -1,3 +1,7 @@
+import threading
+from collections import OrderedDict
+from operator import attrgetter
+
 from flask import session
 from flask_wtf import FlaskForm, Form
 from wtforms import BooleanField, StringField, TextField, DecimalField, SelectField
@@ -10,6 +14,7 @@ from wtforms_alchemy import model_form_factory, QuerySelectField
 from wtforms_alchemy.fields import QuerySelectField, QuerySelectMultipleField, ModelFormField, ModelFieldList
 
 from .models import *
+from .catalogue import catalogue
 from app import db
 
 BaseModelForm = model_form_factory(FlaskForm)
@@ -52,6 +57,10 @@ def create_lab_specimen_container_item_form(lab_id):
 
 
 def create_lab_test_form(lab_id):
+    return cached_form_class(('test',), lambda: _create_lab_test_form(lab_id), lab_id=lab_id)
+
+
+def _create_lab_test_form(lab_id):
     LabSpecimenContainerItemForm = create_lab_specimen_container_item_form(lab_id)
 
     class LabTestForm(ModelForm):
@@ -79,36 +88,59 @@ def create_customer_form(lab_id):
     return LabCustomerForm
 
 
-def create_lab_test_record_form(test, default=None):
-    default_choice = LabResultChoiceItem.query.filter_by(choice_set_id=test.choice_set_id, result=default).first()
-    if default_choice:
-        default_choice = lambda: LabResultChoiceItem.query.filter_by(choice_set_id=test.choice_set_id,
-                                                                     result=default).first()
+def create_lab_test_record_form(test):
+    """The result form of a test.
+
+    The class only depends on the data type of the test, the choices are set on
+    each form with set_result_choices().
+    """
+    return cached_form_class(('record', test.id, test.data_type, test.choice_set_id), lambda: _create_lab_test_record_form(test), lab_id=test.lab_id)
+
+
+def _create_lab_test_record_form(test):
+    is_numeric = test.data_type == "Numeric"
 
     class LabTestRecordForm(ModelForm):
         class Meta:
             model = LabTestRecord
 
         choice_set = QuerySelectField('Result choices',
-                                      query_factory=lambda: [] if not test.choice_set else test.choice_set.choice_items,
+                                      query_factory=lambda: [],
+                                      get_pk=attrgetter('id'),
                                       allow_blank=True,
                                       blank_text='Please select',
-                                      default=default_choice,
                                       validators=[Optional()])
-        numeric = BooleanField('Numeric Result', default=True if test.data_type == "Numeric" else False)
+        numeric = BooleanField('Numeric Result', default=is_numeric)
 
     return LabTestRecordForm
 
 
-def create_lab_test_profile_record_form(order):
-    class LabTestProfileRecordForm(FlaskForm):
-        code_list = order.split(',')
-        field_list = []
-        for code in code_list:
-            test = LabTest.query.filter_by(code=code).first()
-            form = create_lab_test_record_form(test)
-            vars()[code] = FormField(form, default=LabTestRecord)
-    return LabTestProfileRecordForm
+def create_lab_test_profile_record_form(profile, tests):
+    """The result form of a profile with a subform for each test, named by the test code.
+
+    ``tests`` are the tests of the profile by code, see Catalogue.profile_tests().
+    """
+    codes = tuple(code for code in profile_codes(profile) if code in tests)
+
+    def create():
+        fields = {code: FormField(create_lab_test_record_form(tests[code]), default=LabTestRecord)
+                  for code in codes}
+        return type('LabTestProfileRecordForm', (FlaskForm,), fields)
+
+    return cached_form_class(('profile', profile.id, codes), create, lab_id=profile.lab_id)
+
+
+def profile_codes(profile):
+    return [code.strip() for code in (profile.test_order or '').split(',') if code.strip()]
+
+
+def set_result_choices(form, items, default=None):
+    """Set the choices of a result form and select the one matching ``default`` on a new form."""
+    form.choice_set.query = items
+    if default and not form.is_submitted():
+        for item in items:
+            if item.result == default:
+                form.choice_set.data = item
 
 
 class LabOrderRejectRecordForm(ModelForm):
@@ -178,3 +210,29 @@ def create_lab_service_package_profiles_form(lab_id):
                                             option_widget=CheckboxInput())
 
     return LabServicePackageProfilesForm
+
+
+# Form classes built from the tests, profiles and choice sets of a lab are
+# cached by the key of the factory and the catalogue version of the lab, see
+# app.lab.catalogue. A change in any worker bumps the version, so the classes
+# of the old version are no longer used and leave the cache as the least
+# recently used ones.
+FORM_CLASS_CACHE_SIZE = 512
+
+_form_classes = OrderedDict()
+_form_classes_lock = threading.Lock()
+
+
+def cached_form_class(key, create, lab_id):
+    full_key = (lab_id, catalogue(lab_id).version) + key
+    with _form_classes_lock:
+        form_class = _form_classes.get(full_key)
+        if form_class is not None:
+            _form_classes.move_to_end(full_key)
+            return form_class
+    form_class = create()
+    with _form_classes_lock:
+        _form_classes[full_key] = form_class
+        while len(_form_classes) > FORM_CLASS_CACHE_SIZE:
+            _form_classes.popitem(last=False)
+    return form_class
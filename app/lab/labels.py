@@ -0,0 +1,125 @@
+from collections import namedtuple, defaultdict
+from functools import lru_cache
+from io import BytesIO
+
+from barcode import EAN13, Code128
+from barcode.writer import SVGWriter, ImageWriter
+from sqlalchemy.orm import joinedload
+
+from .models import LabTestRecord, LabTest, LabSpecimenContainerItem
+
+SpecimenLabel = namedtuple('SpecimenLabel', ['order', 'container', 'tube', 'payload', 'symbology', 'tests', 'volume'])
+
+SpecimenCode = namedtuple('SpecimenCode', ['order_code', 'container_number', 'tube'])
+
+# the order code is YYMM plus a four digit running number
+EAN13_ORDER_CODE_LENGTH = 8
+
+BARCODE_OPTIONS = {'module_height': 8.0, 'module_width': 0.3, 'font_size': 8, 'text_distance': 3.0}
+
+
+def ean13_checksum(digits):
+    """Return the check digit of the first twelve digits of an EAN-13 code."""
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits[:12]))
+    return str((10 - total % 10) % 10)
+
+
+def specimen_payload(order_code, container_number, tube):
+    """Build the barcode payload of a specimen tube.
+
+    Orders with an eight digit code get a numeric EAN-13 payload of the order
+    code, the two digit container number, a two digit tube number and the check
+    digit. Longer codes do not fit and are encoded as Code128 with a dash before
+    the container part, which also keeps both forms apart when they are scanned.
+    """
+    if len(order_code) == EAN13_ORDER_CODE_LENGTH and order_code.isdigit():
+        digits = f'{order_code}{container_number % 100:02}{tube % 100:02}'
+        return digits + ean13_checksum(digits), 'ean13'
+    return f'{order_code}-{container_number % 100:02}{tube % 100:02}', 'code128'
+
+
+def parse_specimen_code(code):
+    """Split a scanned specimen barcode into its order code, container number and tube.
+
+    Accepts EAN-13 codes with or without the check digit and the Code128 form.
+    Returns None when the code is not a specimen code.
+    """
+    code = (code or '').strip()
+    if '-' in code:
+        order_code, _, rest = code.rpartition('-')
+        if len(rest) != 4 or not rest.isdigit() or not order_code:
+            return None
+        return SpecimenCode(order_code, int(rest[:2]), int(rest[2:]))
+    if not code.isdigit():
+        return None
+    if len(code) == 13:
+        if ean13_checksum(code) != code[-1]:
+            return None
+        code = code[:12]
+    if len(code) != 12:
+        return None
+    return SpecimenCode(code[:8], int(code[8:10]), int(code[10:12]))
+
+
+def load_order_records(order_ids):
+    """Load the active records of the orders with their tests and containers in one pass."""
+    records = LabTestRecord.query.filter(LabTestRecord.order_id.in_(order_ids),
+                                         LabTestRecord.cancelled.isnot(True),
+                                         LabTestRecord.reject_record_id == None) \
+        .options(joinedload(LabTestRecord.test)
+                 .selectinload(LabTest.specimen_container_items)
+                 .joinedload(LabSpecimenContainerItem.specimen_container)) \
+        .order_by(LabTestRecord.id)
+    grouped = defaultdict(list)
+    for record in records:
+        grouped[record.order_id].append(record)
+    return grouped
+
+
+def pack_specimens(order, records):
+    """Assign the specimens of the records to tubes and return a label for each tube.
+
+    Tubes are keyed by the container id. A specimen goes into the last tube of
+    its container while it has room for the volume, otherwise a new tube is used.
+    """
+    tubes = defaultdict(list)
+    for record in records:
+        for item in record.test.specimen_container_items:
+            container = item.specimen_container
+            volume = item.volume or 0
+            container_tubes = tubes[container.id]
+            if not container_tubes or (container.max_volume is not None and
+                                       container_tubes[-1]['volume'] + volume > container.max_volume):
+                container_tubes.append({'container': container, 'volume': 0, 'tests': []})
+            tube = container_tubes[-1]
+            tube['volume'] += volume
+            tube['tests'].append(record.test.code)
+    labels = []
+    for container_tubes in tubes.values():
+        for n, tube in enumerate(container_tubes, start=1):
+            container = tube['container']
+            payload, symbology = specimen_payload(order.code, container.number or 0, n)
+            labels.append(SpecimenLabel(order, container, n, payload, symbology, tube['tests'], tube['volume']))
+    return sorted(labels, key=lambda label: (label.container.number or 0, label.tube))
+
+
+def get_order_labels(orders):
+    """Return the labels of all orders using one query for their records."""
+    records = load_order_records([order.id for order in orders])
+    labels = []
+    for order in orders:
+        labels.extend(pack_specimens(order, records[order.id]))
+    return labels
+
+
+@lru_cache(maxsize=2048)
+def render_barcode(payload, symbology='ean13', fmt='svg', text=None):
+    """Render a barcode to SVG or PNG bytes, the result is cached per payload."""
+    writer = ImageWriter() if fmt == 'png' else SVGWriter()
+    if symbology == 'ean13':
+        barcode = EAN13(payload[:12], writer=writer)
+    else:
+        barcode = Code128(payload, writer=writer)
+    output = BytesIO()
+    barcode.write(output, BARCODE_OPTIONS, text=text)
+    return output.getvalue()
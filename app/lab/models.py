@@ -1,16 +1,48 @@
+import functools
 from datetime import datetime
 from decimal import Decimal
 
-from sqlalchemy_continuum import make_versioned
+import arrow
+from sqlalchemy_continuum import make_versioned, version_class
 import sqlalchemy as sa
 from wtforms.validators import Length
 
 from app import db
+from app.lab.counters import next_number
+from app.lab.utils import as_local
 from app.main.models import Laboratory
 from app.auth.models import User
 
 make_versioned(user_cls=None)
 
+FLAG_LABELS = {
+    'LL': 'CRITICAL LOW',
+    'L': 'LOW',
+    'N': '',
+    'H': 'HIGH',
+    'HH': 'CRITICAL HIGH',
+}
+
+
+def display_cached(func):
+    """A property that is computed once per instance after LabTestOrder.preload().
+
+    Without a preload the value is computed on every access as before, so code
+    that changes the order and reads it again still sees fresh values.
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self):
+        cache = self.__dict__.get('_display_cache')
+        if cache is None:
+            return func(self)
+        if name not in cache:
+            cache[name] = func(self)
+        return cache[name]
+
+    return property(wrapper)
+
 test_profile_assoc = db.Table('test_profile_assoc',
                               db.Column('test_id', db.ForeignKey('lab_tests.id')),
                               db.Column('profile_id', db.ForeignKey('lab_test_profiles.id')))
@@ -37,6 +69,9 @@ lab_test_profile_package_assoc = db.Table('lab_test_profile_package_assoc',
 
 
 class LabHNCount(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('year', 'month'),
+    )
     id = db.Column('id', db.Integer, primary_key=True, autoincrement=True)
     year = db.Column('year', db.Integer, nullable=False)
     month = db.Column('month', db.Integer, nullable=False)
@@ -50,14 +85,10 @@ class LabHNCount(db.Model):
 
     @classmethod
     def get_new_hn(cls, year, month):
-        _hn = cls.query.filter_by(year=year, month=month).first()
-        if not _hn:
-            today = datetime.today()
-            _hn = cls(year=today.year, month=today.month, count=0)
-        _hn.increment()
-        db.session.add(_hn)
-        db.session.commit()
-        return f'{str(_hn.year)[-2:]}{_hn.month:02}{_hn.count:04}'
+        count = next_number(cls, year, month, 'HN_BLOCK_SIZE')
+        if count > 9999:
+            raise ValueError('HN count cannot exceed 9999 per month.')
+        return f'{str(year)[-2:]}{month:02}{count:04}'
 
 
 class LabCustomerUnderlyingDisease(db.Model):
@@ -110,6 +141,14 @@ class LabCustomerMedication(db.Model):
 
 class LabCustomer(db.Model):
     __tablename__ = 'lab_customers'
+    __table_args__ = (
+        # lab scoping and HN ordering of the customer directory
+        db.Index('ix_lab_customers_lab_id_hn', 'lab_id', 'hn'),
+        # trigram indexes for the customer search, they need the pg_trgm extension
+        *[db.Index(f'ix_lab_customers_{column}_trgm', column, postgresql_using='gin',
+                   postgresql_ops={column: 'gin_trgm_ops'})
+          for column in ('firstname', 'lastname', 'hn', 'pid', 'tel')],
+    )
     id = db.Column('id', db.Integer, primary_key=True, autoincrement=True)
     title = db.Column('title', db.String(), info={'label': 'Title',
                                                   'choices': [(t, t) for t in ['นาย',
@@ -176,6 +215,10 @@ class LabCustomer(db.Model):
 
 class LabActivity(db.Model):
     __tablename__ = 'lab_activities'
+    __table_args__ = (
+        # covers the activity log, see app.lab.activities
+        db.Index('ix_lab_activities_lab_id_added_at', 'lab_id', 'added_at'),
+    )
     id = db.Column('id', db.Integer, primary_key=True, autoincrement=True)
     actor_id = db.Column('actor_id', db.ForeignKey('user.id'))
     actor = db.relationship(User, backref=db.backref('activities',
@@ -295,6 +338,8 @@ class LabTest(db.Model):
                                secondary=test_profile_assoc,
                                backref=db.backref('tests'))
     tat = db.Column('tat', db.String(), info={'label': 'Turn-Around-Time'})
+    # received to reported, see app.lab.tat
+    tat_minutes = db.Column('tat_minutes', db.Integer(), info={'label': 'TAT target (minutes)'})
 
     def __str__(self):
         return f'{self.name} ({self.code})'
@@ -324,6 +369,30 @@ class LabTest(db.Model):
         }
 
 
+class LabTestReferenceRange(db.Model):
+    """A reference interval of a test for a sex and an age band.
+
+    A range without a gender or ages applies to everyone. The most specific
+    range that matches a customer is used, see app.lab.ranges.
+    """
+    __tablename__ = 'lab_test_reference_ranges'
+    id = db.Column('id', db.Integer, primary_key=True, autoincrement=True)
+    test_id = db.Column('test_id', db.ForeignKey('lab_tests.id'), nullable=False, index=True)
+    test = db.relationship(LabTest, backref=db.backref('reference_ranges', cascade='all, delete-orphan'))
+    gender = db.Column('gender', db.String(), info={'label': 'Gender',
+                                                    'choices': [(g, g) for g in ['', 'ชาย', 'หญิง']]})
+    # age in years, the lowest inclusive and the highest exclusive
+    min_age = db.Column('min_age', db.Numeric(), info={'label': 'Min age'})
+    max_age = db.Column('max_age', db.Numeric(), info={'label': 'Max age'})
+    min_ref_value = db.Column('min_ref_value', db.Numeric(), info={'label': 'Min ref value'})
+    max_ref_value = db.Column('max_ref_value', db.Numeric(), info={'label': 'Max ref value'})
+    critical_min_value = db.Column('critical_min_value', db.Numeric(), info={'label': 'Critical min value'})
+    critical_max_value = db.Column('critical_max_value', db.Numeric(), info={'label': 'Critical max value'})
+
+    def __str__(self):
+        return f'{self.test.code} {self.gender or ""} {self.min_age or 0}-{self.max_age or ""}'
+
+
 class LabSpecimenContainerItem(db.Model):
     __tablename__ = 'lab_specimen_container_items'
     id = db.Column('id', db.Integer, primary_key=True, autoincrement=True)
@@ -339,6 +408,9 @@ class LabSpecimenContainerItem(db.Model):
 
 class LabOrderCount(db.Model):
     __tablename__ = 'lab_order_counts'
+    __table_args__ = (
+        db.UniqueConstraint('year', 'month'),
+    )
     id = db.Column('id', db.Integer, primary_key=True, autoincrement=True)
     year = db.Column('year', db.Integer(), info={'label': 'Year'})
     month = db.Column('month', db.Integer(), info={'label': 'Month'})
@@ -350,6 +422,12 @@ class LabOrderCount(db.Model):
 
 class LabTestOrder(db.Model):
     __tablename__ = 'lab_test_orders'
+    __table_args__ = (
+        # supports the keyset pagination of the order list
+        db.Index('ix_lab_test_orders_lab_id_ordered_at_id', 'lab_id', 'ordered_at', 'id'),
+        # order counts of the customer directory
+        db.Index('ix_lab_test_orders_customer_id', 'customer_id'),
+    )
     id = db.Column('id', db.Integer, primary_key=True, autoincrement=True)
     code = db.Column('code', db.String(), unique=True, nullable=False)
     lab_id = db.Column('lab_id', db.ForeignKey('labs.id'))
@@ -371,9 +449,17 @@ class LabTestOrder(db.Model):
     def pending_tests(self):
         return len([test for test in self.test_orders if test.finished_at is None])
 
-    @property
+    def preload(self, records, payment):
+        """Keep the records and payment loaded for display and memoize the derived values."""
+        self.__dict__['_display_cache'] = {'all_test_records': records, 'payment': payment}
+
+    @display_cached
+    def all_test_records(self):
+        return self.test_records.all()
+
+    @display_cached
     def active_test_records(self):
-        return [record for record in self.test_records if record.is_active]
+        return [record for record in self.all_test_records if record.is_active]
 
     def to_dict(self):
         return {
@@ -388,20 +474,14 @@ class LabTestOrder(db.Model):
     @classmethod
     def generate_code(cls):
         now = datetime.now()
-        order_count = LabOrderCount.query.filter_by(year=now.year, month=now.month).first()
-        if not order_count:
-            order_count = LabOrderCount(year=now.year, month=now.month, count=1)
-        else:
-            order_count.increment()
-        db.session.add(order_count)
-        db.session.commit()
-        return f'{str(order_count.year)[-2:]}{order_count.month:02}{order_count.count:04}'
+        count = next_number(LabOrderCount, now.year, now.month, 'ORDER_CODE_BLOCK_SIZE')
+        return f'{str(now.year)[-2:]}{now.month:02}{count:04}'
 
-    @property
+    @display_cached
     def payment(self):
         return self.payments.filter_by(expired_at=None).first()
 
-    @property
+    @display_cached
     def invoice_items(self):
         packages = set()
         items = []
@@ -432,7 +512,7 @@ class LabTestOrder(db.Model):
                 })
         return items
 
-    @property
+    @display_cached
     def amount_balance(self):
         packages = set()
         test_prices = Decimal(0.0)
@@ -446,14 +526,26 @@ class LabTestOrder(db.Model):
                 test_prices += rec.test.price
         return test_prices + package_prices
 
-    @property
+    @display_cached
     def last_reported_record(self):
-        return self.test_records.order_by(LabTestRecord.updated_at.desc()).first()
+        reported = [rec for rec in self.all_test_records if rec.updated_at]
+        return max(reported, key=lambda rec: rec.updated_at) if reported else None
 
 
 class LabTestRecord(db.Model):
     __versioned__ = {}
     __tablename__ = 'lab_test_records'
+    __table_args__ = (
+        # covers the pending worklist, see query_pending
+        db.Index('ix_lab_test_records_pending', 'order_id', 'received_at',
+                 postgresql_where=sa.text('updated_at IS NULL AND cancelled IS NOT TRUE AND reject_record_id IS NULL')),
+        # covers the overdue evaluator, see app.lab.tat
+        db.Index('ix_lab_test_records_overdue_at', 'overdue_at',
+                 postgresql_where=sa.text('updated_at IS NULL AND cancelled IS NOT TRUE AND reject_record_id IS NULL')),
+        # covers the rejection report, see app.lab.rejections
+        db.Index('ix_lab_test_records_reject_record_id', 'reject_record_id',
+                 postgresql_where=sa.text('reject_record_id IS NOT NULL')),
+    )
     id = db.Column('id', db.Integer, primary_key=True, autoincrement=True)
     num_result = db.Column('num_result', db.Numeric(),
                            info={'label': 'Numeric Result'})
@@ -479,6 +571,28 @@ class LabTestRecord(db.Model):
     profile = db.relationship(LabTestProfile)
     package_id = db.Column('package_id', db.ForeignKey('lab_service_packages.id'))
     package = db.relationship('LabServicePackage')
+    # LL, L, N, H or HH, set by app.lab.ranges when the result is saved
+    flag = db.Column('flag', db.String(2))
+    # received_at plus the TAT target of the test
+    overdue_at = db.Column('overdue_at', db.DateTime(timezone=True))
+
+    @classmethod
+    def query_pending(cls, lab_id, received_only=True):
+        """Query the records of a lab waiting for results in orders not yet approved."""
+        query = cls.query.join(cls.order).filter(LabTestOrder.lab_id == lab_id,
+                                                 LabTestOrder.approved_at.is_(None),
+                                                 LabTestOrder.cancelled_at.is_(None),
+                                                 cls.updated_at.is_(None),
+                                                 cls.cancelled.isnot(True),
+                                                 cls.reject_record_id.is_(None))
+        if received_only:
+            query = query.filter(cls.received_at.isnot(None))
+        return query
+
+    @property
+    def is_overdue(self):
+        return self.updated_at is None and self.overdue_at is not None \
+            and as_local(self.overdue_at) <= arrow.now('Asia/Bangkok')
 
     @property
     def is_active(self):
@@ -502,11 +616,14 @@ class LabTestRecord(db.Model):
 
     @property
     def interpret(self):
-        if not self.num_result:
+        if self.flag:
+            return FLAG_LABELS.get(self.flag, '')
+        # not flagged yet, compare with the reference values of the test
+        if self.num_result is None:
             return ''
-        if self.test.min_ref_value and self.num_result < self.test.min_ref_value:
+        if self.test.min_ref_value is not None and self.num_result < self.test.min_ref_value:
             return 'LOW'
-        if self.test.max_ref_value and self.num_result < self.test.max_ref_value:
+        if self.test.max_ref_value is not None and self.num_result > self.test.max_ref_value:
             return 'HIGH'
         return ''
 
@@ -547,7 +664,7 @@ class LabPhysicalExamRecord(db.Model):
 class LabOrderRejectRecord(db.Model):
     __tablename__ = 'lab_order_reject_records'
     id = db.Column('id', db.Integer, primary_key=True, autoincrement=True)
-    created_at = db.Column('created_at', db.DateTime(timezone=True), nullable=False)
+    created_at = db.Column('created_at', db.DateTime(timezone=True), nullable=False, index=True)
     creator_id = db.Column('creator_id', db.ForeignKey('user.id'))
     reason = db.Column('reason', db.String(), nullable=False, info={'label': 'สาเหตุ',
                                                                     'choices': [(c, c) for c in
@@ -588,6 +705,30 @@ class LabOrderPaymentRecord(db.Model):
     creator = db.relationship(User)
 
 
+class LabInvoiceJob(db.Model):
+    """A FlowAccount document waiting to be created by the invoice worker."""
+    __tablename__ = 'lab_invoice_jobs'
+    __table_args__ = (
+        db.Index('ix_lab_invoice_jobs_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+    id = db.Column('id', db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column('kind', db.String(), nullable=False, default='cash-invoice')
+    payload = db.Column('payload', db.JSON(), nullable=False)
+    status = db.Column('status', db.String(), nullable=False, default='pending',
+                       info={'choices': [(c, c) for c in ('pending', 'done', 'failed')]})
+    attempts = db.Column('attempts', db.Integer(), nullable=False, default=0)
+    next_attempt_at = db.Column('next_attempt_at', db.DateTime(timezone=True), nullable=False)
+    last_error = db.Column('last_error', db.Text())
+    document_id = db.Column('document_id', db.String())
+    # the reference sent with the document, used to find it again on a retry
+    reference = db.Column('reference', db.String(), unique=True)
+    created_at = db.Column('created_at', db.DateTime(timezone=True), nullable=False)
+    finished_at = db.Column('finished_at', db.DateTime(timezone=True))
+    payment_record_id = db.Column('payment_record_id', db.ForeignKey('lab_order_payment_records.id'))
+    payment_record = db.relationship(LabOrderPaymentRecord,
+                                     backref=db.backref('invoice_jobs', cascade='all, delete-orphan'))
+
+
 class LabServicePackage(db.Model):
     __tablename__ = 'lab_service_packages'
     __table_args__ = (
@@ -619,4 +760,117 @@ class LabServicePackage(db.Model):
         return self.name
 
 
+
+class LabOverdueAlert(db.Model):
+    """A record past its TAT target, published by the overdue evaluator."""
+    __tablename__ = 'lab_overdue_alerts'
+    __table_args__ = (
+        db.Index('ix_lab_overdue_alerts_lab_id_open', 'lab_id',
+                 postgresql_where=sa.text('resolved_at IS NULL')),
+    )
+    id = db.Column('id', db.Integer, primary_key=True, autoincrement=True)
+    lab_id = db.Column('lab_id', db.ForeignKey('labs.id'), nullable=False)
+    record_id = db.Column('record_id', db.ForeignKey('lab_test_records.id'), nullable=False, unique=True)
+    record = db.relationship(LabTestRecord, backref=db.backref('overdue_alert', uselist=False,
+                                                               cascade='all, delete-orphan'))
+    overdue_at = db.Column('overdue_at', db.DateTime(timezone=True), nullable=False)
+    created_at = db.Column('created_at', db.DateTime(timezone=True), nullable=False)
+    # when the record was reported, cancelled or rejected
+    resolved_at = db.Column('resolved_at', db.DateTime(timezone=True))
+
+
+class LabWatermark(db.Model):
+    """How far a background job has processed, by the name of the job."""
+    __tablename__ = 'lab_watermarks'
+    name = db.Column('name', db.String(), primary_key=True)
+    value = db.Column('value', db.DateTime(timezone=True), nullable=False)
+
+
+class LabApiKey(db.Model):
+    """A key a script or LIS client sends to the result APIs of a lab, it acts as its user, see app.lab.apikeys."""
+    __tablename__ = 'lab_api_keys'
+    id = db.Column('id', db.Integer, primary_key=True, autoincrement=True)
+    lab_id = db.Column('lab_id', db.ForeignKey('labs.id'), nullable=False)
+    user_id = db.Column('user_id', db.ForeignKey('user.id'), nullable=False)
+    user = db.relationship(User)
+    name = db.Column('name', db.String(), nullable=False)
+    # only the SHA-256 of the key is kept
+    key_hash = db.Column('key_hash', db.String(64), nullable=False, unique=True)
+    created_at = db.Column('created_at', db.DateTime(timezone=True), nullable=False)
+    last_used_at = db.Column('last_used_at', db.DateTime(timezone=True))
+    revoked_at = db.Column('revoked_at', db.DateTime(timezone=True))
+
+
+class LabCatalogueVersion(db.Model):
+    """Bumped on every change to the tests, profiles, packages or choice sets of a lab, see app.lab.catalogue."""
+    __tablename__ = 'lab_catalogue_versions'
+    lab_id = db.Column('lab_id', db.ForeignKey('labs.id'), primary_key=True)
+    version = db.Column('version', db.Integer(), nullable=False, default=0)
+
+
+# Daily rollups kept by app.lab.stats, the days are in Bangkok time.
+
+class LabDailyStats(db.Model):
+    __tablename__ = 'lab_daily_stats'
+    lab_id = db.Column('lab_id', db.ForeignKey('labs.id'), primary_key=True)
+    day = db.Column('day', db.Date(), primary_key=True)
+    orders = db.Column('orders', db.Integer(), nullable=False, default=0)
+    approved = db.Column('approved', db.Integer(), nullable=False, default=0)
+    cancelled = db.Column('cancelled', db.Integer(), nullable=False, default=0)
+    revenue = db.Column('revenue', db.Numeric(), nullable=False, default=0)
+
+
+class LabDailyTestStats(db.Model):
+    __tablename__ = 'lab_daily_test_stats'
+    lab_id = db.Column('lab_id', db.ForeignKey('labs.id'), primary_key=True)
+    day = db.Column('day', db.Date(), primary_key=True)
+    test_id = db.Column('test_id', db.ForeignKey('lab_tests.id'), primary_key=True)
+    test = db.relationship(LabTest)
+    ordered = db.Column('ordered', db.Integer(), nullable=False, default=0)
+    received = db.Column('received', db.Integer(), nullable=False, default=0)
+    reported = db.Column('reported', db.Integer(), nullable=False, default=0)
+    rejected = db.Column('rejected', db.Integer(), nullable=False, default=0)
+
+
+class LabDailyRejectionStats(db.Model):
+    __tablename__ = 'lab_daily_rejection_stats'
+    lab_id = db.Column('lab_id', db.ForeignKey('labs.id'), primary_key=True)
+    day = db.Column('day', db.Date(), primary_key=True)
+    reason = db.Column('reason', db.String(), primary_key=True)
+    count = db.Column('count', db.Integer(), nullable=False, default=0)
+
+
+class LabDailyTATStats(db.Model):
+    """Turnaround times counted in buckets, so percentiles can be read from any range of days.
+
+    The report metric is received to reported per test. The approve metric is
+    ordered to approved per order and has a test_id of 0.
+    """
+    __tablename__ = 'lab_daily_tat_stats'
+    lab_id = db.Column('lab_id', db.ForeignKey('labs.id'), primary_key=True)
+    day = db.Column('day', db.Date(), primary_key=True)
+    metric = db.Column('metric', db.String(), primary_key=True)
+    test_id = db.Column('test_id', db.Integer(), primary_key=True)
+    # the upper bound of the bucket in minutes, -1 for longer times
+    bucket = db.Column('bucket', db.Integer(), primary_key=True)
+    count = db.Column('count', db.Integer(), nullable=False, default=0)
+
+
+class LabVersionArchive(db.Model):
+    """A revision moved out of a Continuum version table by the compaction job, see app.lab.revisions."""
+    __tablename__ = 'lab_version_archives'
+    table_name = db.Column('table_name', db.String(), primary_key=True)
+    id = db.Column('id', db.Integer(), primary_key=True)
+    transaction_id = db.Column('transaction_id', db.BigInteger(), primary_key=True)
+    end_transaction_id = db.Column('end_transaction_id', db.BigInteger())
+    operation_type = db.Column('operation_type', db.SmallInteger(), nullable=False)
+    issued_at = db.Column('issued_at', db.DateTime())
+    # the columns of the version row
+    data = db.Column('data', db.JSON(), nullable=False)
+    archived_at = db.Column('archived_at', db.DateTime(timezone=True), nullable=False)
+
+
 sa.orm.configure_mappers()
+
+# the revisions of an order are read together, see app.lab.revisions
+sa.Index('ix_lab_test_records_version_order_id', version_class(LabTestRecord).__table__.c.order_id)
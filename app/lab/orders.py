@@ -0,0 +1,124 @@
+from collections import namedtuple, defaultdict
+
+from sqlalchemy.orm import joinedload
+
+from app import db
+from .catalogue import catalogue_with
+from .models import LabTestRecord, LabTestOrder, LabOrderPaymentRecord
+
+OrderItem = namedtuple('OrderItem', ['test_id', 'profile_id', 'package_id'])
+
+
+class OrderItemError(Exception):
+    pass
+
+
+def expand_order_items(lab_id, test_ids=(), profile_ids=(), package_ids=()):
+    """Resolve the selected tests, profiles and packages into one item per test.
+
+    Profiles and packages are read from the catalogue of the lab, so no query is
+    made while it is fresh. A test is ordered only once: tests selected directly
+    win over profiles, profiles over package tests and package tests over
+    package profiles. Raises OrderItemError when a selection is not in the lab.
+    """
+    items = []
+    seen = set()
+    lab_catalogue = catalogue_with(lab_id, test_ids, profile_ids, package_ids)
+    missing = lab_catalogue.missing(test_ids, profile_ids, package_ids)
+    if missing:
+        raise OrderItemError('These selections are no longer available: {}.'.format(
+            ', '.join(f'{kind} {", ".join(map(str, ids))}' for kind, ids in missing.items())))
+
+    def add(test_ids_, profile_id=None, package_id=None):
+        for test_id in test_ids_:
+            if test_id not in seen:
+                seen.add(test_id)
+                items.append(OrderItem(test_id, profile_id, package_id))
+
+    add(test_ids)
+    for profile_id in profile_ids:
+        add(lab_catalogue.profiles[profile_id].test_ids, profile_id=profile_id)
+    for package_id in package_ids:
+        package = lab_catalogue.packages[package_id]
+        add(package.test_ids, package_id=package_id)
+        for profile_id in package.profile_ids:
+            add(lab_catalogue.profiles[profile_id].test_ids, profile_id=profile_id, package_id=package_id)
+    return items
+
+
+def add_order_records(order, items):
+    """Insert a test record for each item of an already flushed order.
+
+    The records are added as plain ORM objects so the flush sends them as one
+    batched INSERT while SQLAlchemy-Continuum still writes their version rows.
+    """
+    records = [LabTestRecord(order_id=order.id,
+                             test_id=item.test_id,
+                             profile_id=item.profile_id,
+                             package_id=item.package_id) for item in items]
+    db.session.add_all(records)
+    return records
+
+
+def diff_order_items(records, items):
+    """Compare the active records of an order with the newly expanded items.
+
+    Returns the items that need new records and the records that must be
+    cancelled. Tests that stay in the order keep their existing records and
+    results, and take the profile and package they are now ordered through.
+    """
+    wanted = {item.test_id: item for item in items}
+    current = {rec.test_id for rec in records}
+    added = [item for item in items if item.test_id not in current]
+    cancelled = [rec for rec in records if rec.test_id not in wanted]
+    for rec in records:
+        item = wanted.get(rec.test_id)
+        if item and (rec.profile_id, rec.package_id) != (item.profile_id, item.package_id):
+            rec.profile_id = item.profile_id
+            rec.package_id = item.package_id
+    return added, cancelled
+
+
+def load_order_for_display(order_id):
+    """Load an order with everything the order, report, invoice and receipt pages show.
+
+    The order with its customer, lab, physical exam and approver, its records
+    with their tests, profiles, packages and rejections, and its payment are
+    loaded in three queries. Derived values such as ``active_test_records`` and
+    ``amount_balance`` are then computed once for the request.
+    """
+    order = LabTestOrder.query.filter(LabTestOrder.id == order_id) \
+        .options(joinedload(LabTestOrder.customer),
+                 joinedload(LabTestOrder.lab),
+                 joinedload(LabTestOrder.physical_exam),
+                 joinedload(LabTestOrder.approver)).first()
+    if not order:
+        return None
+    preload_orders([order])
+    return order
+
+
+def preload_orders(orders):
+    """Load the records and payments of the orders in two queries and preload them."""
+    if not orders:
+        return orders
+    order_ids = [order.id for order in orders]
+    records = defaultdict(list)
+    for rec in LabTestRecord.query.filter(LabTestRecord.order_id.in_(order_ids)) \
+            .options(joinedload(LabTestRecord.test),
+                     joinedload(LabTestRecord.profile),
+                     joinedload(LabTestRecord.package),
+                     joinedload(LabTestRecord.reject_record),
+                     joinedload(LabTestRecord.updater)) \
+            .order_by(LabTestRecord.id):
+        records[rec.order_id].append(rec)
+    payments = {}
+    for payment in LabOrderPaymentRecord.query.filter(LabOrderPaymentRecord.order_id.in_(order_ids),
+                                                      LabOrderPaymentRecord.expired_at.is_(None)) \
+            .options(joinedload(LabOrderPaymentRecord.creator)) \
+            .order_by(LabOrderPaymentRecord.id):
+        # the first one, as LabTestOrder.payment takes it
+        payments.setdefault(payment.order_id, payment)
+    for order in orders:
+        order.preload(records[order.id], payments.get(order.id))
+    return orders
@@ -0,0 +1,502 @@
+import atexit
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import textwrap
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from xml.sax.saxutils import escape
+
+import arrow
+import pytz
+from bahttext import bahttext
+from flask import current_app
+from pypdf import PdfWriter, PdfReader
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_RIGHT, TA_CENTER
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import mm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+from reportlab.platypus import Image, Paragraph, SimpleDocTemplate, TableStyle, Table, KeepTogether, Spacer
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static')
+
+# fonts, styles and the logo are loaded once per process and shared by all documents
+sarabun_font = TTFont('Sarabun', os.path.join(STATIC_DIR, 'fonts', 'THSarabunNew.ttf'))
+pdfmetrics.registerFont(sarabun_font)
+style_sheet = getSampleStyleSheet()
+style_sheet.add(ParagraphStyle(name='ThaiStyle', fontName='Sarabun'))
+style_sheet.add(ParagraphStyle(name='ThaiStyleNumber', fontName='Sarabun', alignment=TA_RIGHT))
+style_sheet.add(ParagraphStyle(name='ThaiStyleCenter', fontName='Sarabun', alignment=TA_CENTER))
+style_sheet.add(ParagraphStyle(name='ThaiStyleRight', fontName='Sarabun', alignment=TA_RIGHT))
+
+logo = Image(os.path.join(STATIC_DIR, 'img', 'ONELAB-01-mini.png'), width=200, lazy=0)
+
+receipt_title = Paragraph('<para align=center><font size=16>ใบเสร็จรับเงิน / RECEIPT<br/><br/></font></para>',
+                          style=style_sheet['ThaiStyle'])
+
+header_styles = TableStyle([
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+])
+
+bangkok = pytz.timezone('Asia/Bangkok')
+
+
+class PageNumCanvas(canvas.Canvas):
+    """
+    Add "page x/y" to every page.
+
+    The page total is drawn into a form when the document is saved, so the
+    pages no longer have to be kept in memory until then.
+    """
+
+    def showPage(self):
+        self.draw_page_number()
+        canvas.Canvas.showPage(self)
+
+    def save(self):
+        self.beginForm('pageCount')
+        self.setFont("Sarabun", 12)
+        self.drawString(0, 0, str(self._pageNumber - 1))
+        self.endForm()
+        canvas.Canvas.save(self)
+
+    def draw_page_number(self):
+        self.setFont("Sarabun", 12)
+        self.drawRightString(190 * mm, 290 * mm, f'{self._pageNumber}/')
+        self.saveState()
+        self.translate(190 * mm, 290 * mm)
+        self.doForm('pageCount')
+        self.restoreState()
+
+
+class PDFCache:
+    """A size-bounded on-disk LRU cache of rendered documents.
+
+    The least recently read files are removed when the directory grows over
+    ``max_bytes``; a read touches the file modification time.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pdf')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, data):
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.pdf'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+_caches = {}
+
+
+def get_cache(name):
+    directory = os.path.join(current_app.config.get('PDF_CACHE_DIR') or
+                             os.path.join(tempfile.gettempdir(), 'one-lims-pdf'), name)
+    if directory not in _caches:
+        _caches[directory] = PDFCache(directory, current_app.config.get('PDF_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    return _caches[directory]
+
+
+def merge_pdfs(documents):
+    """Concatenate the PDF bytes into one document."""
+    writer = PdfWriter()
+    for data in documents:
+        writer.append(PdfReader(BytesIO(data)))
+    output = BytesIO()
+    writer.write(output)
+    output.seek(0)
+    return output
+
+
+def render_receipt_pdf(order):
+    """Render the receipt of the current payment of the order and return the PDF bytes."""
+    payment = order.payment
+    this_lab = order.lab
+
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer,
+                            rightMargin=20,
+                            leftMargin=20,
+                            topMargin=180,
+                            bottomMargin=10,
+                            )
+    receipt_number = order.code
+    data = []
+    address = f'''<br/><br/><br/><br/><font size=10>
+            ที่อยู่ / Address <br/>
+            {escape(this_lab.address or '')}<br/><br/>
+            เลขประจำตัวผู้เสียภาษี / TAX ID<br/>
+            {escape(this_lab.tax_id or '')}
+            </font>
+            '''
+
+    receipt_info = '''<br/><br/><br/><br/><font size=10>
+            เลขที่ / NO. {receipt_number}<br/>
+            วันที่ออก / ISSUE TIME {issued_date}<br/>
+            ออกโดย / ISSUER {issuer}<br/>
+            </font>
+            '''
+    issued_date = arrow.get(payment.created_at.astimezone(bangkok)).format(fmt='DD MMMM YYYY HH:mm:ss',
+                                                                           locale='th-th')
+    # the receipt is cached, so it shows when and by whom it was issued rather than printed
+    receipt_info_ori = receipt_info.format(receipt_number=receipt_number,
+                                           issued_date=issued_date,
+                                           issuer=escape(str(payment.creator)))
+
+    header_content_ori = [[Paragraph(address, style=style_sheet['ThaiStyle']),
+                           [logo],
+                           Paragraph(receipt_info_ori, style=style_sheet['ThaiStyle'])]]
+
+    header_ori = Table(header_content_ori, colWidths=[130, 240, 150])
+
+    header_ori.hAlign = 'CENTER'
+    header_ori.setStyle(header_styles)
+
+    customer_name = '''<para><font size=11>
+    ได้รับเงินจาก / PAYER {issued_for}<br/>
+    ที่อยู่ / ADDRESS<br/>{address}
+    </font></para>
+    '''.format(issued_for=escape(order.customer.fullname),
+               address='<br/>'.join(escape(line) for line in textwrap.wrap(order.customer.address or '', width=100)))
+    customer = Paragraph(customer_name, style=style_sheet['ThaiStyle'])
+    items = [[Paragraph('<font size=14>ลำดับ / No.</font>', style=style_sheet['ThaiStyleCenter']),
+              Paragraph('<font size=14>รายการ / Description</font>', style=style_sheet['ThaiStyleCenter']),
+              Paragraph('<font size=14>รวม / Total</font>', style=style_sheet['ThaiStyleCenter']),
+              ]]
+    total = 0
+    number_test = 0
+    for t in order.active_test_records:
+        price = t.test.price
+        total += price
+        number_test += 1
+        item = [Paragraph('<font size=14>{}</font>'.format(number_test), style=style_sheet['ThaiStyleCenter']),
+                Paragraph('<font size=14>{} ({})</font>'
+                          .format(escape(t.test.name), escape(t.test.detail or '-')),
+                          style=style_sheet['ThaiStyle']),
+                Paragraph('<font size=14>{:,.2f}</font>'.format(price), style=style_sheet['ThaiStyleNumber'])]
+        items.append(item)
+
+    total_thai = bahttext(total)
+    total_text = "รวมเงินทั้งสิ้น {}".format(total_thai)
+    items.append([
+        Paragraph('<font size=14></font>', style=style_sheet['ThaiStyle']),
+        Paragraph('<font size=14></font>', style=style_sheet['ThaiStyle']),
+        Paragraph('<font size=14></font>', style=style_sheet['ThaiStyle']),
+    ])
+    items.append([
+        Paragraph('<font size=14>{}</font>'.format(total_text), style=style_sheet['ThaiStyle']),
+        Paragraph('<font size=14></font>', style=style_sheet['ThaiStyle']),
+        Paragraph('<font size=14>{:,.2f}</font>'.format(total), style=style_sheet['ThaiStyleNumber'])
+    ])
+    item_table = Table(items, colWidths=[50, 350, 70], repeatRows=1, cornerRadii=(5, 5, 5, 5))
+    item_table.setStyle(TableStyle([
+        ('BOX', (0, 0), (-1, 0), 0.25, colors.black),
+        ('BOX', (0, -1), (-1, -1), 0.25, colors.black),
+        ('BOX', (0, 0), (0, -1), 0.25, colors.black),
+        ('BOX', (1, 0), (1, -1), 0.25, colors.black),
+        ('BOX', (2, 0), (2, -1), 0.25, colors.black),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 10),
+        ('BOTTOMPADDING', (0, -1), (-1, -1), 10),
+        ('BOTTOMPADDING', (0, -2), (-1, -2), 10),
+    ]))
+    item_table.setStyle([('VALIGN', (0, 0), (-1, -1), 'MIDDLE')])
+    item_table.setStyle([('SPAN', (0, -1), (1, -1))])
+
+    if payment.payment_method == 'Cash':
+        payment_info = Paragraph('<font size=14>ชำระเงินด้วย / PAYMENT METHOD: เงินสด / CASH</font>',
+                                 style=style_sheet['ThaiStyleRight'])
+    elif payment.payment_method == 'QR':
+        payment_info = Paragraph('<font size=14>ชำระเงินด้วย / PAYMENT METHOD: QR / QR</font>',
+                                 style=style_sheet['ThaiStyleRight'])
+    elif payment.payment_method == 'Credit Card':
+        payment_info = Paragraph(
+            '<font size=14>ชำระเงินด้วย / PAYMENT METHOD บัตรเครดิต / CREDIT CARD: หมายเลข / NUMBER {}-****-****-{}</font>'.format(
+                payment.card_number[:4], payment.card_number[-4:]),
+            style=style_sheet['ThaiStyleRight'])
+    else:
+        payment_info = Paragraph('<font size=14>ยังไม่ชำระเงิน / UNPAID</font>', style=style_sheet['ThaiStyleRight'])
+
+    sign_text = Paragraph(
+        '<br/><br/><br/><br/><font size=14>...................................<br/>({})<br/><br/>ผู้รับเงิน / CASHIER<br/></font>'.format(
+            escape(payment.creator.fullname)),
+        style=style_sheet['ThaiStyleCenter'])
+    total_content = [
+        [
+            payment_info,
+        ],
+        [
+            Paragraph(
+                f"<font size=14>เมื่อ / Date Time {payment.payment_datetime.strftime('%d/%m/%Y %H:%M:%S')}</font>",
+                style=style_sheet['ThaiStyleRight']),
+        ],
+        [
+            sign_text
+        ]
+    ]
+
+    total_table = Table(total_content, colWidths=[400])
+
+    def page_setup(canvas, doc):
+        canvas.saveState()
+        header = header_ori
+        w, h = header.wrap(doc.width, doc.topMargin)
+        header.drawOn(canvas, doc.leftMargin + 28, doc.height + doc.topMargin - h)
+
+        subheader1 = receipt_title
+        w, h = subheader1.wrap(doc.width, doc.topMargin)
+        subheader1.drawOn(canvas, doc.leftMargin, doc.height + doc.topMargin - h * 5.5)
+
+        subheader2 = customer
+        w, h = subheader2.wrap(doc.width, doc.topMargin)
+        subheader2.drawOn(canvas, doc.leftMargin + 48, doc.height + doc.topMargin - h * 4.5)
+        canvas.restoreState()
+
+    data.append(KeepTogether(item_table))
+    data.append(KeepTogether(Spacer(1, 12)))
+    data.append(KeepTogether(total_table))
+
+    doc.build(data, onFirstPage=page_setup, onLaterPages=page_setup, canvasmaker=PageNumCanvas)
+    return buffer.getvalue()
+
+
+def receipt_cache_key(order):
+    payment = order.payment
+    customer = order.customer
+    lab = order.lab
+    # everything else the receipt prints, edits of the customer, the lab or the tests render a new one
+    printed = [order.code, lab.address, lab.tax_id, customer.fullname, customer.hn, customer.address,
+               [(rec.id, rec.test.name, rec.test.detail, str(rec.test.price)) for rec in order.active_test_records]]
+    digest = hashlib.sha1(repr(printed).encode()).hexdigest()
+    return f'receipt:{order.id}:{payment.id}:{payment.created_at.isoformat()}:{digest}'
+
+
+def get_receipt_pdf(order):
+    """Return the receipt PDF bytes from the cache, rendering it on a miss.
+
+    The key includes the time the payment record was saved and the other
+    printed fields, so editing the payment, the customer, the lab or the tests
+    of the order renders a new receipt.
+    """
+    cache = get_cache('receipts')
+    key = receipt_cache_key(order)
+    data = cache.get(key)
+    if data is None:
+        data = render_receipt_pdf(order)
+        cache.set(key, data)
+    return data
+
+
+def generate_receipt_pdf(order, sign=False, cancel=False):
+    return BytesIO(get_receipt_pdf(order))
+
+
+def generate_receipts_pdf(orders):
+    """Merge the receipts of the orders into one PDF."""
+    return merge_pdfs([get_receipt_pdf(order) for order in orders if order.payment])
+
+
+def format_datetime(dt):
+    return dt.astimezone(bangkok).strftime('%d/%m/%Y %X') if dt else ''
+
+
+def report_context(order, records=None):
+    """Collect what the result report shows into plain data.
+
+    The result can be pickled, so reports can be laid out in other processes.
+    ``records`` are the active records of the order when they were preloaded.
+    """
+    if records is None:
+        records = order.active_test_records
+    customer = order.customer
+    lab = order.lab
+    exam = order.physical_exam
+    reported = [rec for rec in records if rec.updated_at]
+    last_reported = max(reported, key=lambda rec: rec.updated_at) if reported else None
+    return {
+        'lab': {'name': lab.name, 'address': lab.address or '', 'tel': lab.tel or ''},
+        'code': order.code,
+        'customer': {
+            'hn': customer.hn or '',
+            'fullname': customer.fullname,
+            'dob': customer.dob.strftime('%d/%m/%Y') if customer.dob else '',
+            'gender': customer.gender or '',
+        },
+        'physical_exam': {
+            'weight': exam.weight,
+            'height': exam.height,
+            'bmi': exam.bmi,
+            'bmi_interpret': exam.bmi_interpret,
+            'heartrate': exam.heartrate,
+            'systolic': exam.systolic,
+            'diastolic': exam.diastolic,
+        } if exam else None,
+        'records': [{
+            'name': rec.test.name,
+            'result': str(rec.num_result if rec.num_result is not None else rec.text_result or ''),
+            'unit': rec.test.unit or '',
+            'reference': rec.test.reference_values,
+            'flag': rec.interpret or '',
+            'comment': rec.comment or '',
+        } for rec in records],
+        'reporter': str(last_reported.updater) if last_reported and last_reported.updater else '',
+        'reporter_license': last_reported.updater.license_id if last_reported and last_reported.updater else '',
+        'reported_at': format_datetime(last_reported.updated_at) if last_reported else '',
+        'approver': str(order.approver) if order.approver else '',
+        'approver_license': order.approver.license_id if order.approver else '',
+        'approved_at': format_datetime(order.approved_at),
+    }
+
+
+def render_report_pdf(context):
+    """Lay out a result report from report_context() and return the PDF bytes."""
+    style = style_sheet['ThaiStyle']
+    center = style_sheet['ThaiStyleCenter']
+
+    # the values are plain text, a < in a name or result would break the markup
+    def p(text, size=12, style=style):
+        return Paragraph(f'<font size={size}>{escape(str(text))}</font>', style=style)
+
+    def b(text, size=12, style=style):
+        return Paragraph(f'<font size={size}><b>{escape(text)}</b></font>', style=style)
+
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, rightMargin=20, leftMargin=20, topMargin=20, bottomMargin=20)
+    customer = context['customer']
+    data = [
+        logo,
+        p(f"{context['lab']['address']} โทรศัพท์ {context['lab']['tel']}", size=14, style=center),
+        Spacer(1, 6),
+        p(f"Order ID {context['code']}"),
+    ]
+    info = [
+        [b('HN'), p(customer['hn']), '', '', '', ''],
+        [b('ชื่อ นามสกุล'), p(customer['fullname']),
+         b('วันเดือนปีเกิด'), p(customer['dob']),
+         b('เพศ'), p(customer['gender'])],
+    ]
+    exam = context['physical_exam']
+    if exam:
+        info.append([b('น้ำหนัก'), p(f"{exam['weight'] or '-'} กก."),
+                     b('ส่วนสูง'), p(f"{exam['height'] or '-'} ซม."),
+                     b('ดัชนีมวลกาย'), p(f"{exam['bmi'] or '-'} ({exam['bmi_interpret'] or '-'})")])
+        info.append([b('ความดันโลหิต'), p(f"{exam['systolic'] or '-'}/{exam['diastolic'] or '-'} mmHg"),
+                     b('อัตราการเต้นหัวใจ'), p(f"{exam['heartrate'] or '-'} ครั้ง/นาที"), '', ''])
+    info_table = Table(info, colWidths=[80, 130, 80, 90, 80, 90])
+    info_table.setStyle(TableStyle([('VALIGN', (0, 0), (-1, -1), 'MIDDLE')]))
+    data.append(info_table)
+    data.append(p('รายงานผลการตรวจ', size=18, style=center))
+    data.append(Spacer(1, 12))
+
+    results = [[b('ชื่อการทดสอบ'), b('ผลการทดสอบ'), b('หน่วย'),
+                b('ค่าอ้างอิง'), b('การแปลผล/หมายเหตุ')]]
+    for rec in context['records']:
+        results.append([p(rec['name']), p(rec['result']), p(rec['unit']),
+                        p(rec['reference']), p(f"{rec['flag']} {rec['comment']}".strip())])
+    result_table = Table(results, colWidths=[150, 90, 60, 90, 150], repeatRows=1)
+    result_table.setStyle(TableStyle([
+        ('GRID', (0, 0), (-1, -1), 0.25, colors.black),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+    ]))
+    data.append(result_table)
+    data.append(Spacer(1, 12))
+
+    signatures = Table([
+        [p('Reported By'), p(context['reporter']), p(f"License ID {context['reporter_license'] or '-'}")],
+        [p('Report Date Time'), p(context['reported_at']), ''],
+        [p('Approved By'), p(context['approver']), p(f"License ID {context['approver_license'] or '-'}")],
+        [p('Approve Date Time'), p(context['approved_at']), ''],
+    ], colWidths=[120, 200, 150])
+    data.append(KeepTogether(signatures))
+
+    doc.build(data, canvasmaker=PageNumCanvas)
+    return buffer.getvalue()
+
+
+def generate_report_pdf(order):
+    return BytesIO(render_report_pdf(report_context(order)))
+
+
+# One pool per worker process, started on the first large export and kept for
+# the next ones. Its processes are spawned rather than forked from a worker
+# that is serving requests on other threads.
+_report_pool = None
+_report_pool_pid = None
+_report_pool_lock = threading.Lock()
+
+
+def get_report_pool(processes=None):
+    global _report_pool, _report_pool_pid
+    with _report_pool_lock:
+        if _report_pool is None or _report_pool_pid != os.getpid():
+            _report_pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+            _report_pool_pid = os.getpid()
+        return _report_pool
+
+
+@atexit.register
+def shutdown_report_pool():
+    if _report_pool is not None and _report_pool_pid == os.getpid():
+        _report_pool.shutdown(cancel_futures=True)
+
+
+def render_reports(contexts, processes=None, threshold=20):
+    """Render many reports, laying them out in the report pool when there are at least threshold of them.
+
+    Smaller batches are rendered in the request, where starting the work in
+    other processes costs more than it saves.
+    """
+    if len(contexts) < max(threshold, 2) or processes == 1:
+        return [render_report_pdf(context) for context in contexts]
+    return list(get_report_pool(processes).map(render_report_pdf, contexts, chunksize=8))
+
+
+def zip_reports(names, documents):
+    output = BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data in zip(names, documents):
+            zf.writestr(name, data)
+    output.seek(0)
+    return output
@@ -0,0 +1,138 @@
+import click
+import numpy as np
+import pandas as pd
+from flask.cli import AppGroup
+from sqlalchemy import select
+
+from app import db
+from .models import LabTest, LabTestReferenceRange, LabTestRecord, LabTestOrder, LabCustomer
+from .utils import local_date
+
+RANGE_COLUMNS = ['test_id', 'range_gender', 'min_age', 'max_age',
+                 'min_ref_value', 'max_ref_value', 'critical_min_value', 'critical_max_value', 'specificity']
+
+RECORD_COLUMNS = ['test_id', 'result', 'dob', 'gender', 'ordered_at']
+
+CHUNK_SIZE = 5000
+
+
+def to_float(value):
+    return np.nan if value is None else float(value)
+
+
+def load_ranges(test_ids):
+    """Load the reference ranges of the tests into a DataFrame in two queries.
+
+    The reference values of the test itself are added as the least specific
+    range, so results of tests without ranges are flagged as before.
+    """
+    test_ids = list({int(i) for i in test_ids if i})
+    rows = []
+    if test_ids:
+        for r in LabTestReferenceRange.query.filter(LabTestReferenceRange.test_id.in_(test_ids)):
+            specificity = (4 if r.gender else 0) + (r.min_age is not None) + (r.max_age is not None)
+            rows.append((r.test_id, r.gender or None, to_float(r.min_age), to_float(r.max_age),
+                         to_float(r.min_ref_value), to_float(r.max_ref_value),
+                         to_float(r.critical_min_value), to_float(r.critical_max_value), specificity))
+        tests = db.session.query(LabTest.id, LabTest.min_ref_value, LabTest.max_ref_value) \
+            .filter(LabTest.id.in_(test_ids))
+        for test_id, min_ref_value, max_ref_value in tests:
+            rows.append((test_id, None, np.nan, np.nan, to_float(min_ref_value), to_float(max_ref_value),
+                         np.nan, np.nan, -1))
+    return pd.DataFrame(rows, columns=RANGE_COLUMNS)
+
+
+def ages(dob, at):
+    """Ages in years at the time of the order, in completed years from one year old."""
+    dob = pd.to_datetime(dob, errors='coerce')
+    at = pd.to_datetime(at, errors='coerce')
+    years = at.dt.year - dob.dt.year - ((at.dt.month * 100 + at.dt.day) < (dob.dt.month * 100 + dob.dt.day))
+    return pd.Series(np.where(years >= 1, years, (at - dob).dt.days / 365.2425), index=dob.index)
+
+
+def evaluate_flags(records, ranges):
+    """Flag the results of a DataFrame of RECORD_COLUMNS against the ranges in one pass.
+
+    Each record is matched with the most specific range of its test for the
+    sex and age of the customer. Returns LL, L, N, H or HH for each record,
+    or None when there is no numeric result.
+    """
+    if records.empty:
+        return pd.Series([], dtype=object)
+    records = records.assign(age=ages(records['dob'], records['ordered_at']),
+                             gender=records['gender'].mask(records['gender'] == ''),
+                             result=pd.to_numeric(records['result'], errors='coerce'))
+    merged = records.reset_index(names='position').merge(ranges, on='test_id', how='inner')
+    matches = (merged['range_gender'].isna() | (merged['range_gender'] == merged['gender'])) \
+        & (merged['min_age'].isna() | (merged['age'] >= merged['min_age'])) \
+        & (merged['max_age'].isna() | (merged['age'] < merged['max_age']))
+    best = merged[matches].sort_values(['position', 'specificity'], ascending=[True, False]) \
+        .drop_duplicates('position').set_index('position').reindex(records.index)
+    result = records['result']
+    flags = np.select([result < best['critical_min_value'],
+                       result > best['critical_max_value'],
+                       result < best['min_ref_value'],
+                       result > best['max_ref_value']],
+                      ['LL', 'HH', 'L', 'H'], default='N')
+    return pd.Series(np.where(result.isna(), None, flags), index=records.index, dtype=object)
+
+
+def flag_records(records):
+    """Set the flag of the records from their numeric results.
+
+    The customers of the orders and the ranges of the tests are loaded in one
+    query each, so a whole order or batch is flagged at once.
+    """
+    records = [rec for rec in records if rec.test_id]
+    if not records:
+        return
+    order_ids = {rec.order_id for rec in records}
+    customers = {order_id: (dob, gender, ordered_at) for order_id, dob, gender, ordered_at
+                 in db.session.query(LabTestOrder.id, LabCustomer.dob, LabCustomer.gender, LabTestOrder.ordered_at)
+                 .outerjoin(LabCustomer, LabTestOrder.customer_id == LabCustomer.id)
+                 .filter(LabTestOrder.id.in_(order_ids))}
+    frame = pd.DataFrame([(rec.test_id, to_float(rec.num_result)) + customers.get(rec.order_id, (None, None, None))
+                          for rec in records], columns=RECORD_COLUMNS)
+    frame['ordered_at'] = frame['ordered_at'].map(local_date)
+    flags = evaluate_flags(frame, load_ranges(frame['test_id']))
+    for rec, flag in zip(records, flags):
+        rec.flag = flag
+
+
+def reflag(lab_id=None, order_ids=None, chunk_size=CHUNK_SIZE):
+    """Recompute the stored flags of the numeric results of a lab or of orders after the ranges changed."""
+    stmt = select(LabTestRecord.id, LabTestRecord.test_id, LabTestRecord.num_result,
+                  LabCustomer.dob, LabCustomer.gender, LabTestOrder.ordered_at, LabTestRecord.flag) \
+        .join(LabTestOrder, LabTestRecord.order_id == LabTestOrder.id) \
+        .outerjoin(LabCustomer, LabTestOrder.customer_id == LabCustomer.id) \
+        .where(LabTestRecord.num_result.isnot(None)) \
+        .order_by(LabTestRecord.id)
+    if lab_id:
+        stmt = stmt.where(LabTestOrder.lab_id == lab_id)
+    if order_ids is not None:
+        stmt = stmt.where(LabTestOrder.id.in_(order_ids))
+    result = db.session.execute(stmt.execution_options(stream_results=True, max_row_buffer=chunk_size))
+    changed = 0
+    for rows in result.partitions(chunk_size):
+        chunk = pd.DataFrame(rows, columns=['id'] + RECORD_COLUMNS + ['flag'])
+        chunk['result'] = chunk['result'].map(to_float)
+        chunk['ordered_at'] = chunk['ordered_at'].map(local_date)
+        chunk['new_flag'] = evaluate_flags(chunk[RECORD_COLUMNS], load_ranges(chunk['test_id'].unique()))
+        updates = chunk[chunk['new_flag'] != chunk['flag']]
+        # the flag is derived from the result, so no versions are written
+        db.session.bulk_update_mappings(LabTestRecord, [{'id': int(row.id), 'flag': row.new_flag}
+                                                        for row in updates.itertuples()])
+        changed += len(updates)
+    db.session.commit()
+    return changed
+
+
+range_cli = AppGroup('ranges', help='Reference ranges and result flags.')
+
+
+@range_cli.command('reflag')
+@click.option('--lab-id', type=int, help='Only the results of this lab.')
+def reflag_command(lab_id):
+    """Recompute the flags of stored results, run it after changing reference ranges."""
+    changed = reflag(lab_id=lab_id)
+    click.echo(f'{changed} flags changed.')
@@ -0,0 +1,89 @@
+from collections import OrderedDict
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased, contains_eager, joinedload
+
+from app import db
+from app.auth.models import User
+from .exports import format_value
+from .models import LabTestRecord, LabTestOrder, LabTest, LabCustomer, LabOrderRejectRecord
+
+Receiver = aliased(User)
+Rejecter = aliased(User)
+
+# the columns a report can be grouped by, the receiver is the staff who
+# took in the specimen
+REJECTION_GROUPS = OrderedDict([
+    ('reason', (LabOrderRejectRecord.reason,)),
+    ('test', (LabTest.code, LabTest.name)),
+    ('receiver', (Receiver.firstname, Receiver.lastname)),
+])
+
+REJECTION_COLUMNS = OrderedDict([
+    ('rejected_at', LabOrderRejectRecord.created_at),
+    ('reason', LabOrderRejectRecord.reason),
+    ('detail', LabOrderRejectRecord.detail),
+    ('order_code', LabTestOrder.code),
+    ('ordered_at', LabTestOrder.ordered_at),
+    ('hn', LabCustomer.hn),
+    ('test_code', LabTest.code),
+    ('test_name', LabTest.name),
+    ('received_at', LabTestRecord.received_at),
+    ('receiver', func.coalesce(Receiver.firstname, '') + ' ' + func.coalesce(Receiver.lastname, '')),
+    ('rejected_by', func.coalesce(Rejecter.firstname, '') + ' ' + func.coalesce(Rejecter.lastname, '')),
+])
+
+
+def filter_rejections(query, lab_id, start=None, end=None):
+    """Filter a query or select joined to the orders and reject records by lab and [start, end) of the rejection."""
+    query = query.filter(LabTestOrder.lab_id == lab_id)
+    if start:
+        query = query.filter(LabOrderRejectRecord.created_at >= start)
+    if end:
+        query = query.filter(LabOrderRejectRecord.created_at < end)
+    return query
+
+
+def paginate_rejections(lab_id, start=None, end=None, page=1, per_page=50):
+    """A page of the rejected records, latest first, with what the rows show loaded in the same query."""
+    query = LabTestRecord.query \
+        .join(LabOrderRejectRecord, LabTestRecord.reject_record_id == LabOrderRejectRecord.id) \
+        .join(LabTestRecord.order) \
+        .options(contains_eager(LabTestRecord.reject_record),
+                 contains_eager(LabTestRecord.order).joinedload(LabTestOrder.customer),
+                 contains_eager(LabTestRecord.order).joinedload(LabTestOrder.ordered_by),
+                 joinedload(LabTestRecord.test),
+                 joinedload(LabTestRecord.receiver))
+    query = filter_rejections(query, lab_id, start, end) \
+        .order_by(LabOrderRejectRecord.created_at.desc(), LabTestRecord.id.desc())
+    return query.paginate(page=page, per_page=per_page, error_out=False)
+
+
+def count_rejections(lab_id, group='reason', start=None, end=None):
+    """Return the (labels, count) of the rejections by the columns of the group, the largest first."""
+    columns = REJECTION_GROUPS.get(group, REJECTION_GROUPS['reason'])
+    count = func.count(LabTestRecord.id)
+    query = db.session.query(*columns, count) \
+        .select_from(LabTestRecord) \
+        .join(LabOrderRejectRecord, LabTestRecord.reject_record_id == LabOrderRejectRecord.id) \
+        .join(LabTestOrder, LabTestRecord.order_id == LabTestOrder.id) \
+        .outerjoin(LabTest, LabTestRecord.test_id == LabTest.id) \
+        .outerjoin(Receiver, LabTestRecord.receiver_id == Receiver.id)
+    query = filter_rejections(query, lab_id, start, end).group_by(*columns).order_by(count.desc())
+    return [(' '.join(str(label) for label in row[:-1] if label), row[-1]) for row in query]
+
+
+def iter_rejection_rows(lab_id, start=None, end=None, chunk_size=1000):
+    """Yield lists of rows of REJECTION_COLUMNS for a CSV export, see exports.generate_csv()."""
+    stmt = select(*REJECTION_COLUMNS.values()) \
+        .select_from(LabTestRecord) \
+        .join(LabOrderRejectRecord, LabTestRecord.reject_record_id == LabOrderRejectRecord.id) \
+        .join(LabTestOrder, LabTestRecord.order_id == LabTestOrder.id) \
+        .outerjoin(LabCustomer, LabTestOrder.customer_id == LabCustomer.id) \
+        .outerjoin(LabTest, LabTestRecord.test_id == LabTest.id) \
+        .outerjoin(Receiver, LabTestRecord.receiver_id == Receiver.id) \
+        .outerjoin(Rejecter, LabOrderRejectRecord.creator_id == Rejecter.id)
+    stmt = filter_rejections(stmt, lab_id, start, end).order_by(LabOrderRejectRecord.created_at, LabTestRecord.id)
+    result = db.session.execute(stmt.execution_options(stream_results=True, max_row_buffer=chunk_size))
+    for rows in result.partitions(chunk_size):
+        yield [[format_value(v) for v in row] for row in rows]
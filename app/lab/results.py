@@ -0,0 +1,189 @@
+import csv
+import io
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+import arrow
+from sqlalchemy import or_, tuple_
+from sqlalchemy.orm import contains_eager, selectinload
+
+from app import db
+from .models import LabTestRecord, LabTestOrder, LabTest, LabResultChoiceSet
+from .ranges import flag_records
+from .utils import as_local
+
+# the CSV header and JSON keys of a result row, a record is found by
+# record_id or by order_code and test_code
+RESULT_FIELDS = ('record_id', 'order_code', 'test_code', 'result', 'comment', 'observed_at')
+
+
+class ResultError(Exception):
+    pass
+
+
+def parse_result_rows(data, content_type):
+    """Read result rows from a JSON list (or {"results": [...]}) or CSV text."""
+    if 'csv' in (content_type or ''):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8-sig')
+        return list(csv.DictReader(io.StringIO(data)))
+    if isinstance(data, dict):
+        data = data.get('results')
+    if not isinstance(data, list):
+        raise ResultError('Expected a list of results.')
+    return data
+
+
+def load_choices(lab_id):
+    """Return the choice items of the lab by choice set id, with the results lowercased as keys."""
+    choice_sets = LabResultChoiceSet.query.filter_by(lab_id=lab_id) \
+        .options(selectinload(LabResultChoiceSet.choice_items))
+    return {cs.id: {item.result.strip().lower(): item.result for item in cs.choice_items} for cs in choice_sets}
+
+
+def load_records(lab_id, rows):
+    """Load the records referenced by the rows with their orders and tests in one query."""
+    record_ids = set()
+    codes = set()
+    for row in rows:
+        if not isinstance(row, dict):
+            continue
+        try:
+            if row.get('record_id') not in (None, ''):
+                record_ids.add(int(row['record_id']))
+        except (TypeError, ValueError):
+            pass
+        if row.get('order_code') and row.get('test_code'):
+            codes.add((str(row['order_code']), str(row['test_code'])))
+    conditions = []
+    if record_ids:
+        conditions.append(LabTestRecord.id.in_(record_ids))
+    if codes:
+        conditions.append(tuple_(LabTestOrder.code, LabTest.code).in_(codes))
+    if not conditions:
+        return {}, {}
+    records = LabTestRecord.query.join(LabTestRecord.order).join(LabTestRecord.test) \
+        .filter(LabTestOrder.lab_id == lab_id, or_(*conditions)) \
+        .options(contains_eager(LabTestRecord.order), contains_eager(LabTestRecord.test)).all()
+    by_id = {rec.id: rec for rec in records}
+    by_code = {}
+    for rec in records:
+        # a test cancelled and ordered again has several records, use the active one
+        if not rec.cancelled and not rec.reject_record_id:
+            by_code[(rec.order.code, rec.test.code)] = rec
+    return by_id, by_code
+
+
+def validate_result(rec, row, choices):
+    """Return the new (num_result, text_result) of the record or raise ResultError."""
+    if rec.cancelled or rec.reject_record_id or rec.order.cancelled_at:
+        raise ResultError('The record was cancelled or rejected.')
+    if rec.order.approved_at:
+        raise ResultError('The order has been approved.')
+    value = row.get('result')
+    value = '' if value is None else str(value).strip()
+    if not value:
+        raise ResultError('The result is empty.')
+    test = rec.test
+    if test.data_type == 'Numeric':
+        try:
+            number = Decimal(value)
+        except InvalidOperation:
+            raise ResultError(f'{value} is not a number.')
+        if not number.is_finite():
+            raise ResultError(f'{value} is not a number.')
+        if test.min_value is not None and number < test.min_value:
+            raise ResultError(f'{value} is below the lowest value of {test.code}.')
+        if test.max_value is not None and number > test.max_value:
+            raise ResultError(f'{value} is above the highest value of {test.code}.')
+        return number, None
+    if test.choice_set_id:
+        items = choices.get(test.choice_set_id, {})
+        if items and value.lower() not in items:
+            raise ResultError(f'{value} is not one of the choices of {test.code}.')
+        return None, items.get(value.lower(), value)
+    return None, value
+
+
+def apply_results(lab_id, rows, user):
+    """Validate the result rows and save the valid ones in one transaction.
+
+    The records, tests and choice sets are loaded up front, so validation runs
+    in memory. Rows with errors are skipped and reported by their index. Rows
+    with an ``observed_at`` older than the current result are skipped, and so
+    are rows without one that repeat the current result. When rows of the
+    batch are for the same record, only the latest observation is saved, like
+    in app.lab.analyzers.apply_batch(). The
+    records are updated through the ORM in one flush, which sends the UPDATEs
+    as a batch and lets SQLAlchemy-Continuum write their versions.
+    """
+    choices = load_choices(lab_id)
+    by_id, by_code = load_records(lab_id, rows)
+    now = arrow.now('Asia/Bangkok').datetime
+    errors = []
+    latest = {}
+    skipped = 0
+    for i, row in enumerate(rows):
+        try:
+            if not isinstance(row, dict):
+                raise ResultError('A result must be an object.')
+            rec = None
+            if row.get('record_id') not in (None, ''):
+                try:
+                    rec = by_id.get(int(row['record_id']))
+                except (TypeError, ValueError):
+                    raise ResultError('The record_id must be a number.')
+            elif row.get('order_code') and row.get('test_code'):
+                rec = by_code.get((str(row['order_code']), str(row['test_code'])))
+            if rec is None:
+                raise ResultError('The test record was not found.')
+            observed_at = parse_observed_at(row.get('observed_at'))
+            if observed_at and rec.updated_at and as_local(rec.updated_at) >= observed_at:
+                # a repeated or late message, the record already has this or a newer result
+                skipped += 1
+                continue
+            num_result, text_result = validate_result(rec, row, choices)
+            if not observed_at and rec.updated_at and unchanged(rec, num_result, text_result, row.get('comment')):
+                # a resent result without a time, saving it again would only add a revision
+                skipped += 1
+                continue
+        except ResultError as e:
+            errors.append({'row': i, 'error': str(e)})
+            continue
+        if rec.id in latest:
+            # of two rows of a record the later one wins unless only the earlier one has a newer time
+            skipped += 1
+            previous_observed_at = latest[rec.id][1]
+            if previous_observed_at and (not observed_at or observed_at < previous_observed_at):
+                continue
+        latest[rec.id] = (rec, observed_at, num_result, text_result, row.get('comment'))
+    for rec, observed_at, num_result, text_result, comment in latest.values():
+        rec.num_result = num_result
+        rec.text_result = text_result
+        if comment:
+            rec.comment = comment
+        rec.updated_at = observed_at or now
+        rec.updater_id = user.id if user else None
+    flag_records([rec for rec, *_ in latest.values()])
+    db.session.commit()
+    return {'updated': len(latest), 'skipped': skipped, 'errors': errors}
+
+
+def unchanged(rec, num_result, text_result, comment):
+    return rec.num_result == num_result and (rec.text_result or None) == (text_result or None) \
+        and (not comment or comment == rec.comment)
+
+
+def parse_observed_at(value):
+    """The time the result was measured, rows with it are applied only when newer than the record."""
+    if not value:
+        return None
+    try:
+        # an ISO time without an offset is Bangkok time
+        observed_at = as_local(datetime.fromisoformat(str(value)))
+    except ValueError:
+        try:
+            observed_at = arrow.get(value).datetime
+        except (arrow.parser.ParserError, TypeError, ValueError):
+            raise ResultError(f'{value} is not a valid observed_at.')
+    return arrow.get(observed_at).to('Asia/Bangkok').datetime
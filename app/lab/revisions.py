@@ -0,0 +1,135 @@
+from datetime import timedelta
+from decimal import Decimal
+
+import arrow
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select, func, tuple_
+from sqlalchemy.orm import aliased
+from sqlalchemy_continuum import version_class, transaction_class
+
+from app import db
+from app.auth.models import User
+from .models import LabTest, LabTestRecord, LabVersionArchive
+
+RecordVersion = version_class(LabTestRecord)
+Transaction = transaction_class(LabTestRecord)
+Updater = aliased(User)
+
+OPERATIONS = {0: 'insert', 1: 'update', 2: 'delete'}
+
+# the fields of a record compared between its revisions
+RECORD_FIELDS = ('num_result', 'text_result', 'comment', 'flag', 'received_at', 'receiver_id',
+                 'updated_at', 'updater_id', 'cancelled', 'reject_record_id', 'test_id')
+
+COMPACTED_MODELS = (LabTestRecord, LabTest)
+
+CHUNK_SIZE = 5000
+
+
+def query_revisions(*criteria):
+    """Return the revisions of the records matching the criteria with the change of each, in one query.
+
+    The revisions of a record come in the order they were made and carry the
+    fields changed from the one before as {field: [old, new]}.
+    """
+    stmt = select(RecordVersion.id, RecordVersion.transaction_id, RecordVersion.operation_type,
+                  RecordVersion.order_id, Transaction.issued_at, LabTest.name.label('test_name'),
+                  (func.coalesce(Updater.firstname, '') + ' ' + func.coalesce(Updater.lastname, '')).label('updater'),
+                  *[getattr(RecordVersion, name) for name in RECORD_FIELDS]) \
+        .outerjoin(Transaction, RecordVersion.transaction_id == Transaction.id) \
+        .outerjoin(LabTest, RecordVersion.test_id == LabTest.id) \
+        .outerjoin(Updater, RecordVersion.updater_id == Updater.id) \
+        .where(*criteria) \
+        .order_by(RecordVersion.id, RecordVersion.transaction_id)
+    revisions = []
+    previous = {}
+    for row in db.session.execute(stmt):
+        revision = dict(row._mapping)
+        revision['operation'] = OPERATIONS.get(revision.pop('operation_type'))
+        before = previous.get(row.id, {})
+        revision['changes'] = {name: [before.get(name), revision[name]] for name in RECORD_FIELDS
+                               if before.get(name) != revision[name]}
+        previous[row.id] = revision
+        revisions.append(revision)
+    return revisions
+
+
+def order_revisions(order_id):
+    return query_revisions(RecordVersion.order_id == order_id)
+
+
+def record_revisions(record_id):
+    return query_revisions(RecordVersion.id == record_id)
+
+
+def to_json(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def compact(model, before, archive=True, chunk_size=CHUNK_SIZE):
+    """Move the revisions of a model that were superseded before a time out of its version table.
+
+    The current revision of every row is kept, so Continuum goes on writing
+    new revisions as before. With archive the moved revisions are kept in
+    lab_version_archives, otherwise they are deleted. Returns the number of
+    revisions moved.
+    """
+    table = version_class(model).__table__
+    transactions = transaction_class(model).__table__
+    # transaction ids grow with time, the first one of the cutoff bounds the superseded revisions
+    boundary = db.session.execute(select(func.min(transactions.c.id))
+                                  .where(transactions.c.issued_at >= before)).scalar()
+    if boundary is None:
+        boundary = (db.session.execute(select(func.max(transactions.c.id))).scalar() or 0) + 1
+    stmt = select(table, transactions.c.issued_at) \
+        .outerjoin(transactions, table.c.transaction_id == transactions.c.id) \
+        .where(table.c.end_transaction_id.isnot(None), table.c.end_transaction_id < boundary) \
+        .order_by(table.c.transaction_id, table.c.id) \
+        .limit(chunk_size)
+    now = arrow.now('Asia/Bangkok').datetime
+    moved = 0
+    while True:
+        rows = db.session.execute(stmt).all()
+        if not rows:
+            break
+        if archive:
+            db.session.bulk_insert_mappings(LabVersionArchive, [
+                {'table_name': table.name,
+                 'id': row.id,
+                 'transaction_id': row.transaction_id,
+                 'end_transaction_id': row.end_transaction_id,
+                 'operation_type': row.operation_type,
+                 'issued_at': row.issued_at,
+                 'data': {column.name: to_json(row._mapping[column]) for column in table.columns},
+                 'archived_at': now} for row in rows])
+        keys = [(row.id, row.transaction_id) for row in rows]
+        db.session.execute(table.delete().where(tuple_(table.c.id, table.c.transaction_id).in_(keys)))
+        db.session.commit()
+        moved += len(rows)
+        if len(rows) < chunk_size:
+            break
+    return moved
+
+
+revision_cli = AppGroup('revisions', help='Revision history of tests and test records.')
+
+
+@revision_cli.command('compact')
+@click.option('--days', type=int, help='Keep the revisions superseded within this many days, '
+                                       'REVISION_RETENTION_DAYS by default.')
+@click.option('--delete', is_flag=True, help='Delete the old revisions instead of archiving them.')
+@click.option('--chunk-size', default=CHUNK_SIZE, help='Revisions moved per transaction.')
+def compact_command(days, delete, chunk_size):
+    """Move old revisions out of the version tables."""
+    days = days if days is not None else current_app.config['REVISION_RETENTION_DAYS']
+    # Continuum stores naive UTC times in the transaction table
+    before = arrow.utcnow().naive - timedelta(days=days)
+    for model in COMPACTED_MODELS:
+        moved = compact(model, before, archive=not delete, chunk_size=chunk_size)
+        click.echo(f'{version_class(model).__table__.name}: {moved} revisions {"deleted" if delete else "archived"}')
@@ -0,0 +1,102 @@
+import re
+
+from sqlalchemy import func, or_, and_, case, literal
+
+from app import db
+from .models import LabCustomer
+from .utils import escape_like
+
+SEARCH_LIMIT = 20
+
+# the columns with a pg_trgm GIN index, see LabCustomer.__table_args__
+SEARCH_COLUMNS = ('firstname', 'lastname', 'hn', 'pid', 'tel')
+
+
+def normalize_query(query):
+    return re.sub(r'\s+', ' ', (query or '').strip())
+
+
+def search_customers(lab_id, query, limit=SEARCH_LIMIT):
+    """Return the customers of a lab matching the query, best matches first.
+
+    A query of two words is taken as a firstname and a lastname. On PostgreSQL
+    the filters and the ranking use pg_trgm so the GIN indexes are used, other
+    databases are searched with trigram_search().
+    """
+    query = normalize_query(query)
+    if not query:
+        return []
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return trigram_search(lab_id, query, limit)
+
+    words = query.split(' ')
+    if len(words) == 2:
+        firstname, lastname = words
+        condition = and_(LabCustomer.firstname.ilike(f'%{escape_like(firstname)}%', escape='\\'),
+                         LabCustomer.lastname.ilike(f'%{escape_like(lastname)}%', escape='\\'))
+        rank = func.similarity(LabCustomer.firstname, firstname) + func.similarity(LabCustomer.lastname, lastname)
+    else:
+        pattern = escape_like(query)
+        condition = or_(LabCustomer.firstname.ilike(f'%{pattern}%', escape='\\'),
+                        LabCustomer.lastname.ilike(f'%{pattern}%', escape='\\'),
+                        LabCustomer.firstname.op('%')(query),
+                        LabCustomer.lastname.op('%')(query),
+                        LabCustomer.hn.like(f'{pattern}%', escape='\\'),
+                        LabCustomer.pid.like(f'{pattern}%', escape='\\'),
+                        LabCustomer.tel.like(f'%{pattern}%', escape='\\'))
+        rank = func.greatest(func.similarity(LabCustomer.firstname, query),
+                             func.similarity(LabCustomer.lastname, query),
+                             func.similarity(LabCustomer.tel, query),
+                             case((LabCustomer.hn == query, literal(2.0)), else_=literal(0.0)),
+                             case((LabCustomer.pid == query, literal(2.0)), else_=literal(0.0)))
+    return LabCustomer.query.filter(LabCustomer.lab_id == lab_id, condition) \
+        .order_by(rank.desc(), LabCustomer.id) \
+        .limit(limit).all()
+
+
+def trigrams(text):
+    """Trigrams of the words of the text the way pg_trgm makes them."""
+    result = set()
+    # Thai vowel and tone marks are not \w in Python but are part of the word
+    for word in re.findall(r'[\w\u0e00-\u0e7f]+', (text or '').lower()):
+        word = f'  {word} '
+        result.update(word[i:i + 3] for i in range(len(word) - 2))
+    return result
+
+
+def similarity(a, b):
+    """pg_trgm similarity(): the shared trigrams over all trigrams of both strings."""
+    ta, tb = trigrams(a), trigrams(b)
+    if not ta or not tb:
+        return 0.0
+    return len(ta & tb) / len(ta | tb)
+
+
+def trigram_search(lab_id, query, limit=SEARCH_LIMIT, threshold=0.3):
+    """Rank the customers of a lab in Python for databases without pg_trgm.
+
+    Only the searched columns are loaded, so this is fine for tests and small
+    labs but it still reads every customer of the lab.
+    """
+    lowered = query.lower()
+    words = lowered.split(' ')
+    rows = db.session.query(LabCustomer.id, *[getattr(LabCustomer, c) for c in SEARCH_COLUMNS]) \
+        .filter(LabCustomer.lab_id == lab_id)
+    ranked = []
+    for id_, firstname, lastname, hn, pid, tel in rows:
+        firstname, lastname = (firstname or '').lower(), (lastname or '').lower()
+        if len(words) == 2:
+            if words[0] not in firstname or words[1] not in lastname:
+                continue
+            rank = similarity(firstname, words[0]) + similarity(lastname, words[1])
+        else:
+            rank = max(similarity(firstname, lowered), similarity(lastname, lowered), similarity(tel, lowered),
+                       2.0 if query in (hn, pid) else 0.0)
+            matched = rank >= threshold or lowered in firstname or lowered in lastname or \
+                (hn or '').startswith(query) or (pid or '').startswith(query) or query in (tel or '')
+            if not matched:
+                continue
+        ranked.append((-rank, id_))
+    ids = [id_ for _, id_ in sorted(ranked)[:limit]]
+    customers = {c.id: c for c in LabCustomer.query.filter(LabCustomer.id.in_(ids))}
+    return [customers[id_] for id_ in ids]
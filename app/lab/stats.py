@@ -0,0 +1,342 @@
+import bisect
+from collections import defaultdict
+from datetime import timedelta
+
+import arrow
+import click
+import sqlalchemy as sa
+from flask.cli import AppGroup
+from sqlalchemy import event, select, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from app import db
+from .models import LabTest, LabTestRecord, LabTestOrder, LabOrderRejectRecord, LabOrderPaymentRecord, \
+    LabDailyStats, LabDailyTestStats, LabDailyRejectionStats, LabDailyTATStats
+from .utils import as_local, local_date
+
+# upper bounds of the turnaround time buckets in minutes
+TAT_BUCKETS = [5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240, 360, 480, 720, 1080, 1440,
+               2160, 2880, 4320, 7200, 10080]
+
+TAT_PERCENTILES = (50, 90, 95)
+
+# the test_id of turnaround times of whole orders
+ORDER_TEST_ID = 0
+
+ROLLUP_KEYS = {
+    LabDailyStats: ('lab_id', 'day'),
+    LabDailyTestStats: ('lab_id', 'day', 'test_id'),
+    LabDailyRejectionStats: ('lab_id', 'day', 'reason'),
+    LabDailyTATStats: ('lab_id', 'day', 'metric', 'test_id', 'bucket'),
+}
+
+ROLLUP_VALUES = {
+    LabDailyStats: ('orders', 'approved', 'cancelled', 'revenue'),
+    LabDailyTestStats: ('ordered', 'received', 'reported', 'rejected'),
+    LabDailyRejectionStats: ('count',),
+    LabDailyTATStats: ('count',),
+}
+
+CHUNK_SIZE = 5000
+
+
+def tat_bucket(start, end):
+    minutes = (as_local(end) - as_local(start)).total_seconds() / 60
+    i = bisect.bisect_left(TAT_BUCKETS, minutes)
+    return TAT_BUCKETS[i] if i < len(TAT_BUCKETS) else -1
+
+
+# The rollups are the sums of what each record, order and payment contributes.
+# A change is counted by taking away what the old values contributed and
+# adding what the new values contribute, the backfill adds them all up.
+
+def record_contributions(deltas, sign, lab_id, test_id, ordered_at, received_at, updated_at,
+                         rejected_at, reason):
+    if not lab_id or not test_id:
+        return
+    if ordered_at:
+        deltas[LabDailyTestStats, (lab_id, local_date(ordered_at), test_id), 'ordered'] += sign
+    if received_at:
+        deltas[LabDailyTestStats, (lab_id, local_date(received_at), test_id), 'received'] += sign
+    if updated_at:
+        day = local_date(updated_at)
+        deltas[LabDailyTestStats, (lab_id, day, test_id), 'reported'] += sign
+        if received_at:
+            bucket = tat_bucket(received_at, updated_at)
+            deltas[LabDailyTATStats, (lab_id, day, 'report', test_id, bucket), 'count'] += sign
+    if rejected_at:
+        day = local_date(rejected_at)
+        deltas[LabDailyTestStats, (lab_id, day, test_id), 'rejected'] += sign
+        deltas[LabDailyRejectionStats, (lab_id, day, reason or ''), 'count'] += sign
+
+
+def order_contributions(deltas, sign, lab_id, ordered_at, approved_at, cancelled_at):
+    if not lab_id:
+        return
+    if ordered_at:
+        deltas[LabDailyStats, (lab_id, local_date(ordered_at)), 'orders'] += sign
+    if approved_at:
+        day = local_date(approved_at)
+        deltas[LabDailyStats, (lab_id, day), 'approved'] += sign
+        if ordered_at:
+            bucket = tat_bucket(ordered_at, approved_at)
+            deltas[LabDailyTATStats, (lab_id, day, 'approve', ORDER_TEST_ID, bucket), 'count'] += sign
+    if cancelled_at:
+        deltas[LabDailyStats, (lab_id, local_date(cancelled_at)), 'cancelled'] += sign
+
+
+def payment_contributions(deltas, sign, lab_id, paid_at, amount):
+    if lab_id and paid_at and amount:
+        deltas[LabDailyStats, (lab_id, local_date(paid_at)), 'revenue'] += sign * amount
+
+
+def write_deltas(connection, deltas):
+    """Add the deltas to the rollups with one upsert per table."""
+    rows = defaultdict(dict)
+    for (model, key, column), amount in deltas.items():
+        if not amount:
+            continue
+        row = rows[model].setdefault(key, dict(zip(ROLLUP_KEYS[model], key),
+                                               **{c: 0 for c in ROLLUP_VALUES[model]}))
+        row[column] += amount
+    for model, model_rows in rows.items():
+        table = model.__table__
+        insert = postgresql.insert if connection.dialect.name == 'postgresql' else sqlite.insert
+        stmt = insert(table).values(list(model_rows.values()))
+        stmt = stmt.on_conflict_do_update(index_elements=[table.c[k] for k in ROLLUP_KEYS[model]],
+                                          set_={c: table.c[c] + stmt.excluded[c] for c in ROLLUP_VALUES[model]})
+        connection.execute(stmt)
+
+
+def related_id(obj, name):
+    """The id of a many-to-one relation, also when only the object was assigned."""
+    value = getattr(obj, f'{name}_id')
+    if value is None:
+        related = getattr(obj, name)
+        value = related.id if related is not None else None
+    return value
+
+
+def attribute_values(obj, names, old):
+    """The current values of the attributes, or the values they had when loaded."""
+    state = sa.inspect(obj)
+    values = []
+    for name in names:
+        history = state.attrs[name].history
+        if old and history.deleted:
+            values.append(history.deleted[0])
+        elif old and history.added:
+            values.append(None)
+        else:
+            values.append(getattr(obj, name))
+    return values
+
+
+def collect_record(session, deltas, rec, sign, old):
+    order = rec.order or (session.get(LabTestOrder, rec.order_id) if rec.order_id else None)
+    if order is None:
+        return
+    received_at, updated_at, reject_record = attribute_values(rec, TRACKED[LabTestRecord], old)
+    record_contributions(deltas, sign, related_id(order, 'lab'), related_id(rec, 'test'), order.ordered_at,
+                         received_at, updated_at,
+                         reject_record.created_at if reject_record else None,
+                         reject_record.reason if reject_record else None)
+
+
+def collect_order(session, deltas, order, sign, old):
+    order_contributions(deltas, sign, related_id(order, 'lab'), *attribute_values(order, TRACKED[LabTestOrder], old))
+
+
+def collect_payment(session, deltas, payment, sign, old):
+    order = payment.order or (session.get(LabTestOrder, payment.order_id) if payment.order_id else None)
+    if order is None:
+        return
+    amount, paid_at, created_at = attribute_values(payment, TRACKED[LabOrderPaymentRecord], old)
+    payment_contributions(deltas, sign, related_id(order, 'lab'), paid_at or created_at, amount)
+
+
+TRACKED = {
+    LabTestRecord: ('received_at', 'updated_at', 'reject_record'),
+    LabTestOrder: ('ordered_at', 'approved_at', 'cancelled_at'),
+    LabOrderPaymentRecord: ('payment_amount', 'payment_datetime', 'created_at'),
+}
+
+COLLECTORS = {
+    LabTestRecord: collect_record,
+    LabTestOrder: collect_order,
+    LabOrderPaymentRecord: collect_payment,
+}
+
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    pass
+
+
+# load the old values before they are replaced, so the changes can be undone in the rollups
+for _model, _names in TRACKED.items():
+    for _name in _names:
+        event.listen(getattr(_model, _name), 'set', _keep_old_value, active_history=True)
+
+
+@event.listens_for(Session, 'before_flush')
+def collect_stats(session, flush_context, instances):
+    deltas = session.info.setdefault('stats_deltas', defaultdict(int))
+    for obj in session.new:
+        collector = COLLECTORS.get(type(obj))
+        if collector:
+            collector(session, deltas, obj, 1, old=False)
+    for obj in session.dirty:
+        collector = COLLECTORS.get(type(obj))
+        if collector and session.is_modified(obj):
+            collector(session, deltas, obj, -1, old=True)
+            collector(session, deltas, obj, 1, old=False)
+    for obj in session.deleted:
+        collector = COLLECTORS.get(type(obj))
+        if collector:
+            collector(session, deltas, obj, -1, old=True)
+
+
+@event.listens_for(Session, 'after_flush')
+def write_stats(session, flush_context):
+    deltas = session.info.pop('stats_deltas', None)
+    if deltas:
+        write_deltas(session.connection(), deltas)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_stats(session):
+    session.info.pop('stats_deltas', None)
+
+
+def backfill(lab_id=None, chunk_size=CHUNK_SIZE):
+    """Rebuild the rollups of a lab, or of all labs, from the records, orders and payments.
+
+    Changes made while it runs may be counted twice or not at all, so run it
+    when the lab is quiet.
+    """
+    deltas = defaultdict(int)
+    records = select(LabTestOrder.lab_id, LabTestRecord.test_id, LabTestOrder.ordered_at,
+                     LabTestRecord.received_at, LabTestRecord.updated_at,
+                     LabOrderRejectRecord.created_at, LabOrderRejectRecord.reason) \
+        .join(LabTestOrder, LabTestRecord.order_id == LabTestOrder.id) \
+        .outerjoin(LabOrderRejectRecord, LabTestRecord.reject_record_id == LabOrderRejectRecord.id)
+    orders = select(LabTestOrder.lab_id, LabTestOrder.ordered_at, LabTestOrder.approved_at, LabTestOrder.cancelled_at)
+    payments = select(LabTestOrder.lab_id,
+                      func.coalesce(LabOrderPaymentRecord.payment_datetime, LabOrderPaymentRecord.created_at),
+                      LabOrderPaymentRecord.payment_amount) \
+        .join(LabTestOrder, LabOrderPaymentRecord.order_id == LabTestOrder.id)
+    if lab_id:
+        records = records.where(LabTestOrder.lab_id == lab_id)
+        orders = orders.where(LabTestOrder.lab_id == lab_id)
+        payments = payments.where(LabTestOrder.lab_id == lab_id)
+    for stmt, contributions in ((records, record_contributions),
+                                (orders, order_contributions),
+                                (payments, payment_contributions)):
+        result = db.session.execute(stmt.execution_options(stream_results=True, max_row_buffer=chunk_size))
+        for rows in result.partitions(chunk_size):
+            for row in rows:
+                contributions(deltas, 1, *row)
+    for model in ROLLUP_KEYS:
+        query = model.query
+        if lab_id:
+            query = query.filter(model.lab_id == lab_id)
+        query.delete(synchronize_session=False)
+    write_deltas(db.session.connection(), deltas)
+    db.session.commit()
+    return len(deltas)
+
+
+def percentiles(buckets):
+    """Read the percentiles from the counts of the buckets as the upper bound of their bucket."""
+    total = sum(buckets.values())
+    result = {'count': total}
+    ordered = sorted(buckets.items(), key=lambda item: item[0] if item[0] >= 0 else float('inf'))
+    for p in TAT_PERCENTILES:
+        value = None
+        if total:
+            running = 0
+            for bucket, count in ordered:
+                running += count
+                if running >= total * p / 100:
+                    value = bucket
+                    break
+        result[f'p{p}'] = value
+    return result
+
+
+def lab_stats(lab_id, start=None, end=None):
+    """Read the statistics of a lab from the rollups for the days in [start, end)."""
+    end = end or arrow.now('Asia/Bangkok').shift(days=+1).date()
+    start = start or end - timedelta(days=30)
+
+    def in_range(model):
+        return model.lab_id == lab_id, model.day >= start, model.day < end
+
+    days = {row.day: {'day': row.day.isoformat(), 'orders': row.orders, 'approved': row.approved,
+                      'cancelled': row.cancelled, 'revenue': float(row.revenue),
+                      'received': 0, 'reported': 0, 'rejected': 0}
+            for row in LabDailyStats.query.filter(*in_range(LabDailyStats))}
+    test_days = db.session.query(LabDailyTestStats.day,
+                                 func.sum(LabDailyTestStats.received),
+                                 func.sum(LabDailyTestStats.reported),
+                                 func.sum(LabDailyTestStats.rejected)) \
+        .filter(*in_range(LabDailyTestStats)).group_by(LabDailyTestStats.day)
+    for day, received, reported, rejected in test_days:
+        row = days.setdefault(day, {'day': day.isoformat(), 'orders': 0, 'approved': 0, 'cancelled': 0,
+                                    'revenue': 0.0})
+        row.update(received=int(received), reported=int(reported), rejected=int(rejected))
+
+    buckets = defaultdict(lambda: defaultdict(int))
+    tat = db.session.query(LabDailyTATStats.metric, LabDailyTATStats.test_id, LabDailyTATStats.bucket,
+                           func.sum(LabDailyTATStats.count)) \
+        .filter(*in_range(LabDailyTATStats)) \
+        .group_by(LabDailyTATStats.metric, LabDailyTATStats.test_id, LabDailyTATStats.bucket)
+    for metric, test_id, bucket, count in tat:
+        buckets[metric, test_id][bucket] += int(count)
+        if metric == 'report':
+            buckets[metric, None][bucket] += int(count)
+
+    tests = db.session.query(LabTest.id, LabTest.code, LabTest.name,
+                             func.sum(LabDailyTestStats.ordered),
+                             func.sum(LabDailyTestStats.received),
+                             func.sum(LabDailyTestStats.reported),
+                             func.sum(LabDailyTestStats.rejected)) \
+        .join(LabDailyTestStats, LabDailyTestStats.test_id == LabTest.id) \
+        .filter(*in_range(LabDailyTestStats)) \
+        .group_by(LabTest.id, LabTest.code, LabTest.name) \
+        .order_by(LabTest.code)
+    rejections = db.session.query(LabDailyRejectionStats.reason, func.sum(LabDailyRejectionStats.count)) \
+        .filter(*in_range(LabDailyRejectionStats)) \
+        .group_by(LabDailyRejectionStats.reason) \
+        .order_by(func.sum(LabDailyRejectionStats.count).desc())
+
+    daily = [days[day] for day in sorted(days)]
+    totals = {key: sum(row[key] for row in daily)
+              for key in ('orders', 'approved', 'cancelled', 'revenue', 'received', 'reported', 'rejected')}
+    return {
+        'start': start.isoformat(),
+        'end': (end - timedelta(days=1)).isoformat(),
+        'totals': totals,
+        'days': daily,
+        'tests': [{'id': test_id, 'code': code, 'name': name, 'ordered': int(ordered), 'received': int(received),
+                   'reported': int(reported), 'rejected': int(rejected),
+                   'tat': percentiles(buckets['report', test_id])}
+                  for test_id, code, name, ordered, received, reported, rejected in tests],
+        'rejections': [{'reason': reason, 'count': int(count)} for reason, count in rejections if count],
+        'tat': {
+            'report': percentiles(buckets['report', None]),
+            'approve': percentiles(buckets['approve', ORDER_TEST_ID]),
+        },
+    }
+
+
+stats_cli = AppGroup('stats', help='Lab dashboard statistics.')
+
+
+@stats_cli.command('backfill')
+@click.option('--lab-id', type=int, help='Only rebuild the statistics of this lab.')
+def backfill_command(lab_id):
+    """Rebuild the daily statistics from the existing orders, records and payments."""
+    rows = backfill(lab_id=lab_id)
+    click.echo(f'{rows} statistics updated.')
@@ -0,0 +1,166 @@
+import time
+from datetime import timedelta
+
+import arrow
+import click
+import sqlalchemy as sa
+from flask.cli import AppGroup
+from sqlalchemy import event, select, or_
+from sqlalchemy.orm import Session
+
+from app import db
+from .models import LabTest, LabTestRecord, LabTestOrder, LabOverdueAlert, LabWatermark
+from .utils import as_local
+
+WATERMARK = 'tat-overdue'
+
+
+def deadline(received_at, tat_minutes):
+    if received_at is None or not tat_minutes:
+        return None
+    return as_local(received_at) + timedelta(minutes=tat_minutes)
+
+
+def pending():
+    return (LabTestRecord.updated_at.is_(None),
+            LabTestRecord.cancelled.isnot(True),
+            LabTestRecord.reject_record_id.is_(None))
+
+
+@event.listens_for(Session, 'before_flush')
+def schedule_records(session, flush_context, instances):
+    """Keep overdue_at of the records in step with received_at and the TAT target of their test."""
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, LabTestRecord):
+            state = sa.inspect(obj)
+            if obj in session.new or state.attrs.received_at.history.has_changes() \
+                    or state.attrs.test_id.history.has_changes() or state.attrs.test.history.has_changes():
+                test = obj.test or (session.get(LabTest, obj.test_id) if obj.test_id else None)
+                obj.overdue_at = deadline(obj.received_at, test.tat_minutes if test else None)
+                note_deadlines(session, [obj.overdue_at])
+        elif isinstance(obj, LabTest) and obj not in session.new \
+                and sa.inspect(obj).attrs.tat_minutes.history.has_changes():
+            session.info.setdefault('rescheduled_tests', {})[obj.id] = obj.tat_minutes
+
+
+@event.listens_for(Session, 'after_flush')
+def reschedule_records(session, flush_context):
+    """Move the deadlines of the pending records of tests whose target changed."""
+    tests = session.info.pop('rescheduled_tests', None)
+    if not tests:
+        return
+    connection = session.connection()
+    rows = connection.execute(select(LabTestRecord.id, LabTestRecord.test_id, LabTestRecord.received_at)
+                              .where(LabTestRecord.test_id.in_(tests),
+                                     LabTestRecord.received_at.isnot(None), *pending()))
+    updates = [{'record_id': id_, 'overdue_at': deadline(received_at, tests[test_id])}
+               for id_, test_id, received_at in rows]
+    if updates:
+        table = LabTestRecord.__table__
+        connection.execute(table.update().where(table.c.id == sa.bindparam('record_id'))
+                           .values(overdue_at=sa.bindparam('overdue_at')), updates)
+        note_deadlines(session, [update['overdue_at'] for update in updates])
+
+
+def note_deadlines(session, deadlines):
+    deadlines = [d for d in deadlines if d is not None]
+    if deadlines:
+        earliest = session.info.get('earliest_deadline')
+        session.info['earliest_deadline'] = min(deadlines + ([earliest] if earliest else []))
+
+
+@event.listens_for(Session, 'after_flush')
+def lower_watermark(session, flush_context):
+    """Move the watermark back to the earliest deadline set in the flush.
+
+    A record received with a time in the past or a test whose target was
+    shortened can have a deadline before the last run, it is picked up by the
+    next one this way.
+    """
+    earliest = session.info.pop('earliest_deadline', None)
+    if earliest is None:
+        return
+    table = LabWatermark.__table__
+    session.connection().execute(table.update()
+                                 .where(table.c.name == WATERMARK, table.c.value >= earliest)
+                                 .values(value=earliest - timedelta(microseconds=1)))
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_rescheduled(session):
+    session.info.pop('rescheduled_tests', None)
+    session.info.pop('earliest_deadline', None)
+
+
+def evaluate(now=None):
+    """Publish alerts for the records that passed their TAT target since the last run.
+
+    Only the records with an overdue_at after the watermark are read, so a run
+    costs the same however long the history is. Deadlines set before the
+    watermark move it back, see lower_watermark. A resolved alert of a record
+    that is overdue again is re-opened. Open alerts of records that were
+    reported, cancelled or rejected since are resolved.
+    Returns the numbers of published and resolved alerts.
+    """
+    now = now or arrow.now('Asia/Bangkok').datetime
+    watermark = db.session.get(LabWatermark, WATERMARK)
+    query = db.session.query(LabTestRecord.id, LabTestOrder.lab_id, LabTestRecord.overdue_at, LabOverdueAlert.id) \
+        .join(LabTestOrder, LabTestRecord.order_id == LabTestOrder.id) \
+        .outerjoin(LabOverdueAlert, LabOverdueAlert.record_id == LabTestRecord.id) \
+        .filter(LabTestRecord.overdue_at <= now, *pending(),
+                or_(LabOverdueAlert.id.is_(None), LabOverdueAlert.resolved_at.isnot(None)))
+    if watermark:
+        query = query.filter(LabTestRecord.overdue_at > as_local(watermark.value))
+    alerts = []
+    reopened = []
+    for record_id, lab_id, overdue_at, alert_id in query:
+        if alert_id:
+            reopened.append({'id': alert_id, 'overdue_at': overdue_at, 'created_at': now, 'resolved_at': None})
+        else:
+            alerts.append({'record_id': record_id, 'lab_id': lab_id, 'overdue_at': overdue_at, 'created_at': now})
+    if alerts:
+        db.session.bulk_insert_mappings(LabOverdueAlert, alerts)
+    if reopened:
+        db.session.bulk_update_mappings(LabOverdueAlert, reopened)
+
+    open_alerts = select(LabOverdueAlert.record_id).where(LabOverdueAlert.resolved_at.is_(None))
+    finished = select(LabTestRecord.id).where(LabTestRecord.id.in_(open_alerts),
+                                              or_(LabTestRecord.updated_at.isnot(None),
+                                                  LabTestRecord.cancelled.is_(True),
+                                                  LabTestRecord.reject_record_id.isnot(None),
+                                                  LabTestRecord.overdue_at.is_(None),
+                                                  LabTestRecord.overdue_at > now))
+    resolved = LabOverdueAlert.query.filter(LabOverdueAlert.resolved_at.is_(None),
+                                            LabOverdueAlert.record_id.in_(finished)) \
+        .update({'resolved_at': now}, synchronize_session=False)
+
+    if watermark:
+        # unless a deadline moved it back since it was read
+        table = LabWatermark.__table__
+        db.session.execute(table.update().where(table.c.name == WATERMARK, table.c.value == watermark.value)
+                           .values(value=now))
+    else:
+        db.session.add(LabWatermark(name=WATERMARK, value=now))
+    db.session.commit()
+    return len(alerts) + len(reopened), resolved
+
+
+def open_alerts(lab_id):
+    return LabOverdueAlert.query.filter(LabOverdueAlert.lab_id == lab_id, LabOverdueAlert.resolved_at.is_(None))
+
+
+tat_cli = AppGroup('tat', help='Turnaround time targets.')
+
+
+@tat_cli.command('evaluate')
+@click.option('--interval', default=60.0, help='Seconds between runs.')
+@click.option('--once', is_flag=True, help='Run once and exit.')
+def evaluate_command(interval, once):
+    """Publish and resolve overdue alerts, every minute unless --once is given."""
+    while True:
+        published, resolved = evaluate()
+        if published or resolved:
+            click.echo(f'{published} overdue, {resolved} resolved')
+        if once:
+            break
+        time.sleep(interval)
@@ -0,0 +1,59 @@
+import base64
+from datetime import datetime
+
+import arrow
+
+
+def parse_date_range(start, end, tz='Asia/Bangkok'):
+    """Convert the YYYY-MM-DD strings from a filter form into [start, end) datetimes.
+
+    The end date is inclusive for the user, so one day is added to it.
+    Invalid or missing values are returned as None.
+    """
+    try:
+        start_dt = arrow.get(start, 'YYYY-MM-DD', tzinfo=tz).datetime if start else None
+    except (arrow.parser.ParserError, ValueError):
+        start_dt = None
+    try:
+        end_dt = arrow.get(end, 'YYYY-MM-DD', tzinfo=tz).shift(days=+1).datetime if end else None
+    except (arrow.parser.ParserError, ValueError):
+        end_dt = None
+    return start_dt, end_dt
+
+
+def escape_like(text):
+    """Escape the LIKE wildcards in text, use it with escape='\\'."""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def as_local(value):
+    """Databases without time zone support return naive datetimes, they are Bangkok time."""
+    if value.tzinfo is None:
+        return arrow.get(value, tzinfo='Asia/Bangkok').datetime
+    return value
+
+
+def local_date(value):
+    """The date of a datetime in Bangkok, naive datetimes are Bangkok time already."""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return value.date()
+    return arrow.get(value).to('Asia/Bangkok').date()
+
+
+def encode_cursor(dt, id_):
+    """Encode the (datetime, id) of the last row of a page as an opaque URL-safe string."""
+    value = f'{dt.isoformat() if dt else ""}|{id_}'
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by encode_cursor, returns None for a missing or malformed cursor."""
+    if not cursor:
+        return None
+    try:
+        dt, id_ = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+        return (datetime.fromisoformat(dt) if dt else None), int(id_)
+    except (ValueError, UnicodeDecodeError):
+        return None
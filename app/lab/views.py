@@ -1,11 +1,8 @@
+import csv
 import random
-import textwrap
 
 import psycopg2
 import pytz
-from bahttext import bahttext
-from barcode import EAN13
-from barcode.writer import SVGWriter
 from io import BytesIO
 
 import numpy as np
@@ -14,21 +11,37 @@ from datetime import date
 import arrow
 import pandas as pd
 from faker import Faker
-from flask import render_template, url_for, request, flash, redirect, make_response, send_file, session, jsonify
+from flask import render_template, url_for, request, flash, redirect, make_response, send_file, session, jsonify, \
+    Response, stream_with_context, current_app, abort
 from flask_login import login_required, current_user
-from reportlab.lib import colors
-from reportlab.lib.enums import TA_RIGHT, TA_CENTER
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import mm
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.pdfgen import canvas
-from reportlab.platypus import Image, Paragraph, SimpleDocTemplate, TableStyle, Table, KeepTogether, Spacer
-from sqlalchemy import func, or_, and_
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import joinedload, contains_eager
 
 from . import lab_blueprint as lab
 from .forms import *
 from .models import *
+from .exports import RESULT_COLUMNS, DEFAULT_RESULT_COLUMNS, iter_result_rows, generate_csv, write_xlsx, \
+    format_value
+from .flowaccount import enqueue_invoice, share_document, FlowAccountError
+from .pdf import generate_receipt_pdf, generate_receipts_pdf, generate_report_pdf, report_context, render_reports, \
+    merge_pdfs, zip_reports
+from .labels import get_order_labels, render_barcode, parse_specimen_code
+from . import search
+from .apikeys import api_auth_required
+from .results import parse_result_rows, apply_results, ResultError
+from .analyzers import import_stream
+from .ranges import flag_records
+from .stats import lab_stats
+from .tat import open_alerts
+from .activities import query_activities
+from .catalogue import catalogue, catalogue_with
+from .revisions import order_revisions, record_revisions
+from .rejections import REJECTION_GROUPS, REJECTION_COLUMNS, paginate_rejections, count_rejections, \
+    iter_rejection_rows
+from .customers import AGE_BANDS, paginate_customers
+from .orders import OrderItemError, expand_order_items, add_order_records, diff_order_items, load_order_for_display, \
+    preload_orders
+from .utils import parse_date_range, encode_cursor, decode_cursor
 from app.main.models import UserLabAffil
 from collections import namedtuple, defaultdict
 
@@ -36,8 +49,6 @@ from ..auth.models import UserCheckinRecord
 
 from dotenv import load_dotenv
 import requests
-import json
-import os
 
 load_dotenv()
 
@@ -49,44 +60,6 @@ TestOrder = namedtuple('TestOrder', ['order', 'ordered_at', 'type', 'approved_at
 
 fake = Faker(['th-TH'])
 
-import openapi_client
-from openapi_client.rest import ApiException
-from pprint import pprint
-
-configuration = openapi_client.Configuration(
-    host=os.getenv('FA_URL')
-)
-
-def get_access_token():
-
-
-
-    url = f"{configuration.host}/token?Content-Type=application/x-www-form-urlencoded"
-
-    client_id = os.getenv('FA_CLIENT_ID')
-    client_secret = os.getenv('FA_CLIENT_SECRET')
-    grant_type = os.getenv('FA_GRANT_TYPE')
-    scope = os.getenv('FA_SCOPE')
-
-
-
-    payload = (
-        f"client_id={client_id}&"
-        f"client_secret={client_secret}&"
-        f"grant_type={grant_type}&"
-        f"scope={scope}"
-    )
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    response = requests.post(url, headers=headers, data=payload)
-    if response.status_code == 200:
-        token_data = response.json()
-        return token_data["access_token"]
-    else:
-        raise Exception(f"Failed to get access token: {response.text}")
-
-
 
 @lab.route('/<int:lab_id>')
 @login_required
@@ -97,7 +70,7 @@ def landing(lab_id):
         return redirect(url_for('main.index'))
     lab = Laboratory.query.get(lab_id)
     session['lab_id'] = lab_id
-    return render_template('lab/index.html', lab=lab)
+    return render_template('lab/index.html', lab=lab, today=arrow.now('Asia/Bangkok').date().isoformat())
 
 
 @lab.route('/labs', methods=['GET', 'POST'])
@@ -132,7 +105,7 @@ def edit_lab(lab_id=None):
 @login_required
 def list_tests(lab_id):
     lab = Laboratory.query.get(lab_id)
-    return render_template('lab/test_list.html', lab=lab)
+    return render_template('lab/test_list.html', lab=lab, catalogue=catalogue(lab_id))
 
 
 @lab.route('/<int:lab_id>/choice_sets')
@@ -399,7 +372,40 @@ def remove_quan_test(lab_id, test_id):
 @login_required
 def list_patients(lab_id):
     lab = Laboratory.query.get(lab_id)
-    return render_template('lab/customer_list.html', lab=lab)
+    return render_template('lab/customer_list.html', lab=lab, age_bands=AGE_BANDS)
+
+
+@lab.route('/api/labs/<int:lab_id>/customers')
+@login_required
+def get_customers(lab_id):
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', 50, type=int), 200)
+    sort = request.args.get('sort', 'hn')
+    descending = request.args.get('order') == 'desc'
+    filters = {
+        'hn': request.args.get('hn', '').strip(),
+        'name': request.args.get('name', '').strip(),
+        'gender': request.args.get('gender'),
+        'age_band': request.args.get('age_band'),
+    }
+    pagination, counts = paginate_customers(lab_id, page=page, per_page=per_page,
+                                            sort=sort, descending=descending, **filters)
+    if request.headers.get('HX-Request') == 'true':
+        return render_template('lab/partials/customer_rows.html',
+                               customers=pagination.items,
+                               counts=counts,
+                               pagination=pagination,
+                               sort=sort,
+                               descending=descending,
+                               lab_id=lab_id)
+    data = []
+    for customer in pagination.items:
+        item = customer.to_dict()
+        item['hn'] = customer.hn
+        item['tel'] = customer.tel
+        item['pending_orders'], item['total_orders'] = counts.get(customer.id, (0, 0))
+        data.append(item)
+    return jsonify(data=data, page=pagination.page, pages=pagination.pages, total=pagination.total)
 
 
 def add_customer_items_from_select(fieldname, model, attribute, attrname, lab_id):
@@ -464,7 +470,7 @@ def add_patient(lab_id, customer_id=None):
                 flash('Customer info has been updated.', 'success')
             else:
                 flash('New customer has been added.', 'success')
-            return render_template('lab/customer_list.html', lab=lab)
+            return render_template('lab/customer_list.html', lab=lab, age_bands=AGE_BANDS)
         else:
             flash(f'Failed to add a new customer. {form.errors}', 'danger')
     return render_template('lab/new_customer.html', form=form, lab_id=lab_id, customer=customer)
@@ -519,6 +525,8 @@ def add_random_patients(lab_id):
                 title=title,
                 lab=lab
             )
+            customer_.generate_hn()
+            db.session.add(customer_)
         # activity = LabActivity(
         #     lab_id=lab_id,
         #     actor=current_user,
@@ -541,26 +549,22 @@ def add_test_order(lab_id, customer_id, order_id=None):
     lab = Laboratory.query.get(lab_id)
     referrer = request.args.get('back')
     selected_test_ids = []
-    selected_profile_ids = []
+    selected_profile_ids = set()
+    selected_package_ids = set()
+    active_records = []
     order = None
     if order_id:
         order = LabTestOrder.query.get(order_id)
-        selected_test_ids = [record.test.id for record in order.active_test_records if not record.profile_id]
-        selected_profile_ids = [record.profile_id for record in order.active_test_records]
+        active_records = order.active_test_records
+        selected_test_ids = [rec.test_id for rec in active_records if not rec.profile_id and not rec.package_id]
+        selected_profile_ids = {rec.profile_id for rec in active_records if rec.profile_id and not rec.package_id}
+        selected_package_ids = {rec.package_id for rec in active_records if rec.package_id}
     if request.method == 'DELETE':
         order.cancelled_at = arrow.now('Asia/Bangkok').datetime
         for rec in order.test_records:
             rec.cancelled = True
             db.session.add(rec)
-        # activity = LabActivity(
-        #     lab_id=lab_id,
-        #     actor=current_user,
-        #     message='Cancelled an order.',
-        #     detail=order.id,
-        #     added_at=arrow.now('Asia/Bangkok').datetime
-        # )
         db.session.add(order)
-        # db.session.add(activity)
         db.session.commit()
         resp = make_response()
         resp.headers['HX-Refresh'] = 'true'
@@ -570,7 +574,11 @@ def add_test_order(lab_id, customer_id, order_id=None):
         test_ids = [int(_id) for _id in form.getlist('test_ids')]
         profile_ids = [int(_id) for _id in form.getlist('profile_ids')]
         package_ids = [int(_id) for _id in form.getlist('package_ids')]
-        selected_test_ids = set(test_ids)
+        try:
+            items = expand_order_items(lab_id, test_ids, profile_ids, package_ids)
+        except OrderItemError as e:
+            flash(str(e), 'danger')
+            return redirect(request.url)
         if not order_id:
             order = LabTestOrder(
                 lab_id=lab_id,
@@ -578,45 +586,17 @@ def add_test_order(lab_id, customer_id, order_id=None):
                 ordered_at=arrow.now('Asia/Bangkok').datetime,
                 ordered_by=current_user,
                 code=LabTestOrder.generate_code(),
-                test_records=[LabTestRecord(test_id=tid) for tid in test_ids],
             )
-            for profile_id in profile_ids:
-                profile = LabTestProfile.query.get(profile_id)
-                order.test_records = order.test_records.all() + [LabTestRecord(test_id=test.id, profile_id=profile_id)
-                                                                 for test in profile.tests if test.id not in selected_test_ids]
-                selected_test_ids.update([t.id for t in profile.tests])
-            for package_id in package_ids:
-                package = LabServicePackage.query.get(package_id)
-                order.test_records = order.test_records.all() + [LabTestRecord(test_id=t.id, package_id=package.id)
-                                                                 for t in package.tests if t.id not in selected_test_ids]
-                selected_test_ids.update([t.id for t in package.tests])
-                for pp in package.profiles:
-                    order.test_records = order.test_records.all()\
-                                         + [LabTestRecord(test_id=test.id, profile_id=pp.id, package_id=package_id)
-                                            for test in pp.tests if test.id not in selected_test_ids]
-                    selected_test_ids.update([t.id for t in pp.tests])
+            db.session.add(order)
+            db.session.flush()
+            add_order_records(order, items)
             flash('New order has been added.', 'success')
         else:
-            # TODO: refactor this part for better performance
-            for test_id in test_ids:
-                if test_id not in selected_test_ids:
-                    order.test_records.append(LabTestRecord(test_id=test_id))
-            for test_id in selected_test_ids:
-                test_record = LabTestRecord.query.filter_by(test_id=test_id, order_id=order_id).first()
-                if test_id not in test_ids:
-                    test_record.cancelled = True
-                    db.session.add(test_record)
-            for profile_id in profile_ids:
-                if profile_id not in selected_profile_ids:
-                    profile = LabTestProfile.query.get(profile_id)
-                    order.test_records = order.test_records.all() + [LabTestRecord(test_id=test.id,
-                                                                                   profile_id=profile_id)
-                                                                     for test in profile.tests]
-            for selected_profile_id in selected_profile_ids:
-                if selected_profile_id not in profile_ids:
-                    for test_record in order.test_records.filter_by(profile_id=selected_profile_id):
-                        test_record.cancelled = True
-                        db.session.add(test_record)
+            added, cancelled = diff_order_items(active_records, items)
+            # the flush sends the cancellations as one batched UPDATE
+            for rec in cancelled:
+                rec.cancelled = True
+            add_order_records(order, added)
             flash('The order has been updated.', 'success')
 
         db.session.add(order)
@@ -626,53 +606,58 @@ def add_test_order(lab_id, customer_id, order_id=None):
     return render_template('lab/new_test_order.html',
                            referrer=referrer,
                            lab=lab,
+                           catalogue=catalogue(lab_id),
                            order=order,
                            customer_id=customer_id,
                            selected_profile_ids=selected_profile_ids,
+                           selected_package_ids=selected_package_ids,
                            selected_test_ids=selected_test_ids)
 
 
 @lab.route('/orders/<int:order_id>/barcode')
 @login_required
 def print_order_barcode(order_id):
-    order = LabTestOrder.query.get(order_id)
-    containers = defaultdict(int)
-    container_counts = defaultdict(int)
-    barcodes = []
-    for record in order.active_test_records:
-        for sc in record.test.specimen_container_items:
-            code = f'{order.code}{sc.specimen_container.number:02}{container_counts[sc.specimen_container.container]}'
-            if containers[code] + sc.volume < sc.specimen_container.max_volume:
-                containers[code] += sc.volume
-            else:
-                container_counts[sc.specimen_container] += 1
-                code = f'{order.code}{sc.specimen_container.number:02}{container_counts[sc.specimen_container.container]}'
-                containers[code] += sc.volume
-    for code in containers:
-        rv = BytesIO()
-        _text = f'{code} {order.ordered_at.strftime("%m/%d/%Y")}'
-        EAN13(code, writer=SVGWriter()).write(rv, {'module_height': 8.0, 'module_width': 0.3}, text=_text)
-        barcodes.append((order, rv.getvalue().decode('utf-8')))
-
-    docdef = {
-        'pageSize': {'width': 200, 'height': 200},
-        'pageMargins': [0, 0, 0, 0],
-        'pageOrientation': 'portrait',
-        'content': [
-            {'text': 'HN09099900'},
-            {'text': 'Jane Doe'},
-            {'text': '2/12/2024 10:34:45'}
-        ]
-    }
+    order = LabTestOrder.query.get_or_404(order_id)
+    return render_template('lab/order_barcode.html',
+                           labels=get_order_labels([order]),
+                           render_barcode=render_barcode)
+
+
+@lab.route('/labs/<int:lab_id>/barcodes')
+@login_required
+def print_orders_barcode(lab_id):
+    order_ids = [int(_id) for _id in request.args.getlist('order_ids')]
+    orders = LabTestOrder.query.filter(LabTestOrder.lab_id == lab_id, LabTestOrder.id.in_(order_ids)) \
+        .options(joinedload(LabTestOrder.customer)) \
+        .order_by(LabTestOrder.ordered_at).all()
     return render_template('lab/order_barcode.html',
-                           barcodes=barcodes, order=order, docdef=docdef)
+                           labels=get_order_labels(orders),
+                           render_barcode=render_barcode)
+
+
+@lab.route('/barcodes/<payload>')
+@login_required
+def get_barcode_image(payload):
+    fmt = 'png' if request.args.get('format') == 'png' else 'svg'
+    if not parse_specimen_code(payload):
+        return jsonify({"success": False, "error": "Invalid specimen code."}), 400
+    symbology = 'code128' if '-' in payload else 'ean13'
+    resp = make_response(render_barcode(payload, symbology, fmt))
+    resp.headers['Content-Type'] = 'image/png' if fmt == 'png' else 'image/svg+xml'
+    resp.headers['Cache-Control'] = 'private, max-age=86400'
+    return resp
 
 
 @lab.route('/<int:lab_id>/patients/<int:customer_id>/auto-orders', methods=['POST'])
 @login_required
 def auto_add_test_order(lab_id, customer_id):
     lab = Laboratory.query.get(lab_id)
-    num_tests = LabTest.query.count()
+    num_tests = LabTest.query.filter_by(lab_id=lab_id).count()
+    if not num_tests:
+        flash('The lab has no tests to order.', 'warning')
+        resp = make_response()
+        resp.headers['HX-Refresh'] = 'true'
+        return resp
     random_minutes = random.randint(0, 60)
     order_datetime = arrow.now('Asia/Bangkok').shift(minutes=+random_minutes)
     max_datetime = order_datetime
@@ -726,6 +711,7 @@ def auto_add_test_order(lab_id, customer_id):
         random_minutes = random.randint(1, 60)
         approve_datetime = max_datetime.shift(minutes=+random_minutes)
         order = LabTestOrder(
+            code=LabTestOrder.generate_code(),
             lab_id=lab_id,
             customer_id=customer_id,
             ordered_at=order_datetime.datetime,
@@ -750,26 +736,104 @@ def auto_add_test_order(lab_id, customer_id):
         return resp
 
 
+ORDER_STATUSES = ('pending', 'approved', 'cancelled')
+
+
 @lab.route('/<int:lab_id>/orders', methods=['GET', 'POST'])
 @login_required
 def list_test_orders(lab_id):
     lab = Laboratory.query.get(lab_id)
-    return render_template('lab/test_order_list.html', lab=lab)
+    return render_template('lab/test_order_list.html', lab=lab, statuses=ORDER_STATUSES)
+
+
+@lab.route('/labs/<int:lab_id>/dashboard')
+@login_required
+def show_dashboard(lab_id):
+    lab = Laboratory.query.get(lab_id)
+    return render_template('lab/dashboard.html', lab=lab)
+
+
+@lab.route('/api/labs/<int:lab_id>/stats')
+@login_required
+def get_lab_stats(lab_id):
+    """Return the statistics of the last 30 days or of the start and end dates from the rollups.
+
+    Responds with the dashboard panels for HTMX requests and with JSON otherwise.
+    """
+    start, end = parse_date_range(request.args.get('start'), request.args.get('end'))
+    stats = lab_stats(lab_id, start=start.date() if start else None, end=end.date() if end else None)
+    if request.headers.get('HX-Request') == 'true':
+        if request.args.get('panel') == 'totals':
+            return render_template('lab/partials/dashboard_totals.html', stats=stats)
+        return render_template('lab/partials/dashboard_stats.html', stats=stats)
+    return jsonify(stats)
+
+
+@lab.route('/api/labs/<int:lab_id>/orders')
+@login_required
+def get_test_orders(lab_id):
+    """Return a page of orders using keyset pagination on (ordered_at DESC, id DESC).
+
+    Responds with table rows for HTMX requests and with JSON otherwise.
+    """
+    per_page = min(request.args.get('per_page', 50, type=int), 200)
+    status = request.args.get('status')
+    customer_id = request.args.get('customer_id', type=int)
+    hn = request.args.get('hn')
+    start, end = parse_date_range(request.args.get('start'), request.args.get('end'))
+    cursor = decode_cursor(request.args.get('cursor'))
+
+    query = LabTestOrder.query.filter(LabTestOrder.lab_id == lab_id,
+                                      LabTestOrder.ordered_at.isnot(None)) \
+        .options(joinedload(LabTestOrder.customer), joinedload(LabTestOrder.ordered_by))
+    if status == 'pending':
+        query = query.filter(LabTestOrder.approved_at.is_(None), LabTestOrder.cancelled_at.is_(None))
+    elif status == 'approved':
+        query = query.filter(LabTestOrder.approved_at.isnot(None))
+    elif status == 'cancelled':
+        query = query.filter(LabTestOrder.cancelled_at.isnot(None))
+    if customer_id:
+        query = query.filter(LabTestOrder.customer_id == customer_id)
+    if hn:
+        query = query.filter(LabTestOrder.customer_id.in_(
+            db.session.query(LabCustomer.id).filter_by(lab_id=lab_id, hn=hn)))
+    if start:
+        query = query.filter(LabTestOrder.ordered_at >= start)
+    if end:
+        query = query.filter(LabTestOrder.ordered_at < end)
+    if cursor:
+        query = query.filter(tuple_(LabTestOrder.ordered_at, LabTestOrder.id) < cursor)
+
+    # fetch one extra row to know whether there is a next page
+    orders = query.order_by(LabTestOrder.ordered_at.desc(), LabTestOrder.id.desc()).limit(per_page + 1).all()
+    next_cursor = None
+    if len(orders) > per_page:
+        orders = orders[:per_page]
+        next_cursor = encode_cursor(orders[-1].ordered_at, orders[-1].id)
+
+    if request.headers.get('HX-Request') == 'true':
+        next_url = None
+        if next_cursor:
+            args = request.args.to_dict()
+            args['cursor'] = next_cursor
+            next_url = url_for('lab.get_test_orders', lab_id=lab_id, **args)
+        return render_template('lab/partials/test_order_rows.html', orders=orders, next_url=next_url)
+    data = []
+    for order in orders:
+        item = order.to_dict()
+        item['code'] = order.code
+        item['cancel_datetime'] = order.cancelled_at.strftime('%Y-%m-%d %H:%M:%S') if order.cancelled_at else None
+        item['customer'] = order.customer.fullname if order.customer else None
+        item['hn'] = order.customer.hn if order.customer else None
+        data.append(item)
+    return jsonify(data=data, next_cursor=next_cursor)
 
 
 @lab.route('/records/<int:record_id>/cancel', methods=['POST'])
 @login_required
 def cancel_test_record(record_id):
     record = LabTestRecord.query.get(record_id)
-    # activity = LabActivity(
-    #     lab_id=record.order.lab_id,
-    #     actor=current_user,
-    #     message='Cancelled the test order.',
-    #     detail=record.id,
-    #     added_at=arrow.now('Asia/Bangkok').datetime
-    # )
     record.cancelled = True
-    # db.session.add(activity)
     db.session.commit()
     flash('The test has been cancelled.', 'success')
 
@@ -789,19 +853,11 @@ def reject_test_order(record_id):
             new_record = LabOrderRejectRecord()
             form.populate_obj(new_record)
             new_record.created_at = arrow.now('Asia/Bangkok').datetime
-            new_record.creator = current_user
+            new_record.creator_id = current_user.id
             record.reject_record = new_record
             record.cancelled = True
             db.session.add(record)
             db.session.add(new_record)
-            # activity = LabActivity(
-            #     lab_id=record.order.lab_id,
-            #     actor=current_user,
-            #     message='Rejected and cancelled the test order.',
-            #     detail=record.id,
-            #     added_at=arrow.now('Asia/Bangkok').datetime
-            # )
-            # db.session.add(activity)
             db.session.commit()
             flash('The test has been rejected.', 'success')
             return redirect(url_for('lab.show_customer_test_records', customer_id=record.order.customer.id,
@@ -818,14 +874,6 @@ def receive_test_order(record_id):
     record.received_at = arrow.now('Asia/Bangkok').datetime
     record.receiver = current_user
     db.session.add(record)
-    # activity = LabActivity(
-    #     lab_id=record.order.lab_id,
-    #     actor=current_user,
-    #     message='Received the test.',
-    #     detail=record.id,
-    #     added_at=arrow.now('Asia/Bangkok').datetime
-    # )
-    # db.session.add(activity)
     db.session.commit()
     flash('The order has been received.', 'success')
     return redirect(url_for('lab.show_customer_test_records',
@@ -854,6 +902,59 @@ def list_pending_orders(lab_id):
     return render_template('lab/pending_orders.html', lab=lab)
 
 
+@lab.route('/api/labs/<int:lab_id>/pending-records')
+@login_required
+def get_pending_records(lab_id):
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', 50, type=int), 200)
+    overdue = request.args.get('overdue') == 'true'
+    query = LabTestRecord.query_pending(lab_id)
+    if overdue:
+        query = query.join(LabOverdueAlert, LabOverdueAlert.record_id == LabTestRecord.id) \
+            .filter(LabOverdueAlert.resolved_at.is_(None))
+    pagination = query \
+        .options(contains_eager(LabTestRecord.order).joinedload(LabTestOrder.customer),
+                 contains_eager(LabTestRecord.order).joinedload(LabTestOrder.ordered_by),
+                 joinedload(LabTestRecord.test)) \
+        .order_by(LabTestOrder.ordered_at, LabTestOrder.id, LabTestRecord.id) \
+        .paginate(page=page, per_page=per_page, error_out=False)
+    # records come sorted by order, so consecutive records belong together
+    groups = []
+    for record in pagination.items:
+        if not groups or groups[-1][0] is not record.order:
+            groups.append((record.order, []))
+        groups[-1][1].append(record)
+    if request.headers.get('HX-Request') == 'true':
+        return render_template('lab/partials/pending_records.html',
+                               groups=groups, pagination=pagination, lab_id=lab_id, overdue=overdue)
+    data = []
+    for order, records in groups:
+        item = order.to_dict()
+        item['code'] = order.code
+        item['records'] = [rec.to_dict() for rec in records]
+        data.append(item)
+    return jsonify(data=data, page=pagination.page, pages=pagination.pages, total=pagination.total)
+
+
+@lab.route('/api/labs/<int:lab_id>/pending-records/count')
+@login_required
+def count_pending_records(lab_id):
+    count = LabTestRecord.query_pending(lab_id).with_entities(func.count(LabTestRecord.id)).scalar()
+    if request.headers.get('HX-Request') == 'true':
+        return f'<span class="tag is-rounded is-danger">{count}</span>' if count else ''
+    return jsonify(count=count)
+
+
+@lab.route('/api/labs/<int:lab_id>/overdue-records/count')
+@login_required
+def count_overdue_records(lab_id):
+    """The number of open overdue alerts, published by flask tat evaluate."""
+    count = open_alerts(lab_id).with_entities(func.count(LabOverdueAlert.id)).scalar()
+    if request.headers.get('HX-Request') == 'true':
+        return f'<span class="tag is-rounded is-warning">{count} overdue</span>' if count else ''
+    return jsonify(count=count)
+
+
 @lab.route('/<int:lab_id>/activities')
 @login_required
 def list_activities(lab_id):
@@ -861,6 +962,31 @@ def list_activities(lab_id):
     return render_template('lab/log.html', lab=lab)
 
 
+@lab.route('/api/labs/<int:lab_id>/activities')
+@login_required
+def get_activities(lab_id):
+    """Return a page of activities using keyset pagination on (added_at DESC, id DESC).
+
+    Responds with table rows for HTMX requests and with JSON otherwise.
+    """
+    per_page = min(request.args.get('per_page', 50, type=int), 200)
+    # fetch one extra row to know whether there is a next page
+    activities = query_activities(lab_id, cursor=decode_cursor(request.args.get('cursor')), limit=per_page + 1)
+    next_cursor = None
+    if len(activities) > per_page:
+        activities = activities[:per_page]
+        next_cursor = encode_cursor(activities[-1].added_at, activities[-1].id)
+
+    if request.headers.get('HX-Request') == 'true':
+        next_url = None
+        if next_cursor:
+            args = request.args.to_dict()
+            args['cursor'] = next_cursor
+            next_url = url_for('lab.get_activities', lab_id=lab_id, **args)
+        return render_template('lab/partials/activity_rows.html', activities=activities, next_url=next_url)
+    return jsonify(data=[activity.to_dict() for activity in activities], next_cursor=next_cursor)
+
+
 @lab.route('/customers/<int:customer_id>/records')
 @login_required
 def show_customer_records(customer_id):
@@ -881,7 +1007,7 @@ def show_customer_profile(lab_id, customer_id):
 @lab.route('/orders/<int:order_id>/records')
 @login_required
 def show_customer_test_records(order_id):
-    order = LabTestOrder.query.get(order_id)
+    order = load_order_for_display(order_id)
     customer = order.customer
     if request.headers.get('HX-Request') == 'true':
         return render_template('lab/partials/customer_test_records.html', order=order)
@@ -891,7 +1017,7 @@ def show_customer_test_records(order_id):
 @lab.route('/orders/<int:order_id>/invoice-items')
 @login_required
 def show_invoice_items(order_id):
-    order = LabTestOrder.query.get(order_id)
+    order = load_order_for_display(order_id)
     return render_template('lab/partials/invoice_items.html', order=order)
 
 
@@ -904,8 +1030,14 @@ def finish_test_record(order_id, record_id):
         flash('The order or the test record no longer exists.', 'danger')
         return redirect(request.referrer)
 
-    LabTestRecordForm = create_lab_test_record_form(rec.test, default=rec.text_result)
+    lab_catalogue = catalogue_with(order.lab_id, tests=[rec.test_id])
+    test = lab_catalogue.tests.get(rec.test_id)
+    if not test:
+        flash('The test of the record no longer exists.', 'danger')
+        return redirect(request.referrer or url_for('lab.show_customer_test_records', order_id=order_id))
+    LabTestRecordForm = create_lab_test_record_form(test)
     form = LabTestRecordForm(obj=rec)
+    set_result_choices(form, lab_catalogue.choices(test.choice_set_id), default=rec.text_result)
 
     if request.method == 'POST':
         if form.validate_on_submit():
@@ -914,22 +1046,47 @@ def finish_test_record(order_id, record_id):
             rec.updater = current_user
             if form.choice_set.data:
                 rec.text_result = form.choice_set.data.result
-            # activity = LabActivity(
-            #     lab_id=order.lab_id,
-            #     actor=current_user,
-            #     message='Added the result for a test record.',
-            #     detail=rec.id,
-            #     added_at=arrow.now('Asia/Bangkok').datetime
-            # )
             order.finished_at = arrow.now('Asia/Bangkok').datetime
+            flag_records([rec])
             db.session.add(rec)
-            # db.session.add(activity)
             db.session.commit()
             flash('New result record has been saved.', 'success')
             return redirect(url_for('lab.show_customer_test_records', order_id=order_id, customer_id=order.customer.id))
         else:
             flash(form.errors, 'danger')
-    return render_template('lab/new_test_record.html', form=form, order=order, rec=rec)
+    return render_template('lab/new_test_record.html', form=form, order=order, rec=rec, test=test)
+
+
+@lab.route('/api/labs/<int:lab_id>/results', methods=['POST'])
+@api_auth_required
+def add_results(lab_id, user):
+    """Save results for many records at once from JSON or a CSV upload.
+
+    Clients authenticate with an API key of the lab, see app.lab.apikeys.
+    """
+    try:
+        if 'file' in request.files:
+            rows = parse_result_rows(request.files['file'].read(), 'text/csv')
+        elif request.is_json:
+            rows = parse_result_rows(request.get_json(), request.mimetype)
+        else:
+            rows = parse_result_rows(request.get_data(), request.mimetype)
+    except (ResultError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    summary = apply_results(lab_id, rows, user)
+    return jsonify(success=not summary['errors'], **summary)
+
+
+@lab.route('/api/labs/<int:lab_id>/analyzer-results', methods=['POST'])
+@api_auth_required
+def import_analyzer_results(lab_id, user):
+    """Import an ASTM or HL7 result file, uploaded or sent as the request body.
+
+    Analyzer bridges authenticate with an API key of the lab, see app.lab.apikeys.
+    """
+    stream = request.files['file'].stream if 'file' in request.files else request.stream
+    summary = import_stream(lab_id, stream, user=user)
+    return jsonify(success=not summary['error_count'], **summary)
 
 
 @lab.route('/orders/<int:order_id>/approve', methods=['GET', 'PATCH'])
@@ -940,14 +1097,6 @@ def approve_test_order(order_id):
         if order.approved_at:
             order.approved_at = None
             order.approver = None
-            # activity = LabActivity(
-            #     lab_id=order.lab_id,
-            #     actor=current_user,
-            #     message='Cancelled the approval for an order',
-            #     detail=order.id,
-            #     added_at=arrow.now('Asia/Bangkok').datetime
-            # )
-            # db.session.add(activity)
     else:
         order.approved_at = arrow.now('Asia/Bangkok').datetime
         order.approver = current_user
@@ -963,19 +1112,63 @@ def approve_test_order(order_id):
 @login_required
 def list_rejected_orders(lab_id):
     lab = Laboratory.query.get(lab_id)
-    records = []
-    for order in lab.test_orders:
-        for record in order.test_records:
-            if record.reject_record:
-                records.append(record)
-    return render_template('lab/reject_records.html', records=records, lab=lab)
+    return render_template('lab/reject_records.html', lab=lab, groups=REJECTION_GROUPS)
+
+
+@lab.route('/api/labs/<int:lab_id>/rejections')
+@login_required
+def get_rejections(lab_id):
+    """Return a page of the rejected records and their counts by the group in the date range.
+
+    Responds with the report for HTMX requests, CSV with format=csv and JSON otherwise.
+    """
+    start, end = parse_date_range(request.args.get('start'), request.args.get('end'))
+    if request.args.get('format') == 'csv':
+        chunks = iter_rejection_rows(lab_id, start=start, end=end)
+        resp = Response(stream_with_context(generate_csv(list(REJECTION_COLUMNS), chunks)), mimetype='text/csv')
+        resp.headers['Content-Disposition'] = 'attachment; filename=rejections.csv'
+        return resp
+    group = request.args.get('group', 'reason')
+    if group not in REJECTION_GROUPS:
+        group = 'reason'
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', 50, type=int), 200)
+    pagination = paginate_rejections(lab_id, start=start, end=end, page=page, per_page=per_page)
+    counts = count_rejections(lab_id, group=group, start=start, end=end)
+    if request.headers.get('HX-Request') == 'true':
+        args = request.args.to_dict()
+        args.pop('page', None)
+        return render_template('lab/partials/reject_rows.html', records=pagination.items, pagination=pagination,
+                               counts=counts, group=group, lab_id=lab_id, args=args)
+    return jsonify(counts=[{'group': label, 'count': count} for label, count in counts],
+                   page=pagination.page,
+                   pages=pagination.pages,
+                   total=pagination.total,
+                   records=[dict(rec.to_dict(),
+                                 order_code=rec.order.code,
+                                 reject_record=rec.reject_record.to_dict()) for rec in pagination.items])
 
 
 @lab.route('/records/<int:record_id>/revisions')
 @login_required
 def test_record_revisions(record_id):
     record = LabTestRecord.query.get(record_id)
-    return render_template('lab/test_revisions.html', record=record)
+    return render_template('lab/test_revisions.html', record=record, revisions=record_revisions(record_id))
+
+
+@lab.route('/api/orders/<int:order_id>/revisions')
+@login_required
+def get_order_revisions(order_id):
+    """Return who changed what in the records of an order, read in one query."""
+    return jsonify(data=[{'record_id': rev['id'],
+                          'transaction_id': rev['transaction_id'],
+                          'issued_at': format_value(rev['issued_at']),
+                          'operation': rev['operation'],
+                          'test': rev['test_name'],
+                          'updater': rev['updater'].strip() or None,
+                          'changes': {name: [format_value(old), format_value(new)]
+                                      for name, (old, new) in rev['changes'].items()}}
+                         for rev in order_revisions(order_id)])
 
 
 @lab.route('/labs/<int:lab_id>/data-export', methods=['GET'])
@@ -992,18 +1185,17 @@ def export_data(lab_id):
     }
     if table:
         if table == 'results':
-            data = []
-            lab = Laboratory.query.get(lab_id)
-            for order in lab.test_orders:
-                for rec in order.test_records:
-                    data.append(rec.to_dict())
-            df = pd.DataFrame(data)
-            output = BytesIO()
-            writer = pd.ExcelWriter(output, engine='xlsxwriter')
-            df.to_excel(writer, index=False)
-            writer.close()
-            output.seek(0)
-            return send_file(output, download_name=f'{table}.xlsx')
+            columns = [c for c in request.args.getlist('columns') if c in RESULT_COLUMNS] or DEFAULT_RESULT_COLUMNS
+            start, end = parse_date_range(request.args.get('start'), request.args.get('end'))
+            chunks = iter_result_rows(lab_id, columns=columns, start=start, end=end)
+            export_format = request.args.get('format', 'xlsx')
+            if export_format in ('csv', 'csv.gz'):
+                compress = export_format == 'csv.gz'
+                resp = Response(stream_with_context(generate_csv(columns, chunks, compress=compress)),
+                                mimetype='application/gzip' if compress else 'text/csv')
+                resp.headers['Content-Disposition'] = f'attachment; filename={table}.{export_format}'
+                return resp
+            return send_file(write_xlsx(columns, chunks), download_name=f'{table}.xlsx', as_attachment=True)
         else:
             model = models[table]
             if table == 'reject_records':
@@ -1018,7 +1210,8 @@ def export_data(lab_id):
             output.seek(0)
             return send_file(output, download_name=f'{table}.xlsx')
 
-    return render_template('lab/data_export.html', lab_id=lab_id)
+    return render_template('lab/data_export.html', lab_id=lab_id,
+                           result_columns=RESULT_COLUMNS, default_result_columns=DEFAULT_RESULT_COLUMNS)
 
 
 @lab.route('/payments/<int:order_id>/edit', methods=['GET', 'POST'])
@@ -1032,12 +1225,8 @@ def edit_payment_record(order_id):
         if form.validate_on_submit():
             if order.payment:
                 record = order.payment
-                print("Load Payment Record")
-
             else:
                 record = LabOrderPaymentRecord()
-                print("Enter Payment Record")
-
             form.populate_obj(record)
 
             record.created_at = arrow.now('Asia/Bangkok').datetime
@@ -1100,30 +1289,9 @@ def edit_payment_record(order_id):
             }
 
 
-            access_token = f"Bearer {get_access_token()}"
-
-            access_url = f"{configuration.host}/cash-invoices/with-payment"
-            headers = {
-                "Authorization": f"{access_token}",
-                "Content-Type": "application/json"
-            }
-
-            response = requests.post(access_url, headers=headers, data=json.dumps(invoice))
-
-            document_id = 0
-
-            if response.status_code == 200:
-                api_response = response.json()
-                print({"success": True, "data": api_response})
-                document_id = api_response['data']['documentId']
-                receipt_no = api_response['data']['documentSerial']
-
-
-            else:
-                print({"success": False, "error": response.text}, response.status_code)
-
-            record.receipt_id = document_id
             db.session.add(record)
+            # the receipt is issued in FlowAccount by the invoice worker
+            enqueue_invoice(record, invoice)
             db.session.commit()
 
             flash('Payment record has been saved.', 'success')
@@ -1141,345 +1309,104 @@ def edit_payment_record(order_id):
 @lab.route('/receipt/<int:order_id>/preview', methods=['GET', 'POST'])
 @login_required
 def receipt_view(order_id):
-    order = LabTestOrder.query.get(order_id)
+    order = load_order_for_display(order_id)
     record = order.payment
-
-
-    document = {
-         "documentId" : record.receipt_id
-    }
-
-    access_token = f"Bearer {get_access_token()}"
-
-    access_url = f"{configuration.host}/cash-invoices/sharedocument"
-    headers = {
-        "Authorization": f"{access_token}",
-        "Content-Type": "application/json"
-    }
-
-
-    response = requests.post(access_url, headers=headers, data=json.dumps(document))
-
-
-    if response.status_code == 200:
-        api_response = response.json()
-        link = api_response['data']['link']
-        return jsonify({"success": True, "link": link})
-    else:
-        return jsonify({"success": False, "error": response.text}), response.status_code
-
+    if not record or not record.receipt_id:
+        return jsonify({"success": False, "error": "The receipt has not been issued yet."}), 404
+    try:
+        link = share_document(record.receipt_id)
+    except (FlowAccountError, requests.RequestException) as e:
+        return jsonify({"success": False, "error": str(e)}), 502
+    return jsonify({"success": True, "link": link})
 
 
 @lab.route('/reports/<int:order_id>/preview', methods=['GET', 'POST'])
 @login_required
 def preview_report(order_id):
-    order = LabTestOrder.query.get(order_id)
+    order = load_order_for_display(order_id)
     return render_template('lab/lab_report_preview.html', order=order)
 
 
 @lab.route('/reports/<int:order_id>/print', methods=['GET', 'POST'])
 @login_required
 def print_report(order_id):
-    order = LabTestOrder.query.get(order_id)
+    order = load_order_for_display(order_id)
     return render_template('lab/lab_report_print.html', order=order)
 
 
-@lab.route('/requests/<int:order_id>/preview', methods=['GET', 'POST'])
+@lab.route('/reports/<int:order_id>/pdf')
 @login_required
-def preview_request(order_id):
-    order = LabTestOrder.query.get(order_id)
-    return render_template('lab/lab_request_preview.html', order=order)
-
-
-sarabun_font = TTFont('Sarabun', 'app/static/fonts/THSarabunNew.ttf')
-pdfmetrics.registerFont(sarabun_font)
-style_sheet = getSampleStyleSheet()
-style_sheet.add(ParagraphStyle(name='ThaiStyle', fontName='Sarabun'))
-style_sheet.add(ParagraphStyle(name='ThaiStyleNumber', fontName='Sarabun', alignment=TA_RIGHT))
-style_sheet.add(ParagraphStyle(name='ThaiStyleCenter', fontName='Sarabun', alignment=TA_CENTER))
-style_sheet.add(ParagraphStyle(name='ThaiStyleRight', fontName='Sarabun', alignment=TA_RIGHT))
-
-bangkok = pytz.timezone('Asia/Bangkok')
+def export_report_pdf(order_id):
+    order = load_order_for_display(order_id)
+    if not order:
+        abort(404)
+    return send_file(generate_report_pdf(order), mimetype='application/pdf', download_name=f'{order.code}.pdf')
 
 
-def generate_receipt_pdf(order, sign=False, cancel=False):
-    logo = Image('app/static/img/ONELAB-01-mini.png', width=200)
-
-    this_lab = Laboratory.query.get(session.get('lab_id'))
+@lab.route('/labs/<int:lab_id>/reports/batch')
+@login_required
+def export_reports_pdf(lab_id):
+    start, end = parse_date_range(request.args.get('start'), request.args.get('end'))
+    fmt = request.args.get('format', 'pdf')
+    query = LabTestOrder.query.filter(LabTestOrder.lab_id == lab_id,
+                                      LabTestOrder.approved_at != None,
+                                      LabTestOrder.cancelled_at == None) \
+        .options(joinedload(LabTestOrder.customer),
+                 joinedload(LabTestOrder.lab),
+                 joinedload(LabTestOrder.approver),
+                 joinedload(LabTestOrder.physical_exam))
+    if start:
+        query = query.filter(LabTestOrder.approved_at >= start)
+    if end:
+        query = query.filter(LabTestOrder.approved_at < end)
+    orders = query.order_by(LabTestOrder.approved_at).all()
+    if not orders:
+        return jsonify({"success": False, "error": "No approved orders were found."}), 404
+    # load the records of all orders at once instead of one query per order
+    records = defaultdict(list)
+    for rec in LabTestRecord.query.filter(LabTestRecord.order_id.in_([order.id for order in orders]),
+                                          LabTestRecord.cancelled.isnot(True),
+                                          LabTestRecord.reject_record_id == None) \
+            .options(joinedload(LabTestRecord.test), joinedload(LabTestRecord.updater)) \
+            .order_by(LabTestRecord.id):
+        records[rec.order_id].append(rec)
+    contexts = [report_context(order, records[order.id]) for order in orders]
+    documents = render_reports(contexts, processes=current_app.config.get('REPORT_PROCESSES'),
+                               threshold=current_app.config.get('REPORT_POOL_THRESHOLD', 20))
+    if fmt == 'zip':
+        return send_file(zip_reports([f'{order.code}.pdf' for order in orders], documents),
+                         mimetype='application/zip', download_name='reports.zip')
+    return send_file(merge_pdfs(documents), mimetype='application/pdf', download_name='reports.pdf')
 
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer,
-                            rightMargin=20,
-                            leftMargin=20,
-                            topMargin=180,
-                            bottomMargin=10,
-                            )
-    receipt_number = order.code
-    data = []
-    affiliation = f'''<para align=center><font size=28>
-            {this_lab.name}
-            </font></para>
-            '''
-    address = f'''<br/><br/><br/><br/><font size=10>
-            ที่อยู่ / Address <br/>
-            {this_lab.address}<br/><br/>
-            เลขประจำตัวผู้เสียภาษี / TAX ID<br/>
-            {this_lab.tax_id}
-            </font>
-            '''
-
-    receipt_info = '''<br/><br/><br/><br/><font size=10>
-            เลขที่ / NO. {receipt_number}<br/>
-            วันที่ / DATE {issued_date}<br/>
-            ออกโดย / ISSUER {issuer}<br/><br/>
-            พิมพ์เมื่อ / PRINT TIME {issue_datetime}<br/>
-            </font>
-            '''
-    issued_date = arrow.get(order.payment.created_at.astimezone(bangkok)).format(fmt='DD MMMM YYYY HH:mm:ss',
-                                                                                 locale='th-th')
-    receipt_info_ori = receipt_info.format(receipt_number=receipt_number,
-                                           issued_date=issued_date,
-                                           issuer=current_user,
-                                           issue_datetime=datetime.now().astimezone(bangkok).strftime(
-                                               '%d/%m/%Y %H:%M:%S')
-                                           )
-
-    header_content_ori = [[Paragraph(address, style=style_sheet['ThaiStyle']),
-                           [logo],
-                           Paragraph(receipt_info_ori, style=style_sheet['ThaiStyle'])]]
-
-    header_styles = TableStyle([
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-    ])
-
-    header_ori = Table(header_content_ori, colWidths=[130, 240, 150])
-
-    header_ori.hAlign = 'CENTER'
-    header_ori.setStyle(header_styles)
-
-    customer_name = '''<para><font size=11>
-    ได้รับเงินจาก / PAYER {issued_for}<br/>
-    ที่อยู่ / ADDRESS<br/>{address}
-    </font></para>
-    '''.format(issued_for=order.customer.fullname,
-               address='<br/>'.join(textwrap.wrap(order.customer.address, width=100)))
-    customer = Paragraph(customer_name, style=style_sheet['ThaiStyle'])
-    items = [[Paragraph('<font size=14>ลำดับ / No.</font>', style=style_sheet['ThaiStyleCenter']),
-              Paragraph('<font size=14>รายการ / Description</font>', style=style_sheet['ThaiStyleCenter']),
-              Paragraph('<font size=14>รวม / Total</font>', style=style_sheet['ThaiStyleCenter']),
-              ]]
-    total = 0
-    number_test = 0
-    total_profile_price = 0
-    total_special_price = 0
-    # if receipt.print_profile_note:
-    #     profile_tests = [t for t in receipt.record.ordered_tests if t.profile]
-    #     if profile_tests:
-    #         if receipt.print_profile_how == 'consolidated':
-    #             number_test += 1
-    #             profile_price = profile_tests[0].profile.quote
-    #             if profile_price > 0:
-    #                 item = [
-    #                     Paragraph('<font size=12>{}</font>'.format(number_test), style=style_sheet['ThaiStyleCenter']),
-    #                     Paragraph('<font size=12>การตรวจสุขภาพทางห้องปฏิบัติการ / Laboratory Tests</font>',
-    #                               style=style_sheet['ThaiStyle']),
-    #                     Paragraph('<font size=12>{:,.2f}</font>'.format(profile_price),
-    #                               style=style_sheet['ThaiStyleNumber']),
-    #                     Paragraph('<font size=12>-</font>', style=style_sheet['ThaiStyleCenter']),
-    #                     Paragraph('<font size=12>{:,.2f}</font>'.format(profile_price),
-    #                               style=style_sheet['ThaiStyleNumber']),
-    #                     ]
-    #                 items.append(item)
-    #                 total_profile_price += profile_price
-    #                 total += profile_price
-    #             else:
-    #                 for t in receipt.record.ordered_tests:
-    #                     if t.profile:
-    #                         total_profile_price += t.price
-    #                         total += t.price
-    #                 item = [Paragraph('<font size=12>{}</font>'.format(number_test),
-    #                                   style=style_sheet['ThaiStyleCenter']),
-    #                         Paragraph('<font size=12>การตรวจสุขภาพทางห้องปฏิบัติการ / Laboratory Tests</font>',
-    #                                   style=style_sheet['ThaiStyle']),
-    #                         Paragraph('<font size=12>{:,.2f}</font>'.format(total_profile_price),
-    #                                   style=style_sheet['ThaiStyleNumber']),
-    #                         Paragraph('<font size=12>-</font>', style=style_sheet['ThaiStyleCenter']),
-    #                         Paragraph('<font size=12>{:,.2f}</font>'.format(total_profile_price),
-    #                                   style=style_sheet['ThaiStyleNumber']),
-    #                         ]
-    #                 items.append(item)
-    for t in order.active_test_records:
-        price = t.test.price
-        total += price
-        number_test += 1
-        item = [Paragraph('<font size=14>{}</font>'.format(number_test), style=style_sheet['ThaiStyleCenter']),
-                Paragraph('<font size=14>{} ({})</font>'
-                          .format(t.test.name, t.test.detail or '-'),
-                          style=style_sheet['ThaiStyle']),
-                Paragraph('<font size=14>{:,.2f}</font>'.format(price), style=style_sheet['ThaiStyleNumber'])]
-        items.append(item)
-
-    total_thai = bahttext(total)
-    total_text = "รวมเงินทั้งสิ้น {}".format(total_thai)
-    items.append([
-        Paragraph('<font size=14></font>', style=style_sheet['ThaiStyle']),
-        Paragraph('<font size=14></font>', style=style_sheet['ThaiStyle']),
-        Paragraph('<font size=14></font>', style=style_sheet['ThaiStyle']),
-    ])
-    items.append([
-        Paragraph('<font size=14>{}</font>'.format(total_text), style=style_sheet['ThaiStyle']),
-        Paragraph('<font size=14></font>', style=style_sheet['ThaiStyle']),
-        Paragraph('<font size=14>{:,.2f}</font>'.format(total), style=style_sheet['ThaiStyleNumber'])
-    ])
-    item_table = Table(items, colWidths=[50, 350, 70], repeatRows=1, cornerRadii=(5, 5, 5, 5))
-    item_table.setStyle(TableStyle([
-        ('BOX', (0, 0), (-1, 0), 0.25, colors.black),
-        ('BOX', (0, -1), (-1, -1), 0.25, colors.black),
-        ('BOX', (0, 0), (0, -1), 0.25, colors.black),
-        ('BOX', (1, 0), (1, -1), 0.25, colors.black),
-        ('BOX', (2, 0), (2, -1), 0.25, colors.black),
-        # ('BOX', (0, 0), (2, 32), 0.25, colors.black),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 10),
-        ('BOTTOMPADDING', (0, -1), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, -2), (-1, -2), 10),
-    ]))
-    item_table.setStyle([('VALIGN', (0, 0), (-1, -1), 'MIDDLE')])
-    item_table.setStyle([('SPAN', (0, -1), (1, -1))])
-
-    if order.payment.payment_method == 'Cash':
-        payment_info = Paragraph('<font size=14>ชำระเงินด้วย / PAYMENT METHOD: เงินสด / CASH</font>',
-                                 style=style_sheet['ThaiStyleRight'])
-    elif order.payment.payment_method == 'QR':
-        payment_info = Paragraph('<font size=14>ชำระเงินด้วย / PAYMENT METHOD: QR / QR</font>',
-                                 style=style_sheet['ThaiStyleRight'])
-    elif order.payment.payment_method == 'Credit Card':
-        payment_info = Paragraph(
-            '<font size=14>ชำระเงินด้วย / PAYMENT METHOD บัตรเครดิต / CREDIT CARD: หมายเลข / NUMBER {}-****-****-{}</font>'.format(
-                order.payment.card_number[:4], order.payment.card_number[-4:]),
-            style=style_sheet['ThaiStyleRight'])
-    else:
-        payment_info = Paragraph('<font size=14>ยังไม่ชำระเงิน / UNPAID</font>', style=style_sheet['ThaiStyleRight'])
-
-    sign_text = Paragraph(
-        '<br/><br/><br/><br/><font size=14>...................................<br/>({})<br/><br/>ผู้รับเงิน / CASHIER<br/></font>'.format(
-            order.payment.creator.fullname),
-        style=style_sheet['ThaiStyleCenter'])
-    total_content = [
-        [
-            payment_info,
-        ],
-        [
-            Paragraph(
-                f"<font size=14>เมื่อ / Date Time {order.payment.payment_datetime.strftime('%d/%m/%Y %H:%M:%S')}</font>",
-                style=style_sheet['ThaiStyleRight']),
-        ],
-        [
-            sign_text
-        ]
-    ]
-
-    total_table = Table(total_content, colWidths=[400])
-
-    def first_page_setup(canvas, doc):
-        canvas.saveState()
-        # Head
-        header = header_ori
-        w, h = header.wrap(doc.width, doc.topMargin)
-        header.drawOn(canvas, doc.leftMargin + 28, doc.height + doc.topMargin - h)
-
-        subheader1 = Paragraph('<para align=center><font size=16>ใบเสร็จรับเงิน / RECEIPT<br/><br/></font></para>',
-                               style=style_sheet['ThaiStyle'])
-        w, h = subheader1.wrap(doc.width, doc.topMargin)
-        subheader1.drawOn(canvas, doc.leftMargin, doc.height + doc.topMargin - h * 5.5)
-
-        subheader2 = customer
-        w, h = subheader2.wrap(doc.width, doc.topMargin)
-        subheader2.drawOn(canvas, doc.leftMargin + 48, doc.height + doc.topMargin - h * 4.5)
-
-        # logo_image = ImageReader('app/static/img/mu-watermark.png')
-        # canvas.drawImage(logo_image, 140, 265, mask='auto')
-        canvas.restoreState()
-
-    def later_pages_setup(canvas, doc):
-        canvas.saveState()
-        header = header_ori
-        w, h = header.wrap(doc.width, doc.topMargin)
-        header.drawOn(canvas, doc.leftMargin + 28, doc.height + doc.topMargin - h)
-
-        subheader1 = Paragraph('<para align=center><font size=16>ใบเสร็จรับเงิน / RECEIPT<br/><br/></font></para>',
-                               style=style_sheet['ThaiStyle'])
-        w, h = subheader1.wrap(doc.width, doc.topMargin)
-        subheader1.drawOn(canvas, doc.leftMargin, doc.height + doc.topMargin - h * 5.5)
-
-        subheader2 = customer
-        w, h = subheader2.wrap(doc.width, doc.topMargin)
-        subheader2.drawOn(canvas, doc.leftMargin + 48, doc.height + doc.topMargin - h * 4.5)
-        # logo_image = ImageReader('app/static/img/mu-watermark.png')
-        # canvas.drawImage(logo_image, 140, 265, mask='auto')
-        canvas.restoreState()
-
-    data.append(KeepTogether(item_table))
-    data.append(KeepTogether(Spacer(1, 12)))
-    data.append(KeepTogether(total_table))
-
-    doc.build(data, onFirstPage=first_page_setup, onLaterPages=later_pages_setup, canvasmaker=PageNumCanvas)
-    buffer.seek(0)
-    return buffer
-
-
-class PageNumCanvas(canvas.Canvas):
-    """
-    http://code.activestate.com/recipes/546511-page-x-of-y-with-reportlab/
-    http://code.activestate.com/recipes/576832/
-    """
 
-    # ----------------------------------------------------------------------
-    def __init__(self, *args, **kwargs):
-        """Constructor"""
-        canvas.Canvas.__init__(self, *args, **kwargs)
-        self.pages = []
-
-    # ----------------------------------------------------------------------
-    def showPage(self):
-        """
-        On a page break, add information to the list
-        """
-        self.pages.append(dict(self.__dict__))
-        self._startPage()
-
-    # ----------------------------------------------------------------------
-    def save(self):
-        """
-        Add the page number to each page (page x of y)
-        """
-        page_count = len(self.pages)
-
-        for page in self.pages:
-            self.__dict__.update(page)
-            self.draw_page_number(page_count)
-            canvas.Canvas.showPage(self)
-
-        canvas.Canvas.save(self)
-
-    # ----------------------------------------------------------------------
-    def draw_page_number(self, page_count):
-        """
-        Add the page number
-        """
-        page = "%s/%s" % (self._pageNumber, page_count)
-        self.setFont("Sarabun", 12)
-        self.drawRightString(195 * mm, 290 * mm, page)
+@lab.route('/requests/<int:order_id>/preview', methods=['GET', 'POST'])
+@login_required
+def preview_request(order_id):
+    order = LabTestOrder.query.get(order_id)
+    return render_template('lab/lab_request_preview.html', order=order)
 
 
 @lab.route('/orders/<int:order_id>/payment-export')
 @login_required
 def export_receipt_pdf(order_id):
-    order = LabTestOrder.query.get(order_id)
+    order = load_order_for_display(order_id)
     receipt = generate_receipt_pdf(order)
     return send_file(receipt, mimetype='application/pdf')
 
 
+@lab.route('/labs/<int:lab_id>/receipts/batch')
+@login_required
+def export_receipts_pdf(lab_id):
+    order_ids = [int(_id) for _id in request.args.getlist('order_ids')]
+    orders = LabTestOrder.query.filter(LabTestOrder.lab_id == lab_id, LabTestOrder.id.in_(order_ids)) \
+        .options(joinedload(LabTestOrder.customer), joinedload(LabTestOrder.lab)) \
+        .order_by(LabTestOrder.ordered_at).all()
+    preload_orders(orders)
+    if not any(order.payment for order in orders):
+        return jsonify({"success": False, "error": "No paid orders were selected."}), 404
+    return send_file(generate_receipts_pdf(orders), mimetype='application/pdf', download_name='receipts.pdf')
+
+
 @lab.route('/labs/<int:lab_id>/geo-checkin', methods=['GET', 'POST'])
 @login_required
 def geo_checkin(lab_id):
@@ -1577,41 +1504,38 @@ def add_test_profile(lab_id, profile_id=None):
 @login_required
 def edit_test_profile_record(order_id, profile_id):
     order = LabTestOrder.query.get(order_id)
-    profile = LabTestProfile.query.get(profile_id)
-    LabTestProfileRecordForm = create_lab_test_profile_record_form(profile.test_order)
-    code_names = profile.test_order.split(',')
+    if not order:
+        abort(404)
+    lab_catalogue = catalogue_with(order.lab_id, profiles=[profile_id])
+    profile = lab_catalogue.profiles.get(profile_id)
+    if not profile:
+        abort(404)
+    tests = lab_catalogue.profile_tests(profile)
+    LabTestProfileRecordForm = create_lab_test_profile_record_form(profile, tests)
+    code_names = [code for code in profile_codes(profile) if code in tests]
+    records = {rec.test_id: rec for rec in LabTestRecord.query.filter_by(order_id=order_id, profile_id=profile_id)}
     form = LabTestProfileRecordForm()
-    if request.method == 'GET':
-        for field in form:
-            if field.name not in code_names:
-                continue
-            test = LabTest.query.filter_by(code=field.name).first()
-            _record = LabTestRecord.query.filter_by(test_id=test.id,
-                                                    order_id=order_id,
-                                                    profile_id=profile_id).first()
-            if _record:
-                if _record.test.choice_set:
-                    for c in _record.test.choice_set.choice_items:
-                        if c.result == _record.text_result:
-                            field.choice_set.data = c
-                    field.text_result.data = ""
-                else:
-                    field.text_result.data = _record.text_result
-                field.num_result.data = _record.num_result
-                field.comment.data = _record.comment
+    for code in code_names:
+        test = tests[code]
+        _record = records.get(test.id)
+        field = form[code]
+        set_result_choices(field, lab_catalogue.choices(test.choice_set_id),
+                           default=_record.text_result if _record and test.choice_set_id else None)
+        if request.method == 'GET' and _record:
+            if not test.choice_set_id:
+                field.text_result.data = _record.text_result
+            field.num_result.data = _record.num_result
+            field.comment.data = _record.comment
 
     if form.validate_on_submit():
-        for field in form:
-            if field.name not in code_names:
-                continue
-            test = LabTest.query.filter_by(code=field.name).first()
-            _record = LabTestRecord.query.filter_by(test_id=test.id,
-                                                    order_id=order_id,
-                                                    profile_id=profile_id).first()
+        saved = []
+        for code in code_names:
+            test = tests[code]
+            field = form[code]
+            _record = records.get(test.id)
             if not _record:
-                _record = LabTestRecord(order=order_id, profile_id=profile_id, test_id=test.id)
-
-            print(field.name, field.numeric.data)
+                _record = LabTestRecord(order_id=order_id, profile_id=profile_id, test_id=test.id)
+            saved.append(_record)
 
             if field.numeric.data:
                 _record.num_result = field.num_result.data
@@ -1624,6 +1548,7 @@ def edit_test_profile_record(order_id, profile_id):
             _record.updated_at = arrow.now('Asia/Bangkok').datetime
             _record.updater = current_user
             db.session.add(_record)
+        flag_records(saved)
         db.session.commit()
         flash("Results have been saved.", "success")
         return redirect(url_for('lab.show_customer_test_records', order_id=order_id))
@@ -1728,29 +1653,14 @@ def edit_profiles_service_package(package_id=None):
 
 
 @lab.route('/api/customers/search')
+@login_required
 def search_customers():
-    query = request.args.get('query')
-    customers = []
-    if query:
-        try:
-            firstname, lastname = query.split(' ')
-        except ValueError:
-            customers += LabCustomer.query.filter(or_(
-                LabCustomer.firstname.like(f"%{query}%"),
-                LabCustomer.lastname.like(f"%{query}%"),
-                LabCustomer.hn.like(f"%{query}"),
-            )).all()
-        else:
-            customers += LabCustomer.query.filter(and_(
-                LabCustomer.firstname.like(f'%{firstname}%'),
-                LabCustomer.lastname.like(f'%{lastname}%')
-            )).all()
-    template = ''
-    for customer in customers:
-        url = url_for('lab.show_customer_records', customer_id=customer.id)
-        template += f'<tr><td>{customer.hn}</td><td>{customer.firstname} {customer.lastname}</td><td><a href="{url}" class="button is-rounded is-info"><span class="icon"><i class="fas fa-info-circle"></i></span><span>Info</span></a></td>'
-
-    return template
+    lab_id = request.args.get('lab_id', type=int) or session.get('lab_id')
+    affil = UserLabAffil.query.filter_by(lab_id=lab_id, user_id=current_user.id).first()
+    if not affil or not affil.approved:
+        abort(403)
+    customers = search.search_customers(lab_id, request.args.get('query'))
+    return render_template('lab/partials/customer_search_rows.html', customers=customers)
 
 
 @lab.route('/api/packages/<int:package_id>/info')
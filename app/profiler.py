@@ -0,0 +1,184 @@
+import threading
+import time
+from collections import deque, defaultdict
+from contextlib import contextmanager
+
+from flask import g, request, before_render_template, template_rendered, current_app
+from flask_admin import BaseView, expose
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+
+class QueryRecorder:
+    """Collects the statements executed on this thread while it is active."""
+
+    def __init__(self, keep_slowest=5):
+        self.keep_slowest = keep_slowest
+        self.count = 0
+        self.duration = 0.0
+        self.statements = []
+
+    def add(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements.append((duration, statement))
+
+    @property
+    def slowest(self):
+        return sorted(self.statements, key=lambda s: s[0], reverse=True)[:self.keep_slowest]
+
+    def __enter__(self):
+        active_recorders().append(self)
+        return self
+
+    def __exit__(self, *exc):
+        active_recorders().remove(self)
+
+
+def active_recorders():
+    if not hasattr(_local, 'recorders'):
+        _local.recorders = []
+    return _local.recorders
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if active_recorders():
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    recorders = active_recorders()
+    if recorders and conn.info.get('query_start_time'):
+        duration = time.perf_counter() - conn.info['query_start_time'].pop()
+        for recorder in recorders:
+            recorder.add(statement, duration)
+
+
+@contextmanager
+def assert_max_queries(limit):
+    """Fail when the block issues more than ``limit`` statements.
+
+    with assert_max_queries(5):
+        client.get('/lab/orders/1/records')
+    """
+    with QueryRecorder(keep_slowest=limit + 1) as recorder:
+        yield recorder
+    if recorder.count > limit:
+        statements = '\n'.join(statement for _, statement in recorder.statements)
+        raise AssertionError(f'{recorder.count} queries were issued, the budget is {limit}:\n{statements}')
+
+
+class RequestProfiler:
+    """Per-request query counts, database time and render time.
+
+    The numbers are sent in a Server-Timing header and the last requests are
+    kept in a ring buffer for the profiler panel of the admin.
+    """
+
+    def __init__(self, app=None):
+        self.history = deque(maxlen=500)
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILER_ENABLED', False)
+        app.config.setdefault('PROFILER_HISTORY', 500)
+        app.config.setdefault('PROFILER_SLOW_QUERY_MS', 200)
+        if not app.config['PROFILER_ENABLED']:
+            return
+        self.history = deque(maxlen=app.config['PROFILER_HISTORY'])
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        app.teardown_request(self.teardown)
+        before_render_template.connect(self.start_render, app)
+        template_rendered.connect(self.finish_render, app)
+        app.extensions['profiler'] = self
+
+    def start(self):
+        g.profile_recorder = QueryRecorder()
+        active_recorders().append(g.profile_recorder)
+        g.profile_started_at = time.perf_counter()
+        g.profile_render_time = 0.0
+
+    def start_render(self, sender, template, context, **extra):
+        g.profile_render_started_at = time.perf_counter()
+
+    def finish_render(self, sender, template, context, **extra):
+        started_at = g.pop('profile_render_started_at', None)
+        if started_at is not None:
+            g.profile_render_time += time.perf_counter() - started_at
+
+    def finish(self, response):
+        recorder = g.pop('profile_recorder', None)
+        if recorder is None:
+            return response
+        active_recorders().remove(recorder)
+        total = time.perf_counter() - g.profile_started_at
+        response.headers['Server-Timing'] = ', '.join([
+            f'db;dur={recorder.duration * 1000:.1f};desc="{recorder.count} queries"',
+            f'render;dur={g.profile_render_time * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ])
+        slow_ms = current_app.config['PROFILER_SLOW_QUERY_MS']
+        for duration, statement in recorder.slowest:
+            if duration * 1000 >= slow_ms:
+                current_app.logger.warning('Slow query (%.1f ms) in %s: %s',
+                                           duration * 1000, request.endpoint, statement)
+        with self._lock:
+            self.history.append({
+                'endpoint': request.endpoint,
+                'method': request.method,
+                'path': request.full_path.rstrip('?'),
+                'status': response.status_code,
+                'total_ms': total * 1000,
+                'db_ms': recorder.duration * 1000,
+                'render_ms': g.profile_render_time * 1000,
+                'queries': recorder.count,
+                'slowest': [(duration * 1000, statement) for duration, statement in recorder.slowest],
+            })
+        return response
+
+    def teardown(self, exc):
+        # after_request is skipped when the view raised
+        recorder = g.pop('profile_recorder', None)
+        if recorder is not None:
+            active_recorders().remove(recorder)
+
+    def summary(self):
+        """Aggregate the history by endpoint, the endpoints with the most queries first."""
+        with self._lock:
+            entries = list(self.history)
+        endpoints = defaultdict(list)
+        for entry in entries:
+            endpoints[entry['endpoint']].append(entry)
+        rows = []
+        for endpoint, items in endpoints.items():
+            totals = sorted(item['total_ms'] for item in items)
+            rows.append({
+                'endpoint': endpoint,
+                'requests': len(items),
+                'avg_queries': sum(item['queries'] for item in items) / len(items),
+                'max_queries': max(item['queries'] for item in items),
+                'avg_db_ms': sum(item['db_ms'] for item in items) / len(items),
+                'avg_render_ms': sum(item['render_ms'] for item in items) / len(items),
+                'p95_ms': totals[min(len(totals) - 1, int(len(totals) * 0.95))],
+            })
+        return sorted(rows, key=lambda row: row['max_queries'], reverse=True), list(reversed(entries))
+
+
+profiler = RequestProfiler()
+
+
+class ProfilerView(BaseView):
+    @expose('/')
+    def index(self):
+        summary, entries = profiler.summary()
+        return self.render('admin/profiler.html',
+                           enabled='profiler' in current_app.extensions,
+                           summary=summary,
+                           entries=entries[:100])
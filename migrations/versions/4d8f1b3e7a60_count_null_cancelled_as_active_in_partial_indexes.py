@@ -0,0 +1,36 @@
+"""count null cancelled as active in partial indexes
+
+Revision ID: 4d8f1b3e7a60
+Revises: 9e4b2c6a1f73
+Create Date: 2026-10-19 10:41:15.872034
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4d8f1b3e7a60'
+down_revision = '9e4b2c6a1f73'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('lab_test_records', schema=None) as batch_op:
+        batch_op.drop_index('ix_lab_test_records_pending')
+        batch_op.drop_index('ix_lab_test_records_overdue_at')
+        batch_op.create_index('ix_lab_test_records_pending', ['order_id', 'received_at'], unique=False,
+                              postgresql_where=sa.text('updated_at IS NULL AND cancelled IS NOT TRUE AND reject_record_id IS NULL'))
+        batch_op.create_index('ix_lab_test_records_overdue_at', ['overdue_at'], unique=False,
+                              postgresql_where=sa.text('updated_at IS NULL AND cancelled IS NOT TRUE AND reject_record_id IS NULL'))
+
+
+def downgrade():
+    with op.batch_alter_table('lab_test_records', schema=None) as batch_op:
+        batch_op.drop_index('ix_lab_test_records_overdue_at')
+        batch_op.drop_index('ix_lab_test_records_pending')
+        batch_op.create_index('ix_lab_test_records_overdue_at', ['overdue_at'], unique=False,
+                              postgresql_where=sa.text('updated_at IS NULL AND NOT cancelled AND reject_record_id IS NULL'))
+        batch_op.create_index('ix_lab_test_records_pending', ['order_id', 'received_at'], unique=False,
+                              postgresql_where=sa.text('updated_at IS NULL AND NOT cancelled AND reject_record_id IS NULL'))
@@ -0,0 +1,48 @@
+"""added unique keys to counter tables
+
+Revision ID: 5d2c7a41e9b3
+Revises: 3b8e1f6c9a20
+Create Date: 2026-10-18 10:02:15.551907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2c7a41e9b3'
+down_revision = '3b8e1f6c9a20'
+branch_labels = None
+depends_on = None
+
+
+def merge_duplicates(table):
+    # keep the oldest row of each month with the highest count seen
+    op.execute(f'''
+        UPDATE {table} AS c SET count = d.max_count
+        FROM (SELECT year, month, MIN(id) AS id, MAX(count) AS max_count
+              FROM {table} GROUP BY year, month HAVING COUNT(*) > 1) AS d
+        WHERE c.id = d.id
+    ''')
+    op.execute(f'''
+        DELETE FROM {table} AS c USING {table} AS k
+        WHERE c.year = k.year AND c.month = k.month AND c.id > k.id
+    ''')
+
+
+def upgrade():
+    merge_duplicates('lab_order_counts')
+    merge_duplicates('lab_hn_count')
+    with op.batch_alter_table('lab_hn_count', schema=None) as batch_op:
+        batch_op.create_unique_constraint('lab_hn_count_year_month_unique', ['year', 'month'])
+
+    with op.batch_alter_table('lab_order_counts', schema=None) as batch_op:
+        batch_op.create_unique_constraint('lab_order_counts_year_month_unique', ['year', 'month'])
+
+
+def downgrade():
+    with op.batch_alter_table('lab_order_counts', schema=None) as batch_op:
+        batch_op.drop_constraint('lab_order_counts_year_month_unique', type_='unique')
+
+    with op.batch_alter_table('lab_hn_count', schema=None) as batch_op:
+        batch_op.drop_constraint('lab_hn_count_year_month_unique', type_='unique')
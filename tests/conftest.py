@@ -0,0 +1,52 @@
+import os
+import tempfile
+
+import arrow
+import pytest
+
+# wsgi creates the app on import, so the database is set before
+DB_PATH = os.path.join(tempfile.mkdtemp(prefix='one-lims-tests-'), 'test.sqlite')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+os.environ.setdefault('SECRET_KEY', 'test')
+
+import wsgi  # noqa: E402
+from app import db  # noqa: E402
+from app.auth.models import User  # noqa: E402
+from app.main.models import Laboratory, UserLabAffil  # noqa: E402
+from app.lab.models import LabTest, LabCustomer  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    app = wsgi.app
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False, ACTIVITY_FLUSH_MS=0)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def lab(app):
+    user = User('Lab', 'User', 'lab@one-lims.local', 'password', '1')
+    db.session.add(user)
+    lab = Laboratory(name='Lab', creator=user, address='Address', tax_id='1')
+    db.session.add_all([lab, UserLabAffil(user=user, lab=lab, approved=True)])
+    db.session.add_all([LabTest(name=f'Test {i}', code=f'T{i}', lab=lab, price=100, data_type='Numeric',
+                                min_ref_value=1, max_ref_value=10, added_at=arrow.now('Asia/Bangkok').datetime)
+                        for i in range(3)])
+    db.session.add(LabCustomer(title='นาย', firstname='สมชาย', lastname='ใจดี', lab=lab, hn='1', gender='ชาย',
+                               address='Address', tel='1', pid='1234567890123'))
+    db.session.commit()
+    return lab
+
+
+@pytest.fixture
+def client(app, lab):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(lab.creator.id)
+        session['_fresh'] = True
+        session['lab_id'] = lab.id
+    return client
@@ -0,0 +1,20 @@
+import arrow
+
+from app import db
+from app.lab.apikeys import hash_key
+from app.lab.models import LabApiKey
+
+
+def test_last_used_at_is_saved_when_the_view_does_not_commit(client, lab):
+    api_key = LabApiKey(lab_id=lab.id, user=lab.creator, name='Bridge', key_hash=hash_key('secret'),
+                        created_at=arrow.now('Asia/Bangkok').datetime)
+    db.session.add(api_key)
+    db.session.commit()
+    key_id, lab_id = api_key.id, lab.id
+    db.session.remove()
+    # a rejected payload returns before anything is committed
+    response = client.post(f'/lab/api/labs/{lab_id}/results', data='not a result file',
+                           content_type='text/plain', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 400
+    db.session.remove()
+    assert db.session.get(LabApiKey, key_id).last_used_at is not None
@@ -0,0 +1,78 @@
+import os
+import threading
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from app import create_app, db
+from app.auth.models import User
+from app.main.models import Laboratory, UserLabAffil
+from app.lab import counters
+from app.lab.models import LabOrderCount, LabTest, LabCustomer, LabTestOrder
+
+TEST_POSTGRES_URL = os.environ.get('TEST_POSTGRES_URL')
+
+
+def test_allocate_retries_when_another_worker_inserted_the_month(app, monkeypatch):
+    increment = counters.increment
+    calls = []
+
+    def racing_increment(conn, table, year, month, size):
+        calls.append(size)
+        if len(calls) == 1:
+            # another worker inserts the row of the month first
+            with db.engine.begin() as other:
+                other.execute(table.insert().values(year=year, month=month, count=5))
+            raise IntegrityError('INSERT', {}, Exception('duplicate key'))
+        return increment(conn, table, year, month, size)
+
+    monkeypatch.setattr(counters, 'increment', racing_increment)
+    assert list(counters.allocate(LabOrderCount, 2026, 1, size=2)) == [6, 7]
+    assert len(calls) == 2
+
+
+@pytest.mark.skipif(not TEST_POSTGRES_URL, reason='TEST_POSTGRES_URL is not set')
+def test_parallel_orders_get_unique_codes(monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', TEST_POSTGRES_URL)
+    app = create_app()
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False, ACTIVITY_FLUSH_MS=0)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User('Lab', 'User', 'lab@one-lims.local', 'password', '1')
+        lab = Laboratory(name='Lab', creator=user, address='Address', tax_id='1')
+        test = LabTest(name='Test', code='T1', lab=lab, price=100, data_type='Numeric')
+        customer = LabCustomer(firstname='A', lastname='B', lab=lab, hn='1')
+        db.session.add_all([user, lab, test, customer, UserLabAffil(user=user, lab=lab, approved=True)])
+        db.session.commit()
+        user_id, lab_id, test_id, customer_id = user.id, lab.id, test.id, customer.id
+
+    threads, orders_per_thread = 8, 10
+    errors = []
+
+    def place_orders():
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+        try:
+            for _ in range(orders_per_thread):
+                response = client.post(f'/lab/{lab_id}/patients/{customer_id}/orders',
+                                       data={'test_ids': [test_id]})
+                assert response.status_code == 302
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=place_orders) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    with app.app_context():
+        codes = [code for code, in db.session.query(LabTestOrder.code)]
+        db.session.remove()
+        db.drop_all()
+    assert not errors
+    assert len(codes) == threads * orders_per_thread
+    assert len(set(codes)) == len(codes)
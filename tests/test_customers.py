@@ -0,0 +1,20 @@
+from app import db
+from app.auth.models import User
+from app.main.models import Laboratory
+from app.lab.models import LabCustomer
+
+
+def test_search_customers_of_the_lab(client, lab):
+    response = client.get(f'/lab/api/customers/search?lab_id={lab.id}&query=สมชาย')
+    assert response.status_code == 200
+    assert 'สมชาย' in response.get_data(as_text=True)
+
+
+def test_search_customers_of_another_lab_is_forbidden(client, lab):
+    user = User('Other', 'User', 'other@one-lims.local', 'password', '2')
+    other = Laboratory(name='Other', creator=user, address='Address', tax_id='2')
+    db.session.add(LabCustomer(title='นาง', firstname='สมศรี', lastname='มีสุข', lab=other, hn='2',
+                               gender='หญิง', address='Address', tel='2', pid='1234567890124'))
+    db.session.commit()
+    response = client.get(f'/lab/api/customers/search?lab_id={other.id}&query=สมศรี')
+    assert response.status_code == 403
@@ -0,0 +1,33 @@
+import arrow
+import pytest
+
+from app import db
+from app.lab.models import LabTestOrder, LabTestRecord
+from app.profiler import assert_max_queries
+
+
+@pytest.fixture
+def orders(lab):
+    now = arrow.now('Asia/Bangkok').datetime
+    orders = [LabTestOrder(lab_id=lab.id, customer_id=lab.customers[0].id, code=f'O{i}', ordered_at=now)
+              for i in range(10)]
+    db.session.add_all(orders)
+    db.session.flush()
+    db.session.add_all([LabTestRecord(order_id=order.id, test_id=test.id, received_at=now)
+                        for order in orders for test in lab.tests])
+    db.session.commit()
+    return [order.id for order in orders]
+
+
+@pytest.mark.parametrize('path, budget', [
+    ('/lab/api/labs/{lab_id}/orders', 4),
+    ('/lab/api/labs/{lab_id}/pending-records', 4),
+    ('/lab/orders/{order_id}/records', 5),
+])
+def test_views_stay_within_their_query_budget(client, lab, orders, path, budget):
+    url = path.format(lab_id=lab.id, order_id=orders[0])
+    db.session.remove()
+    # the budget does not grow with the number of orders and records
+    with assert_max_queries(budget):
+        response = client.get(url)
+    assert response.status_code == 200
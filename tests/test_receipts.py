@@ -0,0 +1,38 @@
+import arrow
+
+from app import db
+from app.lab.models import LabTestOrder, LabTestRecord, LabOrderPaymentRecord
+from app.lab.orders import load_order_for_display
+from app.lab.pdf import receipt_cache_key
+from app.profiler import assert_max_queries
+
+
+def add_paid_order(lab, code):
+    now = arrow.now('Asia/Bangkok').datetime
+    order = LabTestOrder(lab_id=lab.id, customer_id=lab.customers[0].id, code=code, ordered_at=now)
+    db.session.add(order)
+    db.session.flush()
+    db.session.add_all([LabTestRecord(order_id=order.id, test_id=test.id) for test in lab.tests])
+    db.session.add(LabOrderPaymentRecord(order_id=order.id, payment_amount=300, created_at=now,
+                                         payment_datetime=now, creator_id=lab.creator.id))
+    db.session.commit()
+    return order.id
+
+
+def test_receipt_cache_key_follows_the_printed_customer(app, lab):
+    order_id = add_paid_order(lab, 'O1')
+    key = receipt_cache_key(load_order_for_display(order_id))
+    lab.customers[0].address = 'New address'
+    db.session.commit()
+    assert receipt_cache_key(load_order_for_display(order_id)) != key
+
+
+def test_receipts_batch_loads_the_orders_in_fixed_queries(app, client, lab, tmp_path):
+    app.config['PDF_CACHE_DIR'] = str(tmp_path)
+    order_ids = [add_paid_order(lab, f'O{i}') for i in range(5)]
+    lab_id = lab.id
+    db.session.remove()
+    with assert_max_queries(6):
+        response = client.get(f'/lab/labs/{lab_id}/receipts/batch', query_string={'order_ids': order_ids})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/pdf'
@@ -0,0 +1,15 @@
+from app import db
+from app.lab.models import LabTestOrder, LabTestRecord
+
+
+def test_report_pages_render_an_order_without_results(client, lab):
+    order = LabTestOrder(lab_id=lab.id, customer_id=lab.customers[0].id, code='O1')
+    db.session.add(order)
+    db.session.flush()
+    db.session.add_all([LabTestRecord(order_id=order.id, test_id=test.id) for test in lab.tests])
+    db.session.commit()
+
+    for path in (f'/lab/reports/{order.id}/preview', f'/lab/reports/{order.id}/print'):
+        response = client.get(path)
+        assert response.status_code == 200
+        assert 'Report Date Time' not in response.get_data(as_text=True)
@@ -0,0 +1,22 @@
+import arrow
+
+from app import db
+from app.lab.models import LabTestOrder, LabTestRecord
+from app.lab.results import apply_results
+
+
+def test_the_latest_row_of_a_record_in_a_batch_is_saved(lab):
+    now = arrow.now('Asia/Bangkok').datetime
+    order = LabTestOrder(lab_id=lab.id, customer_id=lab.customers[0].id, code='O1', ordered_at=now)
+    db.session.add(order)
+    db.session.flush()
+    db.session.add(LabTestRecord(order_id=order.id, test_id=lab.tests[0].id, received_at=now))
+    db.session.commit()
+    rows = [
+        {'order_code': 'O1', 'test_code': 'T0', 'result': 5, 'observed_at': '2026-01-01T10:00:00'},
+        {'order_code': 'O1', 'test_code': 'T0', 'result': 7, 'observed_at': '2026-01-01T11:00:00'},
+        {'order_code': 'O1', 'test_code': 'T0', 'result': 6, 'observed_at': '2026-01-01T10:30:00'},
+    ]
+    summary = apply_results(lab.id, rows, lab.creator)
+    assert summary == {'updated': 1, 'skipped': 2, 'errors': []}
+    assert LabTestRecord.query.filter_by(order_id=order.id).one().num_result == 7
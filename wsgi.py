@@ -22,9 +22,11 @@ admin.add_view(ModelView(Laboratory, db.session, category='Labs'))
 from app.lab.models import *
 
 admin.add_view(ModelView(LabTest, db.session, category='Tests'))
+admin.add_view(ModelView(LabTestReferenceRange, db.session, category='Tests'))
 admin.add_view(ModelView(LabOrderCount, db.session, category='Tests'))
 admin.add_view(ModelView(LabTestOrder, db.session, category='Tests'))
 admin.add_view(ModelView(LabOrderPaymentRecord, db.session, category='Tests'))
+admin.add_view(ModelView(LabInvoiceJob, db.session, category='Tests'))
 admin.add_view(ModelView(LabTestRecord, db.session, category='Tests'))
 admin.add_view(ModelView(LabResultChoiceSet, db.session, category='Tests'))
 admin.add_view(ModelView(LabResultChoiceItem, db.session, category='Tests'))
@@ -38,6 +40,10 @@ admin.add_view(ModelView(Announcement, db.session, category='Announcement'))
 admin.add_view(ModelView(UserLabAffil, db.session, category='Labs'))
 admin.add_view(ModelView(Role, db.session, category='Permission'))
 
+from app.profiler import ProfilerView
+
+admin.add_view(ProfilerView(name='Profiler', endpoint='profiler', category='Debug'))
+
 
 @app.route('/')
 def index():